@@ -0,0 +1,230 @@
+from datetime import datetime, timedelta, timezone
+import argparse
+import json
+import os
+import random
+import sys
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPOSITORY_DIRECTORY, "src"))
+
+from city_registry import feed_file_name  # noqa: E402
+
+# The four real cities, then synthetic cities with an Opendatasoft (Vélib' shaped)
+# feed of their own, named after made-up INSEE codes
+NANTES_CODE = "44109"
+TOULOUSE_CODE = "31555"
+MONTPELLIER_CODE = "34172"
+PARIS_CODE = "75056"
+
+# Communes in the commune feed without any station, like most real communes
+FILLER_COMMUNES = 1000
+
+
+def city_codes(nb_cities):
+    """
+    Returns the INSEE code of each synthetic city: the four real cities, then
+    made-up codes.
+
+    Args:
+        nb_cities (int): Number of cities, at least 4.
+    """
+    extra_codes = [f"{90000 + i}" for i in range(max(nb_cities - 4, 0))]
+    return [PARIS_CODE, NANTES_CODE, TOULOUSE_CODE, MONTPELLIER_CODE, *extra_codes]
+
+
+def city_name(code):
+    """
+    Returns the name of a city.
+
+    Args:
+        code (str): The INSEE code of the city.
+    """
+    names = {
+        PARIS_CODE: "Paris",
+        NANTES_CODE: "Nantes",
+        TOULOUSE_CODE: "Toulouse",
+        MONTPELLIER_CODE: "Montpellier",
+    }
+    return names.get(code, f"City {code}")
+
+
+def write_city_registry(path, nb_cities, base_url):
+    """
+    Writes a city registry (see data/cities.toml) of the synthetic cities, whose
+    feeds are served by the stub server.
+
+    Args:
+        path (str): The registry file.
+        nb_cities (int): Number of cities, at least 4.
+        base_url (str): The stub server URL.
+    """
+    formats = {NANTES_CODE: "jcdecaux", TOULOUSE_CODE: "jcdecaux", MONTPELLIER_CODE: "gbfs"}
+    lines = []
+    for key, code in enumerate(city_codes(nb_cities), start=1):
+        name, feed_format = city_name(code), formats.get(code, "opendatasoft")
+        lines += ["[[city]]", f'name = "{name}"', f"key = {key}", f'format = "{feed_format}"']
+        if feed_format != "opendatasoft":
+            lines.append(f'insee_code = "{code}"')
+        if feed_format == "gbfs":
+            for feed in ("station_status", "station_information"):
+                lines.append(f'{feed}_url = "{base_url}/{feed_file_name(name, feed)}"')
+        else:
+            lines.append(f'url = "{base_url}/{feed_file_name(name, "realtime")}"')
+        lines.append("")
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as fd:
+        fd.write("\n".join(lines))
+
+
+def station_counts(rng, capacity):
+    """
+    Returns random (bikes, docks) available for a station.
+
+    Args:
+        rng (random.Random): The random generator.
+        capacity (int): The station capacity.
+    """
+    bikes = rng.randint(0, capacity)
+    return bikes, capacity - bikes
+
+
+def generate_feeds(
+    directory, nb_cities=4, nb_stations=100, snapshot=0, seed=0, snapshot_minutes=15
+):
+    """
+    Writes one snapshot of every source feed. Station lists and attributes only
+    depend on the seed, the availability counts and timestamps change with the
+    snapshot, so consecutive snapshots look like consecutive fetches.
+
+    Args:
+        directory (str): Directory the feeds are written to, named like the raw files.
+        nb_cities (int): Number of cities with stations, at least 4.
+        nb_stations (int): Number of stations per city.
+        snapshot (int): Snapshot number.
+        seed (int): Random seed.
+        snapshot_minutes (int): Minutes between two snapshots.
+
+    Returns:
+        dict: The number of stations written to each feed.
+    """
+    rng = random.Random(f"{seed}-{snapshot}")
+    reported_at = datetime(2025, 1, 1, tzinfo=timezone.utc) + timedelta(
+        minutes=snapshot * snapshot_minutes
+    )
+    codes = city_codes(nb_cities)
+    os.makedirs(directory, exist_ok=True)
+
+    # Opendatasoft shaped (Vélib'): Paris and every synthetic city
+    def opendatasoft(city_index, code):
+        stations = []
+        for i in range(nb_stations):
+            capacity = 20 + (i % 3) * 10
+            bikes, docks = station_counts(rng, capacity)
+            stations.append({
+                "stationcode": f"{city_index}{i:05d}",
+                "name": f"Station {code} {i}",
+                "is_installed": "NON" if i % 50 == 0 else "OUI",
+                "capacity": capacity,
+                "numdocksavailable": docks,
+                "numbikesavailable": bikes,
+                "mechanical": bikes // 2,
+                "ebike": bikes - bikes // 2,
+                "duedate": reported_at.isoformat(),
+                "coordonnees_geo": {
+                    "lon": 2.0 + city_index * 0.2 + (i % 100) * 0.001,
+                    "lat": 48.5 + (i // 100) * 0.001,
+                },
+                "nom_arrondissement_communes": city_name(code),
+                "code_insee_commune": code,
+            })
+        return stations
+
+    paris = opendatasoft(0, PARIS_CODE)
+    other_cities = {
+        feed_file_name(city_name(code), "realtime"): opendatasoft(city_index, code)
+        for city_index, code in enumerate(codes[4:], start=1)
+    }
+
+    # Opendatasoft shaped (JCDecaux): Nantes and Toulouse
+    def jcdecaux(longitude, latitude):
+        stations = []
+        for i in range(nb_stations):
+            bikes, docks = station_counts(rng, 20)
+            stations.append({
+                "number": i + 1,
+                "name": f"{i + 1:03d} - STATION {i}",
+                "address": f"{i} rue de la Gare",
+                "position": {"lon": longitude + i * 0.0005, "lat": latitude + i * 0.0005},
+                "status": "OPEN" if i % 40 else "CLOSED",
+                "bike_stands": 20,
+                "available_bike_stands": docks,
+                "available_bikes": bikes,
+                "last_update": reported_at.isoformat(),
+            })
+        return stations
+
+    # GBFS shaped: Montpellier
+    status = []
+    information = []
+    for i in range(nb_stations):
+        bikes, docks = station_counts(rng, 12)
+        status.append({
+            "station_id": f"{i}",
+            "is_installed": 1,
+            "num_bikes_available": bikes,
+            "num_docks_available": docks,
+            "last_reported": int(reported_at.timestamp()),
+        })
+        information.append({
+            "station_id": f"{i}",
+            "name": f"Montpellier {i}",
+            "lat": 43.6 + i * 0.0005,
+            "lon": 3.87 + i * 0.0005,
+            "capacity": 12,
+        })
+    last_updated = int(reported_at.timestamp())
+
+    communes = [
+        {"nom": "Paris", "code": PARIS_CODE, "population": 2100000},
+        {"nom": "Nantes", "code": NANTES_CODE, "population": 320000},
+        {"nom": "Toulouse", "code": TOULOUSE_CODE, "population": 500000},
+        {"nom": "Montpellier", "code": MONTPELLIER_CODE, "population": 300000},
+        *[{"nom": city_name(code), "code": code, "population": 10000} for code in codes[4:]],
+        *[{"nom": f"Commune {i}", "code": f"{10000 + i}", "population": 100} for i in range(FILLER_COMMUNES)],
+    ]
+
+    feeds = {
+        "paris_realtime_bicycle_data.json": paris,
+        "nantes_realtime_bicycle_data.json": jcdecaux(-1.55, 47.2),
+        "toulouse_realtime_bicycle_data.json": jcdecaux(1.44, 43.6),
+        "montpellier_realtime_bicycle_station_status_data.json": {
+            "last_updated": last_updated, "ttl": 60, "data": {"stations": status}
+        },
+        "montpellier_realtime_bicycle_station_information_data.json": {
+            "last_updated": last_updated, "ttl": 3600, "data": {"stations": information}
+        },
+        "commune_data.json": communes,
+        **other_cities,
+    }
+    for file_name, feed in feeds.items():
+        with open(os.path.join(directory, file_name), "w", encoding="utf-8") as fd:
+            json.dump(feed, fd)
+
+    return {
+        file_name: len(feed["data"]["stations"] if isinstance(feed, dict) else feed)
+        for file_name, feed in feeds.items()
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write one snapshot of synthetic source feeds.")
+    parser.add_argument("directory", help="Output directory")
+    parser.add_argument("--cities", type=int, default=4, help="Number of cities, at least 4")
+    parser.add_argument("--stations", type=int, default=100, help="Stations per city")
+    parser.add_argument("--snapshot", type=int, default=0, help="Snapshot number")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    print(generate_feeds(args.directory, args.cities, args.stations, args.snapshot, args.seed))
@@ -0,0 +1,383 @@
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from generate_feeds import generate_feeds, write_city_registry
+from stub_server import start_stub_server, use_stub_server
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIRECTORY = os.path.join(REPOSITORY_DIRECTORY, "benchmarks", "results")
+
+# A scenario is flagged when its median time grows by more than this ratio, and
+# by more than the noise floor
+REGRESSION_RATIO = 1.2
+NOISE_FLOOR_SECONDS = 0.005
+
+
+def timed(timings, scenario, function, *args, **kwargs):
+    """
+    Runs a function and appends its wall time to the timings of a scenario.
+
+    Args:
+        timings (dict): The wall times of each scenario, updated in place.
+        scenario (str): The scenario name.
+        function (callable): The function.
+
+    Returns:
+        The result of the function.
+    """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    timings.setdefault(scenario, []).append(round(time.perf_counter() - start, 6))
+    return result
+
+
+def run_stages(timings, run_at, run_id):
+    """
+    Runs the ETL stages one by one on a single connection, timing each of them.
+
+    Args:
+        timings (dict): The wall times of each scenario, updated in place.
+        run_at (datetime): Start time of the run.
+        run_id (str): The run, names the published database.
+    """
+    from data_agregation import (
+        agregate_dim_city,
+        agregate_dim_station,
+        agregate_fact_station_statements,
+        agregate_rollups,
+        create_agregate_tables,
+    )
+    from city_registry import FEED_FORMATS, cities_of_format
+    from data_consolidation import (
+        consolidate_city_data,
+        consolidate_feed_format,
+        create_consolidate_tables,
+        create_snapshot_view,
+    )
+    from data_ingestion import SNAPSHOT_MODE, get_all_data
+    from data_publication import publish_database
+    from database import connect, transaction
+    from spatial_index import build_station_grid
+
+    timed(timings, "ingest", get_all_data, run_at)
+
+    with connect() as con:
+        timed(timings, "create_tables", lambda: (create_consolidate_tables(con), create_agregate_tables(con)))
+
+        with transaction(con):
+            timed(timings, "consolidate_cities", consolidate_city_data, con)
+        for feed_format in FEED_FORMATS:
+            if not cities_of_format(feed_format):
+                continue
+            # Opens its own transaction once the feeds are staged
+            timed(
+                timings,
+                f"consolidate_{feed_format}",
+                consolidate_feed_format,
+                con,
+                feed_format,
+                run_at,
+            )
+
+        with transaction(con):
+            timed(timings, "agregate_dim_city", agregate_dim_city, con)
+            timed(timings, "agregate_dim_station", agregate_dim_station, con)
+            timed(timings, "build_station_grid", build_station_grid, con)
+            if SNAPSHOT_MODE:
+                create_snapshot_view(con)
+            timed(timings, "agregate_fact_station_statements", agregate_fact_station_statements, con)
+            timed(timings, "agregate_rollups", agregate_rollups, con)
+
+        timed(timings, "publish", publish_database, con, run_id)
+
+
+def run_pipeline(timings, run_id):
+    """
+    Runs the ETL pipeline as the refresher does, timing the whole run and, from
+    the run metrics, each of its tasks.
+
+    Args:
+        timings (dict): The wall times of each scenario, updated in place.
+        run_id (str): The run, names the published database.
+    """
+    from database import connect
+    from etl_refresher import run_etl
+
+    timed(timings, "pipeline", run_etl, run_id)
+
+    with connect(read_only=True) as con:
+        tasks = con.execute(
+            "SELECT STAGE, DURATION_SECONDS FROM ETL_RUN_METRICS WHERE RUN_ID = ? AND KIND = 'task'",
+            [run_id],
+        ).fetchall()
+    for stage, duration_seconds in tasks:
+        timings.setdefault(f"task.{stage}", []).append(duration_seconds)
+
+
+def run_dashboard_queries(timings, run_id):
+    """
+    Times the dashboard queries on the published database of a run, bypassing
+    the Streamlit cache.
+
+    Args:
+        timings (dict): The wall times of each scenario, updated in place.
+        run_id (str): The run whose published database is read.
+    """
+    import dashboard_data as dashboard
+
+    cities = dashboard.get_cities.__wrapped__(run_id).to_pylist()
+    city_id = next(city["ID"] for city in cities if city["NAME"] == "Paris")
+    center = dashboard.get_map_center.__wrapped__(run_id, city_id)
+    queries = {
+        "get_cities": lambda: dashboard.get_cities.__wrapped__(run_id),
+        "get_station_count": lambda: dashboard.get_station_count.__wrapped__(run_id),
+        "get_map_center": lambda: dashboard.get_map_center.__wrapped__(run_id, city_id),
+        "get_map_points_clusters": lambda: dashboard.get_map_points.__wrapped__(
+            run_id, 5, dashboard.viewport_bounds(center, 5)
+        ),
+        "get_map_points_stations": lambda: dashboard.get_map_points.__wrapped__(
+            run_id, dashboard.DETAIL_ZOOM, dashboard.viewport_bounds(center, dashboard.DETAIL_ZOOM)
+        ),
+        "get_nearest_stations": lambda: dashboard.get_nearest_stations.__wrapped__(
+            run_id, center["lon"], center["lat"]
+        ),
+        "get_docks_by_city": lambda: dashboard.get_docks_by_city.__wrapped__(run_id),
+        "get_top_stations": lambda: dashboard.get_top_stations.__wrapped__(run_id),
+        "get_station_summary": lambda: dashboard.get_station_summary.__wrapped__(run_id),
+        "get_avg_bikes_histogram": lambda: dashboard.get_avg_bikes_histogram.__wrapped__(run_id),
+    }
+    for name, query in queries.items():
+        timed(timings, f"dashboard.{name}", query)
+
+
+def summarize(timings):
+    """
+    Returns the wall times of each scenario with their median, min, max and total.
+
+    Args:
+        timings (dict): The wall times of each scenario.
+    """
+    return {
+        scenario: {
+            "median": round(statistics.median(seconds), 6),
+            "min": min(seconds),
+            "max": max(seconds),
+            "total": round(sum(seconds), 6),
+            "seconds": seconds,
+        }
+        for scenario, seconds in timings.items()
+    }
+
+
+def database_summary():
+    """
+    Returns the size of the database file and the number of rows of its main tables.
+    """
+    from database import DATABASE_PATH, connect
+
+    with connect(read_only=True) as con:
+        rows = {
+            table_name: con.execute(f"SELECT count(*) FROM {table_name}").fetchone()[0]
+            for table_name in [
+                "CONSOLIDATE_CITY",
+                "CONSOLIDATE_STATION",
+                "CONSOLIDATE_STATION_STATEMENT",
+                "DIM_STATION",
+                "FACT_STATION_STATEMENT",
+            ]
+        }
+
+    return {"database_bytes": os.path.getsize(DATABASE_PATH), "rows": rows}
+
+
+def git_commit():
+    """
+    Returns the commit of the benchmarked tree, None outside a git checkout.
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPOSITORY_DIRECTORY,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(current, previous, ratio=REGRESSION_RATIO):
+    """
+    Prints the median time of each scenario next to a previous benchmark and
+    returns the scenarios that got slower by more than `ratio`.
+
+    Args:
+        current (dict): The benchmark results.
+        previous (dict): The results to compare with.
+        ratio (float): Slowdown ratio flagged as a regression.
+
+    Returns:
+        list[str]: The regressed scenarios.
+    """
+    regressions = []
+    print(f"{'scenario':<45} {'previous':>10} {'current':>10} {'ratio':>7}")
+    for scenario, stats in current["scenarios"].items():
+        if scenario not in previous["scenarios"]:
+            continue
+        before = previous["scenarios"][scenario]["median"]
+        after = stats["median"]
+        change = after / before if before else float("inf")
+        regressed = change > ratio and after - before > NOISE_FLOOR_SECONDS
+        if regressed:
+            regressions.append(scenario)
+        print(
+            f"{scenario:<45} {before:>10.4f} {after:>10.4f} {change:>7.2f}"
+            + ("  REGRESSION" if regressed else "")
+        )
+    return regressions
+
+
+def run_benchmarks(
+    nb_cities, nb_stations, nb_snapshots, seed=0, latency_seconds=0.0, pipeline=False, workdir=None
+):
+    """
+    Runs the benchmark: for each snapshot, new synthetic feeds are served by the
+    stub server, then ingested, consolidated, aggregated and published, and the
+    dashboard queries are run on the publication. Runs in a scratch directory,
+    offline.
+
+    Args:
+        nb_cities (int): Number of cities, at least 4.
+        nb_stations (int): Stations per city.
+        nb_snapshots (int): Number of snapshots, one ETL run each.
+        seed (int): Random seed of the feeds.
+        latency_seconds (float): Delay of each stub server response.
+        pipeline (bool): Time the pipeline with its tasks instead of each stage.
+        workdir (str | None): Scratch directory, a temporary one if None.
+
+    Returns:
+        dict: The benchmark results.
+    """
+    workdir = workdir or tempfile.mkdtemp(prefix="velo-benchmark-")
+    shutil.copytree(
+        os.path.join(REPOSITORY_DIRECTORY, "data", "sql_statements"),
+        os.path.join(workdir, "data", "sql_statements"),
+        dirs_exist_ok=True,
+    )
+    feeds_directory = os.path.join(workdir, "feeds")
+    # The pipeline reads and writes data/... relative to the working directory
+    os.chdir(workdir)
+
+    server, base_url = start_stub_server(feeds_directory, latency_seconds)
+    # Read on first use of the registry by the pipeline modules
+    write_city_registry(os.path.join(workdir, "data", "cities.toml"), nb_cities, base_url)
+    os.environ["CITY_REGISTRY_FILE"] = os.path.join(workdir, "data", "cities.toml")
+    use_stub_server(base_url)
+
+    timings = {}
+    try:
+        for snapshot in range(nb_snapshots):
+            generate_feeds(feeds_directory, nb_cities, nb_stations, snapshot, seed)
+            # Raw files and snapshots of a run are named after its second
+            time.sleep(1 - time.time() % 1)
+            run_at = datetime.now()
+            run_id = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+            with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                if pipeline:
+                    run_pipeline(timings, run_id)
+                else:
+                    run_stages(timings, run_at, run_id)
+                run_dashboard_queries(timings, run_id)
+            print(f"Snapshot {snapshot + 1}/{nb_snapshots} done.", file=sys.stderr)
+    finally:
+        server.shutdown()
+
+    import duckdb
+
+    from data_ingestion import SNAPSHOT_MODE
+
+    return {
+        "benchmark_at": datetime.now(timezone.utc).isoformat(),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "duckdb": duckdb.__version__,
+        "platform": platform.platform(),
+        "parameters": {
+            "cities": nb_cities,
+            "stations_per_city": nb_stations,
+            "snapshots": nb_snapshots,
+            "seed": seed,
+            "latency_seconds": latency_seconds,
+            "pipeline": pipeline,
+            "snapshot_mode": SNAPSHOT_MODE,
+        },
+        **database_summary(),
+        "scenarios": summarize(timings),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the ETL on synthetic feeds.")
+    parser.add_argument("--cities", type=int, default=4, help="Number of cities, at least 4")
+    parser.add_argument("--stations", type=int, default=500, help="Stations per city")
+    parser.add_argument("--snapshots", type=int, default=5, help="Number of snapshots")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the feeds")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to each API response")
+    parser.add_argument("--pipeline", action="store_true", help="Time the pipeline and its tasks instead of each stage")
+    parser.add_argument("--daily", action="store_true", help="Keep one statement per day instead of every snapshot")
+    parser.add_argument("--workdir", help="Scratch directory, a temporary one by default")
+    parser.add_argument("--output", help="Results file, benchmarks/results/<date>_<commit>.json by default")
+    parser.add_argument("--compare", help="Previous results file to compare with")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with 1 if a scenario regressed")
+    args = parser.parse_args()
+
+    if args.cities < 4:
+        parser.error("--cities must be at least 4")
+
+    # Read by the pipeline modules when they are imported
+    os.environ["ETL_SNAPSHOT_MODE"] = "0" if args.daily else "1"
+    sys.path.insert(0, os.path.join(REPOSITORY_DIRECTORY, "src"))
+    logging.basicConfig(level=logging.WARNING)
+
+    output = os.path.abspath(args.output) if args.output else None
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as fd:
+            previous = json.load(fd)
+
+    results = run_benchmarks(
+        args.cities,
+        args.stations,
+        args.snapshots,
+        args.seed,
+        args.latency,
+        args.pipeline,
+        args.workdir,
+    )
+
+    if output is None:
+        os.makedirs(RESULTS_DIRECTORY, exist_ok=True)
+        output = os.path.join(
+            RESULTS_DIRECTORY,
+            f"{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}_{results['git_commit'] or 'local'}.json",
+        )
+    with open(output, "w", encoding="utf-8") as fd:
+        json.dump(results, fd, indent=2)
+    print(f"Results written to {output}")
+
+    if previous is not None:
+        regressions = compare_results(results, previous)
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
@@ -0,0 +1,99 @@
+import argparse
+import hashlib
+import http.server
+import os
+import threading
+import time
+
+
+class FeedHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves the files of a directory as the source APIs would: the file name is
+    the last path segment, with an ETag so conditional requests get a 304 when
+    the file did not change.
+    """
+
+    directory = "."
+    latency_seconds = 0.0
+
+    def do_GET(self):
+        file_name = self.path.split("?", 1)[0].rstrip("/").rsplit("/", 1)[-1]
+        path = os.path.join(self.directory, file_name)
+        if not os.path.isfile(path):
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        time.sleep(self.latency_seconds)
+        with open(path, "rb") as fd:
+            body = fd.read()
+        etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(directory, latency_seconds=0.0, port=0):
+    """
+    Starts the stub API server on a background thread.
+
+    Args:
+        directory (str): Directory of the served feeds.
+        latency_seconds (float): Delay added to every response, as a remote API.
+        port (int): Port to listen on, any free port if 0.
+
+    Returns:
+        tuple: The server and its base URL.
+    """
+    handler = type(
+        "Handler",
+        (FeedHandler,),
+        {"directory": directory, "latency_seconds": latency_seconds},
+    )
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def use_stub_server(base_url):
+    """
+    Points the commune data source at the stub server, served under its raw file
+    name. The city feeds come from the registry written for the stub server, see
+    generate_feeds.write_city_registry.
+
+    Args:
+        base_url (str): The stub server URL.
+    """
+    import data_ingestion
+
+    data_ingestion.COMMUNE_DATASETS[:] = [
+        (f"{base_url}/{file_name}", file_name) for _, file_name in data_ingestion.COMMUNE_DATASETS
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve synthetic feeds over HTTP.")
+    parser.add_argument("directory", help="Directory of the feeds")
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to each response")
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(args.directory, args.latency, args.port)
+    print(f"Serving {args.directory} on {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
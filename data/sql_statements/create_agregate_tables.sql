@@ -1,28 +1,105 @@
 CREATE TABLE IF NOT EXISTS DIM_STATION (
-    ID VARCHAR PRIMARY KEY,
+    ID INTEGER PRIMARY KEY,
     CODE VARCHAR,
     NAME VARCHAR,
     ADDRESS VARCHAR,
     LONGITUDE FLOAT,
     LATITUDE FLOAT,
-    STATUS VARCHAR,
-    CAPACITTY INTEGER
+    STATUS STATION_STATUS,
+    CAPACITTY SMALLINT,
+    CITY_ID INTEGER
 );
 
 CREATE TABLE IF NOT EXISTS DIM_CITY (
-    ID VARCHAR PRIMARY KEY,
+    ID INTEGER PRIMARY KEY,
+    CODE VARCHAR,
     NAME VARCHAR,
     NB_INHABITANTS INTEGER
 );
 
 CREATE TABLE IF NOT EXISTS FACT_STATION_STATEMENT (
-    STATION_ID VARCHAR NOT NULL,
-    CITY_ID VARCHAR NOT NULL,
-    BICYCLE_DOCKS_AVAILABLE INTEGER,
-    BICYCLE_AVAILABLE INTEGER,
-    LAST_STATEMENT_DATE DATETIME,
+    STATION_ID INTEGER NOT NULL,
+    CITY_ID INTEGER NOT NULL,
+    BICYCLE_DOCKS_AVAILABLE SMALLINT,
+    BICYCLE_AVAILABLE SMALLINT,
+    LAST_STATEMENT_DATE TIMESTAMP,
     CREATED_DATE DATE DEFAULT current_date,
     PRIMARY KEY (STATION_ID, CITY_ID, CREATED_DATE),
     FOREIGN KEY (STATION_ID) REFERENCES DIM_STATION (ID),
     FOREIGN KEY (CITY_ID) REFERENCES DIM_CITY (ID)
 );
+
+CREATE TABLE IF NOT EXISTS ETL_WATERMARK (
+    TABLE_NAME VARCHAR PRIMARY KEY,
+    WATERMARK TIMESTAMP,
+    UPDATED_AT TIMESTAMP
+);
+
+-- One row per pipeline task, instrumented function and fetched source of each run
+CREATE TABLE IF NOT EXISTS ETL_RUN_METRICS (
+    RUN_ID VARCHAR,
+    RUN_AT TIMESTAMP NOT NULL,
+    TASK VARCHAR,
+    STAGE VARCHAR NOT NULL,
+    KIND VARCHAR NOT NULL,
+    STARTED_AT TIMESTAMP,
+    DURATION_SECONDS DOUBLE,
+    STATUS VARCHAR,
+    ROWS_ADDED BIGINT,
+    BYTES_READ BIGINT,
+    BYTES_WRITTEN BIGINT,
+    PROFILE VARCHAR
+);
+
+CREATE TABLE IF NOT EXISTS AGG_STATION_HOURLY (
+    STATION_ID INTEGER NOT NULL,
+    HOUR TIMESTAMP NOT NULL,
+    SUM_BICYCLE_AVAILABLE BIGINT,
+    NB_STATEMENTS BIGINT,
+    MIN_BICYCLE_AVAILABLE SMALLINT,
+    MAX_BICYCLE_AVAILABLE SMALLINT,
+    PRIMARY KEY (STATION_ID, HOUR)
+);
+
+CREATE TABLE IF NOT EXISTS AGG_STATION_DAILY (
+    STATION_ID INTEGER NOT NULL,
+    DAY DATE NOT NULL,
+    SUM_BICYCLE_AVAILABLE BIGINT,
+    NB_STATEMENTS BIGINT,
+    MIN_BICYCLE_AVAILABLE SMALLINT,
+    MAX_BICYCLE_AVAILABLE SMALLINT,
+    PRIMARY KEY (STATION_ID, DAY)
+);
+
+CREATE TABLE IF NOT EXISTS AGG_STATION (
+    STATION_ID INTEGER PRIMARY KEY,
+    SUM_BICYCLE_AVAILABLE BIGINT,
+    NB_STATEMENTS BIGINT,
+    UPDATED_AT TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS AGG_CITY_LATEST (
+    CITY_ID INTEGER PRIMARY KEY,
+    CREATED_DATE DATE,
+    NB_STATIONS INTEGER,
+    SUM_BICYCLE_DOCKS_AVAILABLE BIGINT,
+    SUM_BICYCLE_AVAILABLE BIGINT,
+    UPDATED_AT TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS AGG_STATION_LATEST (
+    STATION_ID INTEGER PRIMARY KEY,
+    CREATED_DATE DATE,
+    BICYCLE_DOCKS_AVAILABLE SMALLINT,
+    BICYCLE_AVAILABLE SMALLINT,
+    LAST_STATEMENT_DATE TIMESTAMP,
+    UPDATED_AT TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS DIM_STATION_GRID (
+    STATION_ID INTEGER PRIMARY KEY,
+    CELL_X INTEGER NOT NULL,
+    CELL_Y INTEGER NOT NULL,
+    LONGITUDE FLOAT,
+    LATITUDE FLOAT
+);
@@ -1,5 +1,22 @@
+CREATE TYPE IF NOT EXISTS STATION_STATUS AS ENUM ('OUI', 'NON');
+
+-- Integer surrogate keys of the stations ('<city code>-<station code>') and cities
+-- (INSEE code), joined on instead of the natural keys
+CREATE SEQUENCE IF NOT EXISTS STATION_KEY_SEQUENCE;
+CREATE SEQUENCE IF NOT EXISTS CITY_KEY_SEQUENCE;
+
+CREATE TABLE IF NOT EXISTS STATION_KEY (
+    NATURAL_ID VARCHAR PRIMARY KEY,
+    ID INTEGER NOT NULL UNIQUE DEFAULT nextval('STATION_KEY_SEQUENCE')
+);
+
+CREATE TABLE IF NOT EXISTS CITY_KEY (
+    NATURAL_ID VARCHAR PRIMARY KEY,
+    ID INTEGER NOT NULL UNIQUE DEFAULT nextval('CITY_KEY_SEQUENCE')
+);
+
 CREATE TABLE IF NOT EXISTS CONSOLIDATE_STATION  (
-    ID VARCHAR NOT NULL,
+    ID INTEGER NOT NULL,
     CODE VARCHAR NOT NULL,
     NAME VARCHAR,
     CITY_NAME VARCHAR,
@@ -7,25 +24,60 @@ CREATE TABLE IF NOT EXISTS CONSOLIDATE_STATION  (
     ADDRESS VARCHAR,
     LONGITUDE FLOAT,
     LATITUDE FLOAT,
-    STATUS VARCHAR,
+    STATUS STATION_STATUS,
     CREATED_DATE DATE,
-    CAPACITTY INTEGER,
+    CAPACITTY SMALLINT,
+    ROW_HASH UBIGINT,
+    VALID_TO DATE,
     PRIMARY KEY (ID, CREATED_DATE)
 );
 
 CREATE TABLE IF NOT EXISTS CONSOLIDATE_CITY (
-    ID VARCHAR,
+    ID INTEGER,
     NAME VARCHAR,
     NB_INHABITANTS INTEGER,
-    CREATED_DATE VARCHAR,
+    CREATED_DATE DATE,
+    ROW_HASH UBIGINT,
+    VALID_TO DATE,
     PRIMARY KEY (ID, CREATED_DATE)
 );
 
 CREATE TABLE IF NOT EXISTS CONSOLIDATE_STATION_STATEMENT (
-    STATION_ID VARCHAR NOT NULL,
-    BICYCLE_DOCKS_AVAILABLE INTEGER,
-    BICYCLE_AVAILABLE INTEGER,
-    LAST_STATEMENT_DATE DATE,
-    CREATED_DATE VARCHAR,
+    STATION_ID INTEGER NOT NULL,
+    BICYCLE_DOCKS_AVAILABLE SMALLINT,
+    BICYCLE_AVAILABLE SMALLINT,
+    LAST_STATEMENT_DATE TIMESTAMP,
+    CREATED_DATE DATE,
+    LOADED_AT TIMESTAMP,
+    LOAD_BATCH BIGINT,
     PRIMARY KEY (STATION_ID, CREATED_DATE)
 );
+
+-- Each load of station statements is a batch, registered in LOAD_BATCH in the same
+-- transaction and removed once merged into FACT_STATION_STATEMENT, so a batch
+-- committed late is still merged by the next aggregation
+CREATE SEQUENCE IF NOT EXISTS LOAD_BATCH_SEQUENCE;
+
+CREATE TABLE IF NOT EXISTS LOAD_BATCH (
+    ID BIGINT PRIMARY KEY,
+    FEED_FORMAT VARCHAR,
+    LOADED_AT TIMESTAMP
+);
+
+-- Polling mode: latest status of each station, and the log of every change seen
+-- by the polls
+CREATE TABLE IF NOT EXISTS STATION_STATUS_LATEST (
+    STATION_ID INTEGER PRIMARY KEY,
+    BICYCLE_DOCKS_AVAILABLE SMALLINT,
+    BICYCLE_AVAILABLE SMALLINT,
+    LAST_STATEMENT_DATE TIMESTAMP,
+    POLLED_AT TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS STATION_STATUS_CHANGE (
+    STATION_ID INTEGER NOT NULL,
+    BICYCLE_DOCKS_AVAILABLE SMALLINT,
+    BICYCLE_AVAILABLE SMALLINT,
+    LAST_STATEMENT_DATE TIMESTAMP,
+    POLLED_AT TIMESTAMP NOT NULL
+);
@@ -0,0 +1,155 @@
+-- Moves the consolidated tables to compact types and integer surrogate keys:
+-- DATE and TIMESTAMP dates, a STATION_STATUS enum, SMALLINT counts, and the
+-- STATION_KEY / CITY_KEY maps replacing the '<city code>-<station code>' and
+-- INSEE code identifiers. The star schema tables are derived from the consolidated
+-- ones: they are dropped here, created again with the new types and rebuilt by
+-- the next aggregation.
+
+-- Columns added before versioned migrations, missing from the oldest databases
+ALTER TABLE CONSOLIDATE_STATION_STATEMENT ADD COLUMN IF NOT EXISTS LOADED_AT TIMESTAMP;
+ALTER TABLE CONSOLIDATE_STATION ADD COLUMN IF NOT EXISTS ROW_HASH UBIGINT;
+ALTER TABLE CONSOLIDATE_STATION ADD COLUMN IF NOT EXISTS VALID_TO DATE;
+ALTER TABLE CONSOLIDATE_CITY ADD COLUMN IF NOT EXISTS ROW_HASH UBIGINT;
+ALTER TABLE CONSOLIDATE_CITY ADD COLUMN IF NOT EXISTS VALID_TO DATE;
+
+CREATE TYPE STATION_STATUS AS ENUM ('OUI', 'NON');
+
+CREATE SEQUENCE STATION_KEY_SEQUENCE;
+CREATE SEQUENCE CITY_KEY_SEQUENCE;
+
+CREATE TABLE STATION_KEY (
+    NATURAL_ID VARCHAR PRIMARY KEY,
+    ID INTEGER NOT NULL UNIQUE DEFAULT nextval('STATION_KEY_SEQUENCE')
+);
+
+CREATE TABLE CITY_KEY (
+    NATURAL_ID VARCHAR PRIMARY KEY,
+    ID INTEGER NOT NULL UNIQUE DEFAULT nextval('CITY_KEY_SEQUENCE')
+);
+
+INSERT INTO STATION_KEY (NATURAL_ID)
+SELECT ID FROM CONSOLIDATE_STATION
+UNION
+SELECT STATION_ID FROM CONSOLIDATE_STATION_STATEMENT
+ORDER BY 1;
+
+INSERT INTO CITY_KEY (NATURAL_ID)
+SELECT DISTINCT ID FROM CONSOLIDATE_CITY WHERE ID IS NOT NULL
+ORDER BY 1;
+
+-- Star schema tables, rebuilt from the consolidated tables by the next aggregation
+DROP TABLE IF EXISTS FACT_STATION_STATEMENT;
+DROP TABLE IF EXISTS DIM_STATION;
+DROP TABLE IF EXISTS DIM_CITY;
+DROP TABLE IF EXISTS DIM_STATION_GRID;
+DROP TABLE IF EXISTS AGG_STATION_HOURLY;
+DROP TABLE IF EXISTS AGG_STATION_DAILY;
+DROP TABLE IF EXISTS AGG_STATION;
+DROP TABLE IF EXISTS AGG_CITY_LATEST;
+DROP TABLE IF EXISTS ETL_WATERMARK;
+
+-- Consolidated tables are copied aside, then reloaded with the new types
+CREATE TABLE CONSOLIDATE_STATION_V0 AS SELECT * FROM CONSOLIDATE_STATION;
+DROP TABLE CONSOLIDATE_STATION;
+
+CREATE TABLE CONSOLIDATE_STATION  (
+    ID INTEGER NOT NULL,
+    CODE VARCHAR NOT NULL,
+    NAME VARCHAR,
+    CITY_NAME VARCHAR,
+    CITY_CODE VARCHAR,
+    ADDRESS VARCHAR,
+    LONGITUDE FLOAT,
+    LATITUDE FLOAT,
+    STATUS STATION_STATUS,
+    CREATED_DATE DATE,
+    CAPACITTY SMALLINT,
+    ROW_HASH UBIGINT,
+    VALID_TO DATE,
+    PRIMARY KEY (ID, CREATED_DATE)
+);
+
+-- Statuses other than 'OUI' and 'NON' are left empty
+INSERT INTO CONSOLIDATE_STATION
+SELECT
+    k.ID,
+    s.CODE,
+    s.NAME,
+    s.CITY_NAME,
+    s.CITY_CODE,
+    s.ADDRESS,
+    s.LONGITUDE,
+    s.LATITUDE,
+    TRY_CAST(s.STATUS AS STATION_STATUS),
+    CAST(s.CREATED_DATE AS DATE),
+    s.CAPACITTY,
+    s.ROW_HASH,
+    s.VALID_TO
+FROM CONSOLIDATE_STATION_V0 s
+JOIN STATION_KEY k ON k.NATURAL_ID = s.ID;
+
+-- Hashes depend on the column types, rows not converted into versions yet keep
+-- no hash
+UPDATE CONSOLIDATE_STATION
+SET ROW_HASH = hash(CODE, NAME, CITY_NAME, CITY_CODE, ADDRESS, LONGITUDE, LATITUDE, STATUS, CAPACITTY)
+WHERE ROW_HASH IS NOT NULL;
+
+DROP TABLE CONSOLIDATE_STATION_V0;
+
+CREATE TABLE CONSOLIDATE_CITY_V0 AS SELECT * FROM CONSOLIDATE_CITY;
+DROP TABLE CONSOLIDATE_CITY;
+
+CREATE TABLE CONSOLIDATE_CITY (
+    ID INTEGER,
+    NAME VARCHAR,
+    NB_INHABITANTS INTEGER,
+    CREATED_DATE DATE,
+    ROW_HASH UBIGINT,
+    VALID_TO DATE,
+    PRIMARY KEY (ID, CREATED_DATE)
+);
+
+INSERT INTO CONSOLIDATE_CITY
+SELECT
+    k.ID,
+    c.NAME,
+    c.NB_INHABITANTS,
+    CAST(c.CREATED_DATE AS DATE),
+    c.ROW_HASH,
+    c.VALID_TO
+FROM CONSOLIDATE_CITY_V0 c
+JOIN CITY_KEY k ON k.NATURAL_ID = c.ID;
+
+UPDATE CONSOLIDATE_CITY
+SET ROW_HASH = hash(NAME, NB_INHABITANTS)
+WHERE ROW_HASH IS NOT NULL;
+
+DROP TABLE CONSOLIDATE_CITY_V0;
+
+CREATE TABLE CONSOLIDATE_STATION_STATEMENT_V0 AS SELECT * FROM CONSOLIDATE_STATION_STATEMENT;
+DROP TABLE CONSOLIDATE_STATION_STATEMENT;
+
+CREATE TABLE CONSOLIDATE_STATION_STATEMENT (
+    STATION_ID INTEGER NOT NULL,
+    BICYCLE_DOCKS_AVAILABLE SMALLINT,
+    BICYCLE_AVAILABLE SMALLINT,
+    LAST_STATEMENT_DATE TIMESTAMP,
+    CREATED_DATE DATE,
+    LOADED_AT TIMESTAMP,
+    PRIMARY KEY (STATION_ID, CREATED_DATE)
+);
+
+-- Rows are reloaded sorted by day, so the zone maps of CREATED_DATE skip row groups
+INSERT INTO CONSOLIDATE_STATION_STATEMENT
+SELECT
+    k.ID,
+    s.BICYCLE_DOCKS_AVAILABLE,
+    s.BICYCLE_AVAILABLE,
+    s.LAST_STATEMENT_DATE,
+    CAST(s.CREATED_DATE AS DATE),
+    s.LOADED_AT
+FROM CONSOLIDATE_STATION_STATEMENT_V0 s
+JOIN STATION_KEY k ON k.NATURAL_ID = s.STATION_ID
+ORDER BY CAST(s.CREATED_DATE AS DATE), k.ID;
+
+DROP TABLE CONSOLIDATE_STATION_STATEMENT_V0;
@@ -0,0 +1,22 @@
+-- Adds the city of each station to DIM_STATION, so the dashboard filters the
+-- stations of a city without reading the fact table. The table is created first
+-- for the databases never aggregated, then the column is filled from the current
+-- version of each station.
+CREATE TABLE IF NOT EXISTS DIM_STATION (
+    ID INTEGER PRIMARY KEY,
+    CODE VARCHAR,
+    NAME VARCHAR,
+    ADDRESS VARCHAR,
+    LONGITUDE FLOAT,
+    LATITUDE FLOAT,
+    STATUS STATION_STATUS,
+    CAPACITTY SMALLINT
+);
+
+ALTER TABLE DIM_STATION ADD COLUMN IF NOT EXISTS CITY_ID INTEGER;
+
+UPDATE DIM_STATION
+SET CITY_ID = k.ID
+FROM CONSOLIDATE_STATION s
+JOIN CITY_KEY k ON k.NATURAL_ID = s.CITY_CODE
+WHERE s.ID = DIM_STATION.ID AND s.VALID_TO IS NULL;
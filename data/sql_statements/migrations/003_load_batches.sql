@@ -0,0 +1,17 @@
+-- Replaces the LOADED_AT watermark of the fact aggregation by load batches: every
+-- load of station statements gets a batch id, queued in LOAD_BATCH until merged.
+-- The existing rows form batch 0, queued so the next aggregation merges the whole
+-- table once, including rows loaded after its last watermark.
+CREATE SEQUENCE IF NOT EXISTS LOAD_BATCH_SEQUENCE;
+
+CREATE TABLE IF NOT EXISTS LOAD_BATCH (
+    ID BIGINT PRIMARY KEY,
+    FEED_FORMAT VARCHAR,
+    LOADED_AT TIMESTAMP
+);
+
+ALTER TABLE CONSOLIDATE_STATION_STATEMENT ADD COLUMN IF NOT EXISTS LOAD_BATCH BIGINT;
+
+UPDATE CONSOLIDATE_STATION_STATEMENT SET LOAD_BATCH = 0;
+
+INSERT INTO LOAD_BATCH VALUES (0, NULL, CURRENT_TIMESTAMP);
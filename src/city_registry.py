@@ -0,0 +1,155 @@
+from functools import cache
+import os
+import re
+import tomllib
+import unicodedata
+
+# Bike-sharing networks fetched and consolidated by the ETL, overridable with the
+# CITY_REGISTRY_FILE environment variable. Resolved from the project directory, not
+# the working directory, so the modules can be imported from anywhere.
+DEFAULT_CITY_REGISTRY_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "cities.toml"
+)
+
+# Feeds of each format. Cities of the same format are staged and consolidated
+# together, by one query per format.
+FEED_FORMATS = {
+    "opendatasoft": ["realtime"],
+    "jcdecaux": ["realtime"],
+    "gbfs": ["station_status", "station_information"],
+}
+# Formats whose feeds give the commune of each station
+FORMATS_WITH_COMMUNES = {"opendatasoft"}
+
+DEFAULT_READ_TIMEOUT = 60
+
+
+def city_slug(name):
+    """
+    Returns the lowercase ASCII name of a city, used in its raw file names and
+    task names.
+
+    Args:
+        name (str): The city name.
+    """
+    ascii_name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode()
+    return re.sub(r"[^a-z0-9]+", "_", ascii_name.lower()).strip("_")
+
+
+def feed_file_name(name, feed):
+    """
+    Returns the raw file name of a feed of a city.
+
+    Args:
+        name (str): The city name.
+        feed (str): The feed, from FEED_FORMATS.
+    """
+    if feed == "realtime":
+        return f"{city_slug(name)}_realtime_bicycle_data.json"
+
+    return f"{city_slug(name)}_realtime_bicycle_{feed}_data.json"
+
+
+def load_city_registry(path=DEFAULT_CITY_REGISTRY_FILE):
+    """
+    Reads and validates the city registry.
+
+    Args:
+        path (str): The registry file.
+
+    Returns:
+        list[dict]: The cities, in registry order, each with its "feeds": the
+            (url, file_name) of each feed of its format.
+    """
+    with open(path, "rb") as fd:
+        entries = tomllib.load(fd).get("city", [])
+
+    cities = []
+    for entry in entries:
+        name, feed_format = entry["name"], entry["format"]
+        if feed_format not in FEED_FORMATS:
+            raise ValueError(f"{name}: unknown feed format {feed_format!r}")
+        if feed_format not in FORMATS_WITH_COMMUNES and "insee_code" not in entry:
+            raise ValueError(f"{name}: insee_code is required for the {feed_format} format")
+
+        cities.append({
+            "name": name,
+            "key": int(entry["key"]),
+            "format": feed_format,
+            "insee_code": entry.get("insee_code"),
+            "read_timeout": entry.get("read_timeout", DEFAULT_READ_TIMEOUT),
+            "feeds": {
+                feed: (entry["url" if feed == "realtime" else f"{feed}_url"], feed_file_name(name, feed))
+                for feed in FEED_FORMATS[feed_format]
+            },
+        })
+
+    for field in ("name", "key"):
+        values = [city[field] for city in cities]
+        duplicates = {value for value in values if values.count(value) > 1}
+        if duplicates:
+            raise ValueError(f"Duplicate city {field} in {path}: {sorted(duplicates)}")
+
+    return cities
+
+
+@cache
+def get_city_registry():
+    """
+    Returns the cities of the registry, read on first use from CITY_REGISTRY_FILE
+    or the registry of the project.
+
+    Returns:
+        list[dict]: The cities, see `load_city_registry`.
+    """
+    return load_city_registry(os.environ.get("CITY_REGISTRY_FILE", DEFAULT_CITY_REGISTRY_FILE))
+
+
+def get_cities():
+    """
+    Returns the names of the cities of the registry.
+    """
+    return [city["name"] for city in get_city_registry()]
+
+
+def city_sources(name):
+    """
+    Returns the raw source file names of a city.
+
+    Args:
+        name (str): The city name.
+    """
+    for city in get_city_registry():
+        if city["name"] == name:
+            return [file_name for _, file_name in city["feeds"].values()]
+
+    raise ValueError(f"Unknown city: {name}")
+
+
+def cities_of_format(feed_format, cities=None):
+    """
+    Returns the registry entries of the cities of a feed format.
+
+    Args:
+        feed_format (str): The feed format.
+        cities (list[str] | None): Only these cities, all of them if None.
+    """
+    return [
+        city
+        for city in get_city_registry()
+        if city["format"] == feed_format and (cities is None or city["name"] in cities)
+    ]
+
+
+def city_of_source(file_name):
+    """
+    Returns the registry entry of the city a raw source file belongs to.
+
+    Args:
+        file_name (str): The raw source file name.
+    """
+    for city in get_city_registry():
+        if file_name in city_sources(city["name"]):
+            return city
+
+    raise ValueError(f"Unknown source: {file_name}")
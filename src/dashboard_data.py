@@ -0,0 +1,413 @@
+from contextlib import contextmanager
+import math
+import os
+import time
+
+import duckdb
+import streamlit as st
+
+from database import DATABASE_PATH, published_database_path
+from spatial_index import find_nearest_stations
+
+# Published databases kept open, the current run and the previous one while the
+# sessions switch over
+PUBLISHED_CONNECTIONS = 2
+
+
+@st.cache_resource(max_entries=PUBLISHED_CONNECTIONS, show_spinner=False)
+def get_published_connection(run_id):
+    """
+    Returns a read-only connection to the database published by an ETL run, opened
+    once and shared by every dashboard session. Published files are never written
+    again, so they can stay open; each query runs on its own cursor of it.
+
+    Args:
+        run_id (str): The ETL run.
+    """
+    return duckdb.connect(published_database_path(run_id), read_only=True)
+
+
+def connect_etl_database(retries=20, wait_seconds=0.5):
+    """
+    Opens the ETL database read-only, retrying for a few seconds while the refresher
+    holds the write lock. The connection must be closed once the query ran: DuckDB
+    refuses the refresher its write lock while any other process keeps the file
+    open, even read-only, and a connection kept open would go on reading the file
+    replaced by a database compaction.
+
+    Args:
+        retries (int): Number of attempts to open the database.
+        wait_seconds (float): Delay between two attempts.
+    """
+    for attempt in range(retries):
+        try:
+            return duckdb.connect(DATABASE_PATH, read_only=True)
+        except duckdb.IOException:
+            if attempt == retries - 1:
+                raise
+            time.sleep(wait_seconds)
+
+
+@contextmanager
+def run_database(run_id=None):
+    """
+    Gives a connection to the database published by an ETL run for the duration of
+    the block, a cursor of its shared connection, so sessions query it side by
+    side. Without a published file (publish mode disabled), the ETL database is
+    opened for the block only.
+
+    Args:
+        run_id (str | None): The ETL run whose published database is read.
+
+    Yields:
+        duckdb.DuckDBPyConnection: The connection.
+    """
+    if run_id and os.path.exists(published_database_path(run_id)):
+        con = get_published_connection(run_id).cursor()
+    else:
+        con = connect_etl_database()
+
+    try:
+        yield con
+    finally:
+        con.close()
+
+
+def fetch_arrow(run_id, query, params=None):
+    """
+    Runs a query against the database of an ETL run and returns the result as an
+    Arrow table, without going through pandas.
+
+    Args:
+        run_id (str): The ETL run whose published database is read.
+        query (str): The SQL query.
+        params (list | dict | None): The query parameters.
+
+    Returns:
+        pyarrow.Table: The query result.
+    """
+    with run_database(run_id) as con:
+        return con.execute(query, params).fetch_arrow_table()
+
+
+# Results are cached as resources keyed on the ETL run id and the query parameters:
+# Arrow tables are immutable, so every session gets the same table without a copy,
+# and entries of previous runs are evicted as new ones come in.
+CACHE_MAX_ENTRIES = 64
+
+# Station map: stations are drawn one by one from DETAIL_ZOOM on and binned into
+# grid cells of GRID_CELL_PX pixels below it, never more than MAX_MAP_POINTS markers
+MAP_WIDTH_PX = 1000
+MAP_HEIGHT_PX = 600
+DETAIL_ZOOM = 14
+GRID_CELL_PX = 40
+MAX_MAP_POINTS = 2000
+
+# Filters shared by the station queries. Parameters left to NULL disable their
+# filter, so each query stays a single prepared statement whatever the selection.
+STATION_FILTER = """
+    ($status IS NULL OR s.STATUS = $status)
+    AND ($city_id IS NULL OR s.CITY_ID = $city_id)
+"""
+
+
+@st.cache_resource(max_entries=1, show_spinner=False)
+def get_cities(run_id):
+    """
+    Returns the cities that have stations, for the city selector.
+
+    Args:
+        run_id (str): The ETL run the data comes from, used as cache key.
+    """
+    return fetch_arrow(run_id, """
+    SELECT dm.ID, dm.NAME
+    FROM DIM_CITY dm
+    INNER JOIN AGG_CITY_LATEST a ON dm.ID = a.CITY_ID
+    ORDER BY dm.NAME;
+    """)
+
+
+@st.cache_resource(max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def get_station_count(run_id, status=None, city_id=None):
+    """
+    Returns the number of stations matching the filters.
+
+    Args:
+        run_id (str): The ETL run the data comes from, used as cache key.
+        status (str | None): Only keep stations with this status.
+        city_id (int | None): Only keep stations of this city.
+    """
+    return fetch_arrow(run_id, f"""
+    SELECT count(*) AS nb_stations
+    FROM DIM_STATION s
+    WHERE {STATION_FILTER};
+    """, {"status": status, "city_id": city_id})["nb_stations"][0].as_py()
+
+
+@st.cache_resource(max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def get_map_center(run_id, city_id=None):
+    """
+    Returns the center of the stations of a city, or of France when no city is selected.
+
+    Args:
+        run_id (str): The ETL run the data comes from, used as cache key.
+        city_id (int | None): The selected city.
+
+    Returns:
+        dict: The "lat" and "lon" of the center.
+    """
+    if city_id is None:
+        return {"lat": 46.5, "lon": 2.5}
+
+    center = fetch_arrow(run_id, f"""
+    SELECT avg(s.LATITUDE) AS lat, avg(s.LONGITUDE) AS lon
+    FROM DIM_STATION s
+    WHERE {STATION_FILTER};
+    """, {"status": None, "city_id": city_id}).to_pylist()[0]
+    return center if center["lat"] is not None else {"lat": 46.5, "lon": 2.5}
+
+
+def viewport_bounds(center, zoom, width_px=MAP_WIDTH_PX, height_px=MAP_HEIGHT_PX):
+    """
+    Returns the area shown by a web mercator map of the given size.
+
+    Args:
+        center (dict): The "lat" and "lon" of the map center.
+        zoom (int): The map zoom level.
+        width_px (int): The map width in pixels.
+        height_px (int): The map height in pixels.
+
+    Returns:
+        tuple: The (min_lon, min_lat, max_lon, max_lat) bounds.
+    """
+    degrees_per_px = 360 / (256 * 2 ** zoom)
+    half_width = width_px / 2 * degrees_per_px
+    half_height = height_px / 2 * degrees_per_px * math.cos(math.radians(center["lat"]))
+    return (
+        center["lon"] - half_width,
+        center["lat"] - half_height,
+        center["lon"] + half_width,
+        center["lat"] + half_height,
+    )
+
+
+@st.cache_resource(max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def get_map_points(run_id, zoom, bounds, status=None, city_id=None):
+    """
+    Returns what the station map draws in the given viewport: individual stations
+    from DETAIL_ZOOM on, clusters of stations binned on a grid sized to the zoom
+    level below it. Either way at most MAX_MAP_POINTS rows are returned, whatever
+    the number of stations.
+
+    Args:
+        run_id (str): The ETL run the data comes from, used as cache key.
+        zoom (int): The map zoom level.
+        bounds (tuple): The (min_lon, min_lat, max_lon, max_lat) viewport bounds.
+        status (str | None): Only keep stations with this status.
+        city_id (int | None): Only keep stations of this city.
+    """
+    min_lon, min_lat, max_lon, max_lat = bounds
+    params = {
+        "status": status,
+        "city_id": city_id,
+        "min_lon": min_lon,
+        "min_lat": min_lat,
+        "max_lon": max_lon,
+        "max_lat": max_lat,
+        "max_points": MAX_MAP_POINTS,
+    }
+    viewport_filter = """
+        s.LONGITUDE BETWEEN $min_lon AND $max_lon
+        AND s.LATITUDE BETWEEN $min_lat AND $max_lat
+    """
+
+    if zoom >= DETAIL_ZOOM:
+        return fetch_arrow(run_id, f"""
+        SELECT
+            s.NAME AS label,
+            s.ADDRESS AS address,
+            s.LONGITUDE AS longitude,
+            s.LATITUDE AS latitude,
+            1 AS nb_stations,
+            s.CAPACITTY AS capacity
+        FROM DIM_STATION s
+        WHERE {STATION_FILTER}
+        AND {viewport_filter}
+        ORDER BY s.CAPACITTY DESC
+        LIMIT $max_points;
+        """, params)
+
+    # Cell side in degrees, so that a cell covers GRID_CELL_PX pixels at this zoom
+    params["cell_size"] = 360 / (256 * 2 ** zoom) * GRID_CELL_PX
+    return fetch_arrow(run_id, f"""
+    SELECT
+        CASE WHEN count(*) = 1 THEN any_value(s.NAME) ELSE count(*) || ' stations' END AS label,
+        CASE WHEN count(*) = 1 THEN any_value(s.ADDRESS) END AS address,
+        avg(s.LONGITUDE) AS longitude,
+        avg(s.LATITUDE) AS latitude,
+        count(*) AS nb_stations,
+        coalesce(sum(s.CAPACITTY), 0)::BIGINT AS capacity
+    FROM DIM_STATION s
+    WHERE {STATION_FILTER}
+    AND {viewport_filter}
+    GROUP BY floor(s.LONGITUDE / $cell_size), floor(s.LATITUDE / $cell_size)
+    ORDER BY nb_stations DESC
+    LIMIT $max_points;
+    """, params)
+
+
+@st.cache_resource(max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def get_nearest_stations(run_id, longitude, latitude, k=5, min_bicycles=1):
+    """
+    Returns the `k` stations nearest to a location with bikes available.
+
+    Args:
+        run_id (str): The ETL run the data comes from, used as cache key.
+        longitude (float): Longitude of the location.
+        latitude (float): Latitude of the location.
+        k (int): Number of stations to return.
+        min_bicycles (int): Minimum number of bikes available.
+    """
+    with run_database(run_id) as con:
+        return find_nearest_stations(con, longitude, latitude, k, min_bicycles)
+
+
+@st.cache_resource(max_entries=1, show_spinner=False)
+def get_docks_by_city(run_id):
+    """
+    Returns the available docks of the main cities on their latest day.
+
+    Args:
+        run_id (str): The ETL run the data comes from, used as cache key.
+    """
+    # Rollup maintained by the ETL, one row per city
+    return fetch_arrow(run_id, """
+    SELECT dm.NAME, a.SUM_BICYCLE_DOCKS_AVAILABLE
+    FROM DIM_CITY dm
+    INNER JOIN AGG_CITY_LATEST a ON dm.ID = a.CITY_ID
+    WHERE lower(dm.NAME) in ('paris', 'nantes', 'vincennes', 'toulouse', 'montpellier')
+    ORDER BY a.SUM_BICYCLE_DOCKS_AVAILABLE DESC;
+    """)
+
+
+# Average number of bikes available at each station over its history,
+# from the rollup maintained by the ETL
+AVG_BIKES_PER_STATION = f"""
+    SELECT
+        s.NAME,
+        s.CODE,
+        s.ADDRESS,
+        a.SUM_BICYCLE_AVAILABLE / a.NB_STATEMENTS AS avg_dock_available
+    FROM DIM_STATION s
+    JOIN AGG_STATION a ON s.ID = a.STATION_ID
+    WHERE a.NB_STATEMENTS > 0
+    AND {STATION_FILTER}
+"""
+
+
+@st.cache_resource(max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def get_top_stations(run_id, limit=10, city_id=None):
+    """
+    Returns the stations with the most bikes available on average.
+
+    Args:
+        run_id (str): The ETL run the data comes from, used as cache key.
+        limit (int): Number of stations to return.
+        city_id (int | None): Only keep stations of this city.
+    """
+    return fetch_arrow(run_id, f"""
+    {AVG_BIKES_PER_STATION}
+    ORDER BY avg_dock_available DESC
+    LIMIT $limit;
+    """, {"status": None, "city_id": city_id, "limit": limit})
+
+
+@st.cache_resource(max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def get_station_summary(run_id, city_id=None):
+    """
+    Returns the number of stations and their overall average of bikes available.
+
+    Args:
+        run_id (str): The ETL run the data comes from, used as cache key.
+        city_id (int | None): Only keep stations of this city.
+    """
+    return fetch_arrow(run_id, f"""
+    SELECT
+        count(*) AS nb_stations,
+        coalesce(round(avg(avg_dock_available), 2), 0) AS avg_dock_available
+    FROM ({AVG_BIKES_PER_STATION});
+    """, {"status": None, "city_id": city_id})
+
+
+@st.cache_resource(max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def get_avg_bikes_histogram(run_id, bins=30, city_id=None):
+    """
+    Returns the distribution of the average bikes available per station, binned
+    by DuckDB into `bins` buckets of equal width.
+
+    Args:
+        run_id (str): The ETL run the data comes from, used as cache key.
+        bins (int): Number of buckets.
+        city_id (int | None): Only keep stations of this city.
+    """
+    return fetch_arrow(run_id, f"""
+    WITH station_avg AS ({AVG_BIKES_PER_STATION}),
+    bounds AS (
+        SELECT
+            min(avg_dock_available) AS low,
+            greatest(max(avg_dock_available) - min(avg_dock_available), 1e-9) / $bins AS width
+        FROM station_avg
+    ),
+    binned AS (
+        SELECT least(floor((avg_dock_available - low) / width), $bins - 1) AS bin, low, width
+        FROM station_avg, bounds
+    )
+    SELECT
+        low + bin * width AS bin_start,
+        low + (bin + 1) * width AS bin_end,
+        count(*) AS nb_stations
+    FROM binned
+    GROUP BY ALL
+    ORDER BY bin_start;
+    """, {"status": None, "city_id": city_id, "bins": bins})
+
+
+@st.cache_resource(max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def get_stage_timings(run_id, kind="task", nb_runs=50):
+    """
+    Returns the wall time of the stages of the last ETL runs, from the metrics
+    recorded by the pipeline.
+
+    Args:
+        run_id (str): The ETL run the data comes from, used as cache key.
+        kind (str): 'task' for the pipeline tasks, 'fetch' for the sources fetched.
+        nb_runs (int): Number of runs.
+    """
+    return fetch_arrow(run_id, """
+    SELECT RUN_AT, STAGE, DURATION_SECONDS, ROWS_ADDED, BYTES_READ, BYTES_WRITTEN, STATUS
+    FROM ETL_RUN_METRICS
+    WHERE KIND = $kind
+    AND RUN_AT IN (
+        SELECT DISTINCT RUN_AT FROM ETL_RUN_METRICS ORDER BY RUN_AT DESC LIMIT $nb_runs
+    )
+    ORDER BY RUN_AT, STAGE;
+    """, {"kind": kind, "nb_runs": nb_runs})
+
+
+@st.cache_resource(max_entries=1, show_spinner=False)
+def get_slowest_functions(run_id, limit=15):
+    """
+    Returns the slowest instrumented functions of the last ETL run.
+
+    Args:
+        run_id (str): The ETL run the data comes from, used as cache key.
+        limit (int): Number of functions.
+    """
+    return fetch_arrow(run_id, """
+    SELECT TASK, STAGE, DURATION_SECONDS, STATUS, BYTES_READ, BYTES_WRITTEN
+    FROM ETL_RUN_METRICS
+    WHERE KIND = 'function'
+    AND RUN_AT = (SELECT max(RUN_AT) FROM ETL_RUN_METRICS)
+    ORDER BY DURATION_SECONDS DESC
+    LIMIT $limit;
+    """, {"limit": limit})
@@ -1,74 +1,469 @@
-import duckdb
+import logging
 
+from data_consolidation import SNAPSHOT_DIRECTORY
+from data_ingestion import SNAPSHOT_MODE
+from database import transaction
+from etl_metrics import instrumented
+from spatial_index import build_station_grid
 
-def create_agregate_tables():
-    con = duckdb.connect(
-        database="data/duckdb/mobility_analysis.duckdb", read_only=False
-    )
+
+@instrumented
+def create_agregate_tables(con):
     with open("data/sql_statements/create_agregate_tables.sql") as fd:
         statements = fd.read()
         for statement in statements.split(";"):
-            print(statement)
+            logging.debug(statement)
             con.execute(statement)
 
 
-def agregate_dim_station():
-    con = duckdb.connect(
-        database="data/duckdb/mobility_analysis.duckdb", read_only=False
-    )
-
+@instrumented
+def agregate_dim_station(con):
     sql_statement = """
     INSERT OR REPLACE INTO DIM_STATION
     SELECT 
-        ID,
-        CODE,
-        NAME,
-        ADDRESS,
-        LONGITUDE,
-        LATITUDE,
-        STATUS,
-        CAPACITTY
-    FROM CONSOLIDATE_STATION
-    WHERE CREATED_DATE = (SELECT MAX(CREATED_DATE) FROM CONSOLIDATE_STATION);
+        s.ID,
+        s.CODE,
+        s.NAME,
+        s.ADDRESS,
+        s.LONGITUDE,
+        s.LATITUDE,
+        s.STATUS,
+        s.CAPACITTY,
+        k.ID AS CITY_ID
+    FROM CONSOLIDATE_STATION s
+    -- Same identifier as DIM_CITY, empty for the stations of an unknown city
+    LEFT JOIN CITY_KEY k ON k.NATURAL_ID = s.CITY_CODE
+    -- Current version of each station
+    WHERE s.VALID_TO IS NULL;
     """
 
     con.execute(sql_statement)
 
 
-def agregate_dim_city():
-    con = duckdb.connect(
-        database="data/duckdb/mobility_analysis.duckdb", read_only=False
-    )
-
+@instrumented
+def agregate_dim_city(con):
     sql_statement = """
     INSERT OR REPLACE INTO DIM_CITY
     SELECT 
-        ID,
-        NAME,
-        NB_INHABITANTS
-    FROM CONSOLIDATE_CITY
-    WHERE CREATED_DATE = (SELECT MAX(CREATED_DATE) FROM CONSOLIDATE_CITY);
+        c.ID,
+        k.NATURAL_ID AS CODE,
+        c.NAME,
+        c.NB_INHABITANTS
+    FROM CONSOLIDATE_CITY c
+    JOIN CITY_KEY k ON k.ID = c.ID
+    -- Current version of each city
+    WHERE c.VALID_TO IS NULL;
     """
 
     con.execute(sql_statement)
 
 
-def agregate_fact_station_statements():
-    con = duckdb.connect(
-        database="data/duckdb/mobility_analysis.duckdb", read_only=False
+def get_watermark(con, table_name):
+    """
+    Returns the timestamp up to which a table's source rows were aggregated.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        table_name (str): The aggregated table.
+
+    Returns:
+        datetime | None: The watermark, None if the table was never aggregated.
+    """
+    row = con.execute(
+        "SELECT WATERMARK FROM ETL_WATERMARK WHERE TABLE_NAME = ?", [table_name]
+    ).fetchone()
+    return row[0] if row else None
+
+
+def set_watermark(con, table_name, watermark):
+    """
+    Records the timestamp up to which a table's source rows were aggregated.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        table_name (str): The aggregated table.
+        watermark (datetime): The new watermark.
+    """
+    con.execute(
+        """
+        INSERT OR REPLACE INTO ETL_WATERMARK
+        VALUES (?, ?, CURRENT_TIMESTAMP)
+        """,
+        [table_name, watermark],
     )
 
+
+@instrumented
+def agregate_fact_station_statements(con):
+    """
+    Incrementally aggregates the station statements into FACT_STATION_STATEMENT.
+    Only the consolidated rows of the load batches queued in LOAD_BATCH (every row
+    while the fact table is empty) are joined and merged, so the cost follows the
+    new data rather than the whole history. Merged batches are removed from the
+    queue; a batch committed after this run started stays queued for the next one,
+    whatever the order the loads were committed in. The merge is keyed on the fact
+    primary key, so reprocessed or late-arriving rows update their day in place.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+    """
+    load_batches = [row[0] for row in con.execute("SELECT ID FROM LOAD_BATCH").fetchall()]
+    first_run = con.execute("SELECT COUNT(*) FROM FACT_STATION_STATEMENT").fetchone()[0] == 0
+
     # First we agregate the cities station statement data
-    sql_statement = """
-    INSERT OR REPLACE INTO FACT_STATION_STATEMENT
-    SELECT STATION_ID, cc.ID as CITY_ID, BICYCLE_DOCKS_AVAILABLE, BICYCLE_AVAILABLE, LAST_STATEMENT_DATE, current_date as CREATED_DATE
-    FROM CONSOLIDATE_STATION_STATEMENT
-    JOIN CONSOLIDATE_STATION ON CONSOLIDATE_STATION.ID = CONSOLIDATE_STATION_STATEMENT.STATION_ID
-    LEFT JOIN CONSOLIDATE_CITY as cc ON cc.ID = CONSOLIDATE_STATION.CITY_CODE
-    WHERE CITY_CODE != 0 
-        AND CONSOLIDATE_STATION_STATEMENT.CREATED_DATE = (SELECT MAX(CREATED_DATE) FROM CONSOLIDATE_STATION_STATEMENT)
-        AND CONSOLIDATE_STATION.CREATED_DATE = (SELECT MAX(CREATED_DATE) FROM CONSOLIDATE_STATION)
-        AND cc.CREATED_DATE = (SELECT MAX(CREATED_DATE) FROM CONSOLIDATE_CITY);
+    con.execute(
+        f"""
+    CREATE OR REPLACE TEMP TABLE FACT_STATION_STATEMENT_DELTA AS
+    SELECT
+        css.STATION_ID,
+        dc.ID AS CITY_ID,
+        css.BICYCLE_DOCKS_AVAILABLE,
+        css.BICYCLE_AVAILABLE,
+        css.LAST_STATEMENT_DATE,
+        css.CREATED_DATE
+    FROM CONSOLIDATE_STATION_STATEMENT AS css
+    JOIN CONSOLIDATE_STATION AS cs
+    -- Current version of each station
+    ON cs.ID = css.STATION_ID AND cs.VALID_TO IS NULL
+    JOIN DIM_CITY AS dc ON dc.CODE = cs.CITY_CODE
+    WHERE cs.CITY_CODE IS NOT NULL
+        AND (
+            $first_run
+            -- Constant lower bound first, so the zone maps skip the merged batches
+            OR (
+                css.LOAD_BATCH >= {min(load_batches, default=0)}
+                AND css.LOAD_BATCH IN (SELECT UNNEST($load_batches::BIGINT[]))
+            )
+        );
+    """,
+        {"first_run": first_run, "load_batches": load_batches},
+    )
+
+    con.execute("""
+    MERGE INTO FACT_STATION_STATEMENT AS f
+    USING FACT_STATION_STATEMENT_DELTA AS d
+    ON f.STATION_ID = d.STATION_ID
+        AND f.CITY_ID = d.CITY_ID
+        AND f.CREATED_DATE = d.CREATED_DATE
+    WHEN MATCHED THEN UPDATE SET
+        BICYCLE_DOCKS_AVAILABLE = d.BICYCLE_DOCKS_AVAILABLE,
+        BICYCLE_AVAILABLE = d.BICYCLE_AVAILABLE,
+        LAST_STATEMENT_DATE = d.LAST_STATEMENT_DATE
+    WHEN NOT MATCHED THEN INSERT (
+        STATION_ID,
+        CITY_ID,
+        BICYCLE_DOCKS_AVAILABLE,
+        BICYCLE_AVAILABLE,
+        LAST_STATEMENT_DATE,
+        CREATED_DATE
+    ) VALUES (
+        d.STATION_ID,
+        d.CITY_ID,
+        d.BICYCLE_DOCKS_AVAILABLE,
+        d.BICYCLE_AVAILABLE,
+        d.LAST_STATEMENT_DATE,
+        d.CREATED_DATE
+    );
+    """)
+
+    con.execute(
+        "DELETE FROM LOAD_BATCH WHERE ID IN (SELECT UNNEST($load_batches::BIGINT[]))",
+        {"load_batches": load_batches},
+    )
+
+    logging.info(
+        f"FACT_STATION_STATEMENT: "
+        f"{con.execute('SELECT COUNT(*) FROM FACT_STATION_STATEMENT_DELTA').fetchone()[0]} "
+        f"rows merged from {len(load_batches)} load batches."
+    )
+
+
+@instrumented
+def agregate_station_hourly(con):
     """
+    Snapshot mode only: recomputes the AGG_STATION_HOURLY buckets of the hours that
+    received snapshots since the table's watermark, from the snapshot store. Only
+    the partitions from the watermark day onwards are scanned, and a touched hour is
+    always rebuilt from all its snapshots, so reprocessing it is harmless. The hour
+    of the watermark is rebuilt too: a resumed run writes the snapshots of its
+    failed formats with the timestamp of the run it resumes.
 
-    con.execute(sql_statement)
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+
+    Returns:
+        list[date]: The days whose hourly buckets were rebuilt.
+    """
+    watermark = get_watermark(con, "AGG_STATION_HOURLY")
+    # Constant partition filter, so DuckDB prunes the snapshot_date directories
+    partition_filter = (
+        f"snapshot_date >= DATE '{watermark:%Y-%m-%d}'" if watermark else "TRUE"
+    )
+    snapshots = f"""
+    read_parquet('{SNAPSHOT_DIRECTORY}/*/*.parquet', hive_partitioning = true)
+    WHERE {partition_filter}
+    """
+
+    con.execute(
+        f"""
+    CREATE OR REPLACE TEMP TABLE ROLLUP_HOURS AS
+    SELECT DISTINCT DATE_TRUNC('hour', snapshot_ts) AS HOUR
+    FROM {snapshots}
+        AND ($watermark::TIMESTAMP IS NULL OR snapshot_ts >= $watermark::TIMESTAMP);
+    """,
+        {"watermark": watermark},
+    )
+
+    con.execute("""
+    DELETE FROM AGG_STATION_HOURLY
+    WHERE HOUR IN (SELECT HOUR FROM ROLLUP_HOURS);
+    """)
+
+    con.execute(f"""
+    INSERT INTO AGG_STATION_HOURLY
+    SELECT
+        station_id,
+        DATE_TRUNC('hour', snapshot_ts) AS HOUR,
+        SUM(bicycle_available),
+        COUNT(*),
+        MIN(bicycle_available),
+        MAX(bicycle_available)
+    FROM {snapshots}
+        AND DATE_TRUNC('hour', snapshot_ts) IN (SELECT HOUR FROM ROLLUP_HOURS)
+    GROUP BY ALL;
+    """)
+
+    # Later snapshots of the last hour put it back in ROLLUP_HOURS on the next run,
+    # where it is rebuilt from all of its snapshots
+    new_watermark = con.execute(f"SELECT MAX(snapshot_ts) FROM {snapshots}").fetchone()[0]
+    if new_watermark is not None:
+        set_watermark(con, "AGG_STATION_HOURLY", new_watermark)
+
+    return [
+        row[0]
+        for row in con.execute(
+            "SELECT DISTINCT CAST(HOUR AS DATE) FROM ROLLUP_HOURS"
+        ).fetchall()
+    ]
+
+
+@instrumented
+def agregate_station_daily(con):
+    """
+    Recomputes the AGG_STATION_DAILY buckets of the days touched by this run and
+    applies the difference with their previous content to the per-station totals
+    of AGG_STATION, so neither rollup is rebuilt from the whole history.
+
+    In snapshot mode the days are rebuilt from AGG_STATION_HOURLY. Otherwise they are
+    rebuilt from FACT_STATION_STATEMENT for the days of FACT_STATION_STATEMENT_DELTA
+    (every fact day on the first run), so `agregate_fact_station_statements` must run
+    before, on the same connection.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+    """
+    if SNAPSHOT_MODE:
+        days = agregate_station_hourly(con)
+        con.execute(
+            """
+        CREATE OR REPLACE TEMP TABLE ROLLUP_DAILY AS
+        SELECT
+            STATION_ID,
+            CAST(HOUR AS DATE) AS DAY,
+            SUM(SUM_BICYCLE_AVAILABLE) AS SUM_BICYCLE_AVAILABLE,
+            SUM(NB_STATEMENTS) AS NB_STATEMENTS,
+            MIN(MIN_BICYCLE_AVAILABLE) AS MIN_BICYCLE_AVAILABLE,
+            MAX(MAX_BICYCLE_AVAILABLE) AS MAX_BICYCLE_AVAILABLE
+        FROM AGG_STATION_HOURLY
+        WHERE CAST(HOUR AS DATE) IN (SELECT UNNEST($days::DATE[]))
+        GROUP BY ALL;
+        """,
+            {"days": days},
+        )
+    else:
+        first_run = con.execute("SELECT COUNT(*) FROM AGG_STATION_DAILY").fetchone()[0] == 0
+        days_source = "FACT_STATION_STATEMENT" if first_run else "FACT_STATION_STATEMENT_DELTA"
+        con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE ROLLUP_DAILY AS
+        SELECT
+            STATION_ID,
+            CREATED_DATE AS DAY,
+            SUM(BICYCLE_AVAILABLE) AS SUM_BICYCLE_AVAILABLE,
+            COUNT(*) AS NB_STATEMENTS,
+            MIN(BICYCLE_AVAILABLE) AS MIN_BICYCLE_AVAILABLE,
+            MAX(BICYCLE_AVAILABLE) AS MAX_BICYCLE_AVAILABLE
+        FROM FACT_STATION_STATEMENT
+        WHERE CREATED_DATE IN (SELECT DISTINCT CREATED_DATE FROM {days_source})
+        GROUP BY ALL;
+        """)
+
+    con.execute("""
+    MERGE INTO AGG_STATION AS a
+    USING (
+        SELECT
+            COALESCE(n.STATION_ID, o.STATION_ID) AS STATION_ID,
+            SUM(COALESCE(n.SUM_BICYCLE_AVAILABLE, 0) - COALESCE(o.SUM_BICYCLE_AVAILABLE, 0)) AS SUM_DIFF,
+            SUM(COALESCE(n.NB_STATEMENTS, 0) - COALESCE(o.NB_STATEMENTS, 0)) AS NB_DIFF
+        FROM ROLLUP_DAILY AS n
+        FULL JOIN (
+            SELECT *
+            FROM AGG_STATION_DAILY
+            WHERE DAY IN (SELECT DISTINCT DAY FROM ROLLUP_DAILY)
+        ) AS o ON n.STATION_ID = o.STATION_ID AND n.DAY = o.DAY
+        GROUP BY 1
+    ) AS d
+    ON a.STATION_ID = d.STATION_ID
+    WHEN MATCHED THEN UPDATE SET
+        SUM_BICYCLE_AVAILABLE = a.SUM_BICYCLE_AVAILABLE + d.SUM_DIFF,
+        NB_STATEMENTS = a.NB_STATEMENTS + d.NB_DIFF,
+        UPDATED_AT = CURRENT_TIMESTAMP
+    WHEN NOT MATCHED THEN INSERT
+        VALUES (d.STATION_ID, d.SUM_DIFF, d.NB_DIFF, CURRENT_TIMESTAMP);
+    """)
+
+    con.execute("""
+    DELETE FROM AGG_STATION_DAILY
+    WHERE DAY IN (SELECT DISTINCT DAY FROM ROLLUP_DAILY);
+    """)
+    con.execute("INSERT INTO AGG_STATION_DAILY SELECT * FROM ROLLUP_DAILY;")
+
+
+@instrumented
+def agregate_city_latest(con):
+    """
+    Refreshes AGG_CITY_LATEST, the available docks and bikes of each city on its
+    latest day, for the cities of FACT_STATION_STATEMENT_DELTA. Late rows from an
+    older day never replace a more recent total.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+    """
+    con.execute("""
+    MERGE INTO AGG_CITY_LATEST AS a
+    USING (
+        SELECT
+            f.CITY_ID,
+            f.CREATED_DATE,
+            COUNT(*) AS NB_STATIONS,
+            SUM(f.BICYCLE_DOCKS_AVAILABLE) AS SUM_BICYCLE_DOCKS_AVAILABLE,
+            SUM(f.BICYCLE_AVAILABLE) AS SUM_BICYCLE_AVAILABLE
+        FROM FACT_STATION_STATEMENT AS f
+        JOIN (
+            SELECT CITY_ID, MAX(CREATED_DATE) AS CREATED_DATE
+            FROM FACT_STATION_STATEMENT_DELTA
+            GROUP BY CITY_ID
+        ) AS d ON f.CITY_ID = d.CITY_ID AND f.CREATED_DATE = d.CREATED_DATE
+        GROUP BY ALL
+    ) AS n
+    ON a.CITY_ID = n.CITY_ID
+    WHEN MATCHED AND n.CREATED_DATE >= a.CREATED_DATE THEN UPDATE SET
+        CREATED_DATE = n.CREATED_DATE,
+        NB_STATIONS = n.NB_STATIONS,
+        SUM_BICYCLE_DOCKS_AVAILABLE = n.SUM_BICYCLE_DOCKS_AVAILABLE,
+        SUM_BICYCLE_AVAILABLE = n.SUM_BICYCLE_AVAILABLE,
+        UPDATED_AT = CURRENT_TIMESTAMP
+    WHEN NOT MATCHED THEN INSERT VALUES (
+        n.CITY_ID,
+        n.CREATED_DATE,
+        n.NB_STATIONS,
+        n.SUM_BICYCLE_DOCKS_AVAILABLE,
+        n.SUM_BICYCLE_AVAILABLE,
+        CURRENT_TIMESTAMP
+    );
+    """)
+
+
+@instrumented
+def agregate_station_latest(con):
+    """
+    Refreshes AGG_STATION_LATEST, the latest statement of each station, for the
+    stations of FACT_STATION_STATEMENT_DELTA (every station on the first run).
+    Late rows from an older day never replace a more recent statement. In polling
+    mode, the last status change polled for a station replaces its statement when
+    it was reported later.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+    """
+    first_run = con.execute("SELECT COUNT(*) FROM AGG_STATION_LATEST").fetchone()[0] == 0
+    source = "FACT_STATION_STATEMENT" if first_run else "FACT_STATION_STATEMENT_DELTA"
+    con.execute(f"""
+    MERGE INTO AGG_STATION_LATEST AS a
+    USING (
+        SELECT
+            STATION_ID,
+            CREATED_DATE,
+            BICYCLE_DOCKS_AVAILABLE,
+            BICYCLE_AVAILABLE,
+            LAST_STATEMENT_DATE
+        FROM {source}
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY STATION_ID ORDER BY CREATED_DATE DESC) = 1
+    ) AS n
+    ON a.STATION_ID = n.STATION_ID
+    WHEN MATCHED AND n.CREATED_DATE >= a.CREATED_DATE THEN UPDATE SET
+        CREATED_DATE = n.CREATED_DATE,
+        BICYCLE_DOCKS_AVAILABLE = n.BICYCLE_DOCKS_AVAILABLE,
+        BICYCLE_AVAILABLE = n.BICYCLE_AVAILABLE,
+        LAST_STATEMENT_DATE = n.LAST_STATEMENT_DATE,
+        UPDATED_AT = CURRENT_TIMESTAMP
+    WHEN NOT MATCHED THEN INSERT VALUES (
+        n.STATION_ID,
+        n.CREATED_DATE,
+        n.BICYCLE_DOCKS_AVAILABLE,
+        n.BICYCLE_AVAILABLE,
+        n.LAST_STATEMENT_DATE,
+        CURRENT_TIMESTAMP
+    );
+    """)
+
+    con.execute("""
+    MERGE INTO AGG_STATION_LATEST AS a
+    USING (
+        SELECT
+            STATION_ID,
+            POLLED_AT::DATE AS CREATED_DATE,
+            BICYCLE_DOCKS_AVAILABLE,
+            BICYCLE_AVAILABLE,
+            LAST_STATEMENT_DATE
+        FROM STATION_STATUS_CHANGE
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY STATION_ID ORDER BY POLLED_AT DESC) = 1
+    ) AS n
+    ON a.STATION_ID = n.STATION_ID
+    WHEN MATCHED AND n.LAST_STATEMENT_DATE > COALESCE(a.LAST_STATEMENT_DATE, '-infinity') THEN UPDATE SET
+        CREATED_DATE = n.CREATED_DATE,
+        BICYCLE_DOCKS_AVAILABLE = n.BICYCLE_DOCKS_AVAILABLE,
+        BICYCLE_AVAILABLE = n.BICYCLE_AVAILABLE,
+        LAST_STATEMENT_DATE = n.LAST_STATEMENT_DATE,
+        UPDATED_AT = CURRENT_TIMESTAMP;
+    """)
+
+
+@instrumented
+def agregate_rollups(con):
+    """
+    Maintains the small rollup tables read by the dashboard. Runs after
+    `agregate_fact_station_statements`, in the same transaction.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+    """
+    agregate_station_daily(con)
+    agregate_city_latest(con)
+    agregate_station_latest(con)
+
+
+def agregate_data(con):
+    """
+    Builds the dimensions, the fact table and the rollups from the consolidated
+    tables, in a single transaction.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+    """
+    create_agregate_tables(con)
+    with transaction(con):
+        agregate_dim_city(con)
+        agregate_dim_station(con)
+        build_station_grid(con)
+        agregate_fact_station_statements(con)
+        agregate_rollups(con)
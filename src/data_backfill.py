@@ -0,0 +1,215 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+import argparse
+import logging
+import os
+import threading
+
+from city_registry import FEED_FORMATS, cities_of_format, city_sources
+from data_agregation import agregate_data
+from data_consolidation import (
+    consolidate_city_data,
+    consolidate_staged_format,
+    create_consolidate_tables,
+    list_raw_files,
+    stage_format_cities,
+)
+from database import connect, transaction
+
+# Number of chunks of days backfilled concurrently, each on its own cursor
+BACKFILL_WORKERS = int(os.environ.get("BACKFILL_WORKERS", os.cpu_count() or 1))
+# Days read and consolidated per transaction, bounds the size of the staged data
+BACKFILL_CHUNK_DAYS = int(os.environ.get("BACKFILL_CHUNK_DAYS", 31))
+
+
+def chunk_days(days, chunk_size=BACKFILL_CHUNK_DAYS):
+    """
+    Splits sorted days into consecutive chunks of at most `chunk_size` days.
+
+    Args:
+        days (list[date]): The days to split.
+        chunk_size (int): Maximum number of days per chunk.
+    """
+    return [days[i:i + chunk_size] for i in range(0, len(days), chunk_size)]
+
+
+def backfill_city_data(con, start_date, end_date):
+    """
+    Consolidates the commune data fetched between two days, oldest days first.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        start_date (date): First day of the backfill.
+        end_date (date): Last day of the backfill.
+    """
+    files = list_raw_files(con, "commune_data.json", start_date, end_date)
+
+    for days in chunk_days(sorted(files)):
+        with transaction(con):
+            consolidate_city_data(con, [path for day in days for path in files[day]])
+        logging.info(f"Cities backfilled from {days[0]} to {days[-1]}.")
+
+
+def format_chunks(con, feed_format, cities, start_date, end_date, chunk_size=BACKFILL_CHUNK_DAYS):
+    """
+    Lists the raw files of the cities of a feed format fetched between two days, by
+    chunks of days, oldest first.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        feed_format (str): The feed format.
+        cities (list[str]): The cities to backfill.
+        start_date (date): First day of the backfill.
+        end_date (date): Last day of the backfill.
+        chunk_size (int): Maximum number of days per chunk.
+
+    Returns:
+        list[tuple]: The days of each chunk, with its raw files by source file name.
+    """
+    files = {
+        file_name: list_raw_files(con, file_name, start_date, end_date)
+        for city in cities
+        for file_name in city_sources(city)
+    }
+    # The days for which the station statements of one of the cities were fetched,
+    # from the first feed of the format
+    statement_files = [
+        city["feeds"][FEED_FORMATS[feed_format][0]][1]
+        for city in cities_of_format(feed_format, cities)
+    ]
+    days = sorted(set().union(*(set(files[file_name]) for file_name in statement_files)))
+
+    return [
+        (
+            chunk,
+            {
+                file_name: [path for day in chunk for path in by_day.get(day, [])]
+                for file_name, by_day in files.items()
+            },
+        )
+        for chunk in chunk_days(days, chunk_size)
+    ]
+
+
+def backfill_chunk(con, feed_format, cities, raw_files, previous, consolidated):
+    """
+    Stages the raw files of a chunk of days of the cities of a feed format, then
+    consolidates their stations and station statements in a single transaction. The
+    staging runs concurrently with the other chunks, but the chunks of a format are
+    consolidated oldest first, once the previous one is: a past day only covers
+    itself in the station history until later days are loaded. A city whose files
+    cannot be read is left out of the chunk.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection, outside a transaction.
+        feed_format (str): The feed format.
+        cities (list[str]): The cities to backfill.
+        raw_files (dict): The raw files of the chunk, by source file name.
+        previous (threading.Event): Set once the previous chunk of the format is done.
+        consolidated (threading.Event): Set once this chunk is done, even if it failed.
+
+    Returns:
+        dict: The error of each city left out of the chunk.
+    """
+    try:
+        failed_cities = stage_format_cities(con, feed_format, cities, raw_files)
+        previous.wait()
+        with transaction(con):
+            consolidate_staged_format(con, feed_format, cities, failed_cities)
+        return failed_cities
+    finally:
+        previous.wait()
+        consolidated.set()
+
+
+def backfill(
+    start_date,
+    end_date,
+    cities=None,
+    max_workers=BACKFILL_WORKERS,
+    chunk_size=BACKFILL_CHUNK_DAYS,
+):
+    """
+    Reprocesses the raw data fetched between two days, then aggregates it once. The
+    days of each feed format are split into chunks, staged concurrently, each on
+    its own cursor with the cities of its format read together, and consolidated
+    in order within their format; a failing chunk does not stop the others.
+
+    Args:
+        start_date (date): First day of the backfill.
+        end_date (date): Last day of the backfill.
+        cities (list[str] | None): The cities to backfill, all of them if None.
+        max_workers (int): Number of chunks backfilled concurrently.
+        chunk_size (int): Maximum number of days per chunk.
+
+    Returns:
+        dict: The number of days backfilled for each city, or the last error it raised.
+    """
+
+    def run(feed_format, raw_files, previous, consolidated):
+        cursor = con.cursor()
+        try:
+            return backfill_chunk(
+                cursor, feed_format, formats[feed_format], raw_files, previous, consolidated
+            )
+        finally:
+            cursor.close()
+
+    formats = {
+        feed_format: [city["name"] for city in cities_of_format(feed_format, cities)]
+        for feed_format in FEED_FORMATS
+    }
+    formats = {feed_format: names for feed_format, names in formats.items() if names}
+
+    with connect() as con:
+        create_consolidate_tables(con)
+        backfill_city_data(con, start_date, end_date)
+
+        # Each chunk waits for the previous chunk of its format before consolidating
+        work = []
+        for feed_format, format_cities in formats.items():
+            previous = threading.Event()
+            previous.set()
+            chunks = format_chunks(con, feed_format, format_cities, start_date, end_date, chunk_size)
+            for index, (days, raw_files) in enumerate(chunks):
+                consolidated = threading.Event()
+                work.append((index, feed_format, days, raw_files, previous, consolidated))
+                previous = consolidated
+        # Oldest chunks first, so the previous chunk of a format is always running
+        # before the one waiting for it
+        work.sort(key=lambda item: item[0])
+
+        results = {city: 0 for names in formats.values() for city in names}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                (feed_format, days, executor.submit(run, feed_format, raw_files, previous, consolidated))
+                for _, feed_format, days, raw_files, previous, consolidated in work
+            ]
+            for feed_format, days, future in futures:
+                try:
+                    failed_cities = future.result()
+                except Exception as e:
+                    logging.error(f"{feed_format} backfill from {days[0]} to {days[-1]} failed: {e}")
+                    failed_cities = {city: e for city in formats[feed_format]}
+                else:
+                    logging.info(f"{feed_format} cities backfilled from {days[0]} to {days[-1]}.")
+
+                for city in formats[feed_format]:
+                    if city in failed_cities:
+                        results[city] = failed_cities[city]
+                    elif isinstance(results[city], int):
+                        results[city] += len(days)
+
+        agregate_data(con)
+
+    return results
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Reprocess past days of raw data.")
+    parser.add_argument("start_date", type=date.fromisoformat, help="First day, YYYY-MM-DD")
+    parser.add_argument("end_date", type=date.fromisoformat, help="Last day, YYYY-MM-DD")
+    args = parser.parse_args()
+
+    print(backfill(args.start_date, args.end_date))
@@ -0,0 +1,268 @@
+from datetime import date, timedelta
+import logging
+import os
+import shutil
+
+import duckdb
+
+from data_agregation import get_watermark
+from data_consolidation import (
+    RAW_DATA_DIRECTORY,
+    SNAPSHOT_DIRECTORY,
+    list_raw_files,
+    raw_columns,
+    raw_data_source,
+    raw_parquet_path,
+)
+from data_ingestion import read_manifest
+from data_polling import prune_status_changes
+from database import DATABASE_PATH, connect
+
+# Days of raw JSON kept as fetched; older days are compacted into Parquet
+RAW_JSON_RETENTION_DAYS = int(os.environ.get("RAW_JSON_RETENTION_DAYS", 7))
+# Days of station statement snapshots kept once rolled up into AGG_STATION_HOURLY
+SNAPSHOT_RETENTION_DAYS = int(os.environ.get("SNAPSHOT_RETENTION_DAYS", 30))
+# Minimum delay between two compactions run by the background refresher, 0 disables them
+COMPACTION_INTERVAL_HOURS = int(os.environ.get("COMPACTION_INTERVAL_HOURS", 24))
+# Raw files that cannot be read are moved here, under their path in the raw data
+# directory, instead of blocking the compaction of their day
+RAW_QUARANTINE_DIRECTORY = "data/raw_quarantine"
+
+
+def quarantine_raw_file(path):
+    """
+    Moves a raw file out of the raw data directory, keeping its path below it.
+
+    Args:
+        path (str): The raw file.
+
+    Returns:
+        str: The new path of the file.
+    """
+    quarantine_path = os.path.join(
+        RAW_QUARANTINE_DIRECTORY, os.path.relpath(path, RAW_DATA_DIRECTORY)
+    )
+    os.makedirs(os.path.dirname(quarantine_path), exist_ok=True)
+    os.replace(path, quarantine_path)
+
+    logging.warning(f"Unreadable raw file {path} moved to {quarantine_path}.")
+    return quarantine_path
+
+
+def readable_raw_paths(con, file_name, raw_paths):
+    """
+    Reads the raw JSON files of a source one by one, moving the ones that cannot
+    be read to the quarantine directory.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        file_name (str): The raw source file name.
+        raw_paths (list[str]): The raw files.
+
+    Returns:
+        list[str]: The files that can be read.
+    """
+    readable = []
+    for path in raw_paths:
+        if not path.endswith(".parquet"):
+            raw_data, _ = raw_data_source([file_name], [path])
+            try:
+                con.execute(f"SELECT count(*) FROM {raw_data}").fetchone()
+            except duckdb.Error:
+                quarantine_raw_file(path)
+                continue
+        readable.append(path)
+
+    return readable
+
+
+def compact_raw_day(con, file_name, day, raw_paths):
+    """
+    Compacts the raw files of a source fetched on a day into a single zstd-compressed
+    Parquet file, then deletes the JSON files. A Parquet file already written for the
+    day is merged into the new one. When the files cannot be read together, the
+    unreadable ones are quarantined and the others compacted.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        file_name (str): The raw source file name.
+        day (date): The day the files were fetched.
+        raw_paths (list[str]): The raw files of the day.
+    """
+    parquet_path = raw_parquet_path(file_name, day)
+    os.makedirs(os.path.dirname(parquet_path), exist_ok=True)
+
+    def copy_to_parquet(paths):
+        raw_data, _ = raw_data_source([file_name], paths)
+        con.execute(f"""
+        COPY (SELECT * FROM {raw_data} ORDER BY filename)
+        TO '{parquet_path}.tmp'
+        (FORMAT parquet, COMPRESSION zstd)
+        """)
+
+    try:
+        copy_to_parquet(raw_paths)
+    except duckdb.Error as e:
+        logging.warning(f"Compacting {file_name} of {day} failed, reading each file: {e}")
+        raw_paths = readable_raw_paths(con, file_name, raw_paths)
+        if not any(not path.endswith(".parquet") for path in raw_paths):
+            return
+        copy_to_parquet(raw_paths)
+    os.replace(f"{parquet_path}.tmp", parquet_path)
+
+    for path in raw_paths:
+        if not path.endswith(".parquet"):
+            os.remove(path)
+
+
+def remove_empty_directories(directory):
+    """
+    Removes the empty directories below `directory`, deepest first.
+
+    Args:
+        directory (str): The root directory, kept even if empty.
+    """
+    for path, _, _ in sorted(os.walk(directory), key=lambda entry: entry[0], reverse=True):
+        if path != directory and not os.listdir(path):
+            os.rmdir(path)
+
+
+def compact_raw_data(con, retention_days=RAW_JSON_RETENTION_DAYS, today=None):
+    """
+    Compacts the raw JSON files older than the retention window into date-partitioned
+    Parquet files, one per source and day. Files still referenced by the ingestion
+    manifest are kept: unchanged sources are consolidated from them. A day that
+    fails is logged and left as is, the other days are still compacted.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        retention_days (int): Number of days of raw JSON kept.
+        today (date | None): The current day.
+
+    Returns:
+        int: Number of source days compacted.
+    """
+    today = today or date.today()
+    last_day = today - timedelta(days=retention_days + 1)
+    manifest_paths = {entry.get("path") for entry in read_manifest().values()}
+
+    nb_days = 0
+    for file_name in raw_columns():
+        files = list_raw_files(con, file_name, date(1970, 1, 1), last_day)
+        for day, raw_paths in files.items():
+            raw_paths = [path for path in raw_paths if path not in manifest_paths]
+            if not any(not path.endswith(".parquet") for path in raw_paths):
+                continue
+
+            try:
+                compact_raw_day(con, file_name, day, raw_paths)
+            except Exception as e:
+                logging.error(f"Compacting {file_name} of {day} failed: {e}")
+                continue
+            nb_days += 1
+
+    if os.path.isdir(RAW_DATA_DIRECTORY):
+        remove_empty_directories(RAW_DATA_DIRECTORY)
+
+    logging.info(f"{nb_days} days of raw data compacted into Parquet.")
+    return nb_days
+
+
+def prune_snapshots(con, retention_days=SNAPSHOT_RETENTION_DAYS, today=None):
+    """
+    Deletes the snapshot_date partitions of the snapshot store older than the
+    retention window. A partition is only deleted once its day is before the
+    AGG_STATION_HOURLY watermark: its hourly buckets are then complete and kept.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        retention_days (int): Number of days of snapshots kept.
+        today (date | None): The current day.
+
+    Returns:
+        int: Number of days deleted.
+    """
+    if not os.path.isdir(SNAPSHOT_DIRECTORY):
+        return 0
+
+    today = today or date.today()
+    last_day = today - timedelta(days=retention_days + 1)
+    watermark = get_watermark(con, "AGG_STATION_HOURLY")
+    if watermark is None:
+        return 0
+    last_day = min(last_day, watermark.date() - timedelta(days=1))
+
+    nb_days = 0
+    for partition in sorted(os.listdir(SNAPSHOT_DIRECTORY)):
+        _, _, day = partition.partition("snapshot_date=")
+        if not day or date.fromisoformat(day) > last_day:
+            continue
+        shutil.rmtree(os.path.join(SNAPSHOT_DIRECTORY, partition))
+        nb_days += 1
+
+    logging.info(f"{nb_days} days of station statement snapshots deleted.")
+    return nb_days
+
+
+def compact_database():
+    """
+    Checkpoints the DuckDB database, then rewrites it into a new file that replaces
+    it: space freed by deleted or updated rows is otherwise kept by the file. Must
+    run while no other connection writes to the database. The compaction is
+    skipped while another process holds the file, such as the dashboard reading it
+    without a published copy: it would keep reading the replaced file.
+
+    Returns:
+        tuple | None: The database size in bytes before and after the compaction,
+            None when it was skipped.
+    """
+    compacted_path = f"{DATABASE_PATH}.compact"
+    if os.path.exists(compacted_path):
+        os.remove(compacted_path)
+
+    try:
+        con = connect()
+    except duckdb.IOException as e:
+        logging.warning(f"Database compaction skipped, the file is in use: {e}")
+        return None
+
+    with con:
+        con.execute("CHECKPOINT")
+        size_before = os.path.getsize(DATABASE_PATH)
+        database_name = con.execute("SELECT current_database()").fetchone()[0]
+        con.execute(f"ATTACH '{compacted_path}' AS compacted")
+        con.execute(f"COPY FROM DATABASE {database_name} TO compacted")
+        con.execute("DETACH compacted")
+        # Replaced while the write lock is held: no reader has the old file open,
+        # the next ones open the compacted file
+        os.replace(compacted_path, DATABASE_PATH)
+    size_after = os.path.getsize(DATABASE_PATH)
+
+    logging.info(f"Database compacted from {size_before} to {size_after} bytes.")
+    return size_before, size_after
+
+
+def run_compaction():
+    """
+    Deletes the station status changes and snapshots and compacts the raw data out
+    of their retention window, then compacts the DuckDB database, even if they
+    failed.
+
+    Returns:
+        tuple | None: The database size in bytes before and after the compaction,
+            None when the database compaction was skipped.
+    """
+    try:
+        with connect() as con:
+            prune_status_changes(con)
+            prune_snapshots(con)
+            compact_raw_data(con)
+    finally:
+        sizes = compact_database()
+
+    return sizes
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    run_compaction()
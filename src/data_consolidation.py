@@ -1,47 +1,508 @@
-from datetime import datetime
+import glob
 import logging
+import os
 
 import duckdb
 
-logging.basicConfig(level=logging.INFO)
-
-today_date = datetime.now().strftime("%Y-%m-%d")
-PARIS_CITY_CODE = 1
-NANTES_CITY_CODE = 2
-TOULOUSE_CITY_CODE = 3
-MONTPELLIER_CITY_CODE = 4
-
+from city_registry import FEED_FORMATS, cities_of_format, get_city_registry
+from data_ingestion import SNAPSHOT_MODE, raw_data_path
+from database import transaction
+from etl_metrics import instrumented
+from schema_migrations import migrate_schema
+
+# Append-only, date-partitioned Parquet store of every station statement snapshot
+SNAPSHOT_DIRECTORY = "data/snapshots/station_statement"
+
+# Raw files older than the retention window are compacted into Parquet files,
+# one per source and day: <directory>/<source>/fetch_date=<YYYY-MM-DD>/<source>.parquet
+RAW_DATA_DIRECTORY = "data/raw_data"
+RAW_PARQUET_DIRECTORY = "data/raw_parquet"
+
+# Day a raw file was fetched, from its data/raw_data/<date>/ directory. Compacted rows
+# keep the path of the JSON file they come from.
+RAW_DATA_PATH_DATE = r"CAST(regexp_extract(filename, '(\d{4}-\d{2}-\d{2})', 1) AS DATE)"
+# Source file name of a raw row, from its path
+RAW_DATA_PATH_SOURCE = r"regexp_replace(parse_filename(filename), '\.gz$', '')"
+
+# Columns read from each feed of a format
+FEED_RAW_COLUMNS = {
+    ("opendatasoft", "realtime"): """{
+        stationcode: 'VARCHAR',
+        name: 'VARCHAR',
+        nom_arrondissement_communes: 'VARCHAR',
+        code_insee_commune: 'VARCHAR',
+        coordonnees_geo: 'STRUCT(lon DOUBLE, lat DOUBLE)',
+        is_installed: 'VARCHAR',
+        capacity: 'INTEGER',
+        numdocksavailable: 'INTEGER',
+        numbikesavailable: 'INTEGER',
+        duedate: 'TIMESTAMPTZ'
+    }""",
+    ("jcdecaux", "realtime"): """{
+        number: 'INTEGER',
+        name: 'VARCHAR',
+        address: 'VARCHAR',
+        position: 'STRUCT(lon DOUBLE, lat DOUBLE)',
+        status: 'VARCHAR',
+        bike_stands: 'INTEGER',
+        available_bike_stands: 'INTEGER',
+        available_bikes: 'INTEGER',
+        last_update: 'TIMESTAMPTZ'
+    }""",
+    ("gbfs", "station_status"): """{
+        data: 'STRUCT(stations STRUCT(
+            station_id VARCHAR,
+            is_installed INTEGER,
+            num_docks_available INTEGER,
+            num_bikes_available INTEGER,
+            last_reported BIGINT
+        )[])'
+    }""",
+    ("gbfs", "station_information"): """{
+        data: 'STRUCT(stations STRUCT(
+            station_id VARCHAR,
+            name VARCHAR,
+            lon DOUBLE,
+            lat DOUBLE,
+            capacity INTEGER
+        )[])'
+    }""",
+}
+
+# Columns read from the commune data, also the schema of its Parquet compaction
+COMMUNE_RAW_COLUMNS = "{code: 'VARCHAR', nom: 'VARCHAR', population: 'INTEGER'}"
+
+# Attributes tracked by the slowly changing dimension tables: a new version of a row
+# is only written when the hash of these columns changes
+SCD_TRACKED_COLUMNS = {
+    "CONSOLIDATE_STATION": [
+        "CODE", "NAME", "CITY_NAME", "CITY_CODE", "ADDRESS",
+        "LONGITUDE", "LATITUDE", "STATUS", "CAPACITTY",
+    ],
+    "CONSOLIDATE_CITY": ["NAME", "NB_INHABITANTS"],
+}
+
+
+def raw_columns():
+    """
+    Returns the columns read from each raw JSON source of the registry and the
+    commune data, also the schema of its Parquet compaction.
 
-def create_consolidate_tables():
+    Returns:
+        dict: The columns of each source file name, as a read_json struct.
+    """
+    return {
+        **{
+            file_name: FEED_RAW_COLUMNS[(city["format"], feed)]
+            for city in get_city_registry()
+            for feed, (_, file_name) in city["feeds"].items()
+        },
+        "commune_data.json": COMMUNE_RAW_COLUMNS,
+    }
+
+
+@instrumented
+def create_consolidate_tables(con):
     """
-    Creates necessary consolidated tables in the DuckDB database.
+    Creates necessary consolidated tables in the DuckDB database, after bringing
+    the schema of an existing database to the latest version.
     Executes the SQL statements from the provided file.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
     """
-    con = duckdb.connect(
-        database="data/duckdb/mobility_analysis.duckdb", read_only=False
-    )
+    migrate_schema(con)
+
     with open("data/sql_statements/create_consolidate_tables.sql") as fd:
         statements = fd.read()
         for statement in statements.split(";"):
-            print(statement)
+            logging.debug(statement)
             con.execute(statement)
 
+    for table_name in SCD_TRACKED_COLUMNS:
+        migrate_scd_history(con, table_name)
+
+    migrate_snapshot_store(con)
 
-def consolidate_paris_station():
+
+def migrate_snapshot_store(con):
     """
-    Consolidates the Paris station data by reading from the Paris real-time bicycle data
-    and normalizing it before storing it into the CONSOLIDATE_STATION table.
+    Rewrites the snapshot files written before the snapshot store kept the station
+    surrogate keys, whose station_id column holds the natural station ids. Each
+    file is written under a temporary name, then renamed over the old one, so an
+    interrupted migration resumes with the files left.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+    """
+    if not glob.glob(f"{SNAPSHOT_DIRECTORY}/*/*.parquet"):
+        return
+
+    paths = [
+        row[0]
+        for row in con.execute(f"""
+        SELECT file_name
+        FROM parquet_schema('{SNAPSHOT_DIRECTORY}/*/*.parquet')
+        WHERE name = 'station_id' AND type = 'BYTE_ARRAY';
+        """).fetchall()
+    ]
+    for path in paths:
+        con.execute(f"""
+        COPY (
+            SELECT
+                k.ID AS station_id,
+                s.bicycle_docks_available,
+                s.bicycle_available,
+                s.last_statement_ts,
+                s.snapshot_ts
+            FROM read_parquet('{path}', hive_partitioning = false) s
+            JOIN STATION_KEY k ON k.NATURAL_ID = s.station_id
+        ) TO '{path}.tmp'
+        (FORMAT parquet, COMPRESSION zstd)
+        """)
+        os.replace(f"{path}.tmp", path)
+
+    if paths:
+        logging.info(f"{len(paths)} snapshot files converted to station surrogate keys.")
+
+
+def row_hash(table_name):
     """
-    con = duckdb.connect(
-        database="data/duckdb/mobility_analysis.duckdb", read_only=False
+    Returns the SQL expression hashing the tracked attributes of a slowly changing
+    dimension table.
+
+    Args:
+        table_name (str): The slowly changing dimension table.
+    """
+    return f"hash({', '.join(SCD_TRACKED_COLUMNS[table_name])})"
+
+
+@instrumented
+def migrate_scd_history(con, table_name):
+    """
+    Converts the daily full copies loaded before the slowly changing dimension
+    handling into versions: rows identical to the previous day are dropped and
+    each remaining version is closed by the next one. Only runs when rows without
+    a hash are left.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        table_name (str): The slowly changing dimension table.
+    """
+    if con.execute(
+        f"SELECT COUNT(*) FROM {table_name} WHERE ROW_HASH IS NULL"
+    ).fetchone()[0] == 0:
+        return
+
+    with transaction(con):
+        con.execute(f"UPDATE {table_name} SET ROW_HASH = {row_hash(table_name)} WHERE ROW_HASH IS NULL;")
+        con.execute(f"""
+        DELETE FROM {table_name}
+        WHERE (ID, CREATED_DATE) IN (
+            SELECT (ID, CREATED_DATE)
+            FROM {table_name}
+            QUALIFY ROW_HASH = LAG(ROW_HASH) OVER (PARTITION BY ID ORDER BY CREATED_DATE)
+        );
+        """)
+        con.execute(f"""
+        UPDATE {table_name} t
+        SET VALID_TO = CAST(n.NEXT_CREATED_DATE AS DATE)
+        FROM (
+            SELECT
+                ID,
+                CREATED_DATE,
+                LEAD(CREATED_DATE) OVER (PARTITION BY ID ORDER BY CREATED_DATE) AS NEXT_CREATED_DATE
+            FROM {table_name}
+        ) n
+        WHERE t.ID = n.ID
+        AND t.CREATED_DATE = n.CREATED_DATE
+        AND n.NEXT_CREATED_DATE IS NOT NULL;
+        """)
+
+    logging.info(f"{table_name} daily copies converted into versions.")
+
+
+@instrumented
+def write_scd_versions(con, table_name, source_query):
+    """
+    Writes the rows of `source_query` into a slowly changing dimension table (type 2).
+    Source rows are daily observations dated by their CREATED_DATE: the current day,
+    or past days when backfilling. Rows identical to the version valid on their day
+    are skipped. For the others, the history of the row is rebuilt from its versions
+    and the new observations: a version starts on each change and is closed by the
+    next one (VALID_TO), the current version having no VALID_TO.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        table_name (str): The slowly changing dimension table.
+        source_query (str): The query returning the rows, with the table columns
+            except ROW_HASH and VALID_TO.
+    """
+    # Rows are cast to the table types before hashing, so hashes compare equal
+    # to the ones of the stored versions
+    con.execute(f"""
+    CREATE OR REPLACE TEMP TABLE SCD_SOURCE AS
+    SELECT * EXCLUDE (ROW_HASH, VALID_TO) FROM {table_name} LIMIT 0;
+    """)
+    con.execute(f"INSERT INTO SCD_SOURCE BY NAME ({source_query});")
+
+    con.execute(f"""
+    CREATE OR REPLACE TEMP TABLE SCD_OBSERVATIONS AS
+    SELECT
+        * REPLACE (CAST(CREATED_DATE AS DATE) AS CREATED_DATE),
+        {row_hash(table_name)} AS ROW_HASH
+    FROM SCD_SOURCE
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY ID, CREATED_DATE) = 1;
+    """)
+
+    # Rows observed with other attributes than the version valid on that day
+    con.execute(f"""
+    CREATE OR REPLACE TEMP TABLE SCD_CHANGED_IDS AS
+    SELECT DISTINCT o.ID
+    FROM SCD_OBSERVATIONS o
+    LEFT JOIN {table_name} v
+    ON v.ID = o.ID
+    AND CAST(v.CREATED_DATE AS DATE) <= o.CREATED_DATE
+    AND (v.VALID_TO IS NULL OR v.VALID_TO > o.CREATED_DATE)
+    WHERE v.ID IS NULL OR v.ROW_HASH <> o.ROW_HASH;
+    """)
+
+    con.execute(f"""
+    CREATE OR REPLACE TEMP TABLE SCD_VERSIONS AS
+    WITH observations AS (
+        SELECT *
+        FROM SCD_OBSERVATIONS
+        WHERE ID IN (SELECT ID FROM SCD_CHANGED_IDS)
+    ),
+    versions AS (
+        SELECT * EXCLUDE (VALID_TO) REPLACE (CAST(CREATED_DATE AS DATE) AS CREATED_DATE)
+        FROM {table_name}
+        WHERE ID IN (SELECT ID FROM SCD_CHANGED_IDS)
+    ),
+    restored AS (
+        -- A past observation only covers its own day: the next day is still
+        -- covered by the version that was valid then
+        SELECT v.* EXCLUDE (VALID_TO) REPLACE (o.CREATED_DATE + 1 AS CREATED_DATE)
+        FROM observations o
+        JOIN {table_name} v
+        ON v.ID = o.ID
+        AND CAST(v.CREATED_DATE AS DATE) <= o.CREATED_DATE + 1
+        AND coalesce(v.VALID_TO, current_date + 1) > o.CREATED_DATE + 1
+    ),
+    days AS (
+        SELECT * EXCLUDE (PRIORITY)
+        FROM (
+            SELECT *, 0 AS PRIORITY FROM observations
+            UNION ALL BY NAME
+            SELECT *, 1 AS PRIORITY FROM versions
+            UNION ALL BY NAME
+            SELECT *, 2 AS PRIORITY FROM restored
+        )
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY ID, CREATED_DATE ORDER BY PRIORITY) = 1
+    ),
+    changes AS (
+        SELECT *
+        FROM days
+        QUALIFY ROW_HASH IS DISTINCT FROM LAG(ROW_HASH) OVER (PARTITION BY ID ORDER BY CREATED_DATE)
     )
+    SELECT *, LEAD(CREATED_DATE) OVER (PARTITION BY ID ORDER BY CREATED_DATE) AS VALID_TO
+    FROM changes;
+    """)
+
+    con.execute(f"DELETE FROM {table_name} WHERE ID IN (SELECT ID FROM SCD_CHANGED_IDS);")
+    con.execute(f"INSERT INTO {table_name} BY NAME SELECT * FROM SCD_VERSIONS;")
+
+    nb_changed = con.execute("SELECT COUNT(*) FROM SCD_CHANGED_IDS").fetchone()[0]
+    for temp_table in ("SCD_SOURCE", "SCD_OBSERVATIONS", "SCD_CHANGED_IDS", "SCD_VERSIONS"):
+        con.execute(f"DROP TABLE {temp_table};")
+    logging.info(f"{table_name}: {nb_changed} rows changed.")
 
-    # Consolidation logic for Paris Bicycle data
 
+@instrumented
+def assign_station_keys(con, staging_table):
+    """
+    Gives a surrogate key to the stations of a staging table seen for the first
+    time, then fills its station_key column from their station_natural_id.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        staging_table (str): The staging table.
+    """
     con.execute(f"""
-    INSERT OR REPLACE INTO CONSOLIDATE_STATION
-    SELECT 
-        '{PARIS_CITY_CODE}' || '-' || stationcode AS id,
+    INSERT INTO STATION_KEY (NATURAL_ID)
+    SELECT DISTINCT station_natural_id
+    FROM {staging_table}
+    WHERE station_natural_id NOT IN (SELECT NATURAL_ID FROM STATION_KEY);
+    """)
+    con.execute(f"""
+    UPDATE {staging_table} s
+    SET station_key = k.ID
+    FROM STATION_KEY k
+    WHERE k.NATURAL_ID = s.station_natural_id;
+    """)
+
+
+def raw_parquet_path(file_name, day):
+    """
+    Returns the Parquet file the raw JSON files of a source and a day are compacted into.
+
+    Args:
+        file_name (str): The raw source file name.
+        day (date): The day the files were fetched.
+    """
+    source = file_name.removesuffix(".json")
+    return f"{RAW_PARQUET_DIRECTORY}/{source}/fetch_date={day:%Y-%m-%d}/{source}.parquet"
+
+
+def list_raw_files(con, file_name, start_date, end_date):
+    """
+    Lists the raw files of a source fetched between two days, with DuckDB globs over
+    the raw JSON directories (including the intra-day snapshot directories) and the
+    compacted Parquet files.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        file_name (str): The raw source file name.
+        start_date (date): First day.
+        end_date (date): Last day.
+
+    Returns:
+        dict: The raw files of each day, by date.
+    """
+    parquet_glob = raw_parquet_path(file_name, start_date).replace(
+        f"fetch_date={start_date:%Y-%m-%d}", "*"
+    )
+    rows = con.execute(f"""
+    SELECT day, list(filename ORDER BY filename) AS files
+    FROM (
+        SELECT filename, {RAW_DATA_PATH_DATE} AS day
+        FROM (
+            -- The plain JSON files of old runs or the gzipped ones, not the
+            -- .tmp files of downloads in progress
+            SELECT file AS filename
+            FROM glob('{RAW_DATA_DIRECTORY}/*/**/{file_name}*')
+            WHERE parse_filename(file) IN ('{file_name}', '{file_name}.gz')
+            UNION ALL
+            SELECT file AS filename FROM glob('{parquet_glob}')
+        )
+    )
+    WHERE day BETWEEN $start_date AND $end_date
+    GROUP BY day
+    ORDER BY day;
+    """, {"start_date": start_date, "end_date": end_date}).fetchall()
+
+    return dict(rows)
+
+
+def raw_data_source(file_names, raw_paths=None):
+    """
+    Returns how to read raw feeds of the same shape: the relation reading their
+    files in a single scan, with a filename column, and the SQL expression of the
+    date each row is consolidated under. By default the JSON files of the current
+    run, dated today; when backfilling, the JSON or compacted Parquet files of past
+    days, each row dated from its file path.
+
+    Args:
+        file_names (list[str]): The raw source file names.
+        raw_paths (list[str] | None): Raw files of past days to read instead.
+
+    Returns:
+        tuple: The relation and the created date expression.
+    """
+    if raw_paths is None:
+        json_paths = [raw_data_path(file_name) for file_name in file_names]
+        parquet_paths, created_date = [], "CURRENT_DATE"
+    else:
+        json_paths = [path for path in raw_paths if not path.endswith(".parquet")]
+        parquet_paths = [path for path in raw_paths if path.endswith(".parquet")]
+        created_date = RAW_DATA_PATH_DATE
+
+    relations = []
+    if json_paths:
+        files = ", ".join(f"'{path}'" for path in json_paths)
+        relations.append(
+            f"SELECT * FROM read_json([{files}], columns = {raw_columns()[file_names[0]]}, filename = true)"
+        )
+    if parquet_paths:
+        # Compacted files hold the filename column of the JSON files they come from
+        files = ", ".join(f"'{path}'" for path in parquet_paths)
+        relations.append(f"SELECT * FROM read_parquet([{files}])")
+
+    return f"({' UNION ALL BY NAME '.join(relations)})", created_date
+
+
+def feed_source(cities, feed, raw_files=None):
+    """
+    Returns how to read a feed of several cities of the same format in a single
+    scan: the relation of its rows, each with the city it belongs to (city,
+    city_key and insee_code columns), and the created date expression.
+
+    Args:
+        cities (list[dict]): The registry entries of the cities.
+        feed (str): The feed, from FEED_FORMATS.
+        raw_files (dict | None): Raw files of past days to read instead of the
+            current run's, by source file name.
+
+    Returns:
+        tuple: The relation and the created date expression, or (None, None) when
+            no file of the feed is to be read.
+    """
+    file_names = [city["feeds"][feed][1] for city in cities]
+    raw_paths = None
+    if raw_files is not None:
+        raw_paths = [path for file_name in file_names for path in raw_files.get(file_name, [])]
+        if not raw_paths:
+            return None, None
+
+    raw_data, created_date = raw_data_source(file_names, raw_paths)
+    feeds = ", ".join(
+        "('{}', '{}', {}, {})".format(
+            city["feeds"][feed][1],
+            city["name"].replace("'", "''"),
+            city["key"],
+            f"'{city['insee_code']}'" if city["insee_code"] else "NULL",
+        )
+        for city in cities
+    )
+
+    return f"""(
+        SELECT r.*, f.city, f.city_key, f.insee_code
+        FROM {raw_data} r
+        JOIN (VALUES {feeds}) AS f(source_file, city, city_key, insee_code)
+        ON f.source_file = {RAW_DATA_PATH_SOURCE}
+    )""", created_date
+
+
+def staging_table(feed_format):
+    """
+    Returns the temporary table the feeds of a format are staged into.
+
+    Args:
+        feed_format (str): The feed format.
+    """
+    return f"STAGING_{feed_format.upper()}"
+
+
+@instrumented
+def stage_opendatasoft_data(con, cities, raw_files=None):
+    """
+    Loads the real-time bicycle data of the Opendatasoft (Vélib') cities into the
+    STAGING_OPENDATASOFT temporary table. Each station carries its own commune.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        cities (list[dict]): The registry entries of the cities.
+        raw_files (dict | None): Raw files of past days to stage instead of the
+            current run's, by source file name.
+    """
+    raw_data, created_date = feed_source(cities, "realtime", raw_files)
+
+    con.execute(f"""
+    CREATE OR REPLACE TEMP TABLE STAGING_OPENDATASOFT AS
+    SELECT
+        city,
+        city_key || '-' || stationcode AS station_natural_id,
+        CAST(NULL AS INTEGER) AS station_key,
         stationcode AS code,
         name,
         nom_arrondissement_communes AS city_name,
@@ -49,69 +510,123 @@ def consolidate_paris_station():
         NULL AS address,
         coordonnees_geo.lon AS longitude,
         coordonnees_geo.lat AS latitude,
-        is_installed AS status,
-        CURRENT_date AS created_date,
-        capacity
-    FROM read_json('data/raw_data/{today_date}/paris_realtime_bicycle_data.json')
+        CASE
+            WHEN is_installed = 'OUI' THEN 'OUI'
+            WHEN is_installed = 'NON' THEN 'NON'
+        END AS status,
+        capacity,
+        numdocksavailable AS bicycle_docks_available,
+        numbikesavailable AS bicycle_available,
+        CAST(duedate AS TIMESTAMP) AS last_statement_date,
+        {created_date} AS created_date,
+        TRUE AS described
+    FROM {raw_data}
+    -- Last reading of the day when several runs of a day are read
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY station_natural_id, created_date ORDER BY filename DESC) = 1
     """)
 
-    logging.info("Paris Bicycle data consolidated successfully.")
 
-
-def consolidate_montpellier_station():
+@instrumented
+def stage_jcdecaux_data(con, cities, raw_files=None):
     """
-    Consolidates the Montpellier station data by reading both real-time bicycle status
-    and station information data, merging them, and storing the result in the
-    CONSOLIDATE_STATION table.
+    Loads the real-time bicycle data of the JCDecaux-style cities (Nantes,
+    Toulouse) into the STAGING_JCDECAUX temporary table.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        cities (list[dict]): The registry entries of the cities.
+        raw_files (dict | None): Raw files of past days to stage instead of the
+            current run's, by source file name.
     """
-    con = duckdb.connect(
-        database="data/duckdb/mobility_analysis.duckdb", read_only=False
-    )
+    raw_data, created_date = feed_source(cities, "realtime", raw_files)
 
     con.execute(f"""
-    INSERT OR REPLACE INTO CONSOLIDATE_STATION
-    WITH status_data AS (
-        SELECT *
-        FROM read_json(
-            'data/raw_data/{today_date}/montpellier_realtime_bicycle_station_status_data.json',
-            columns = {{
-                data: 'STRUCT(stations STRUCT(
-                    station_id VARCHAR,
-                    is_installed INTEGER
-                )[])'
-            }}
+    CREATE OR REPLACE TEMP TABLE STAGING_JCDECAUX AS
+    SELECT
+        city,
+        city_key || '-' || number AS station_natural_id,
+        CAST(NULL AS INTEGER) AS station_key,
+        CAST(number AS VARCHAR) AS code,
+        COALESCE(SPLIT_PART(name, '-', 2), name) AS name,
+        city AS city_name,
+        insee_code AS city_code,
+        address,
+        position.lon AS longitude,
+        position.lat AS latitude,
+        CASE
+            WHEN status = 'OPEN' THEN 'OUI'
+            WHEN status = 'CLOSED' THEN 'NON'
+        END AS status,
+        bike_stands AS capacity,
+        available_bike_stands AS bicycle_docks_available,
+        available_bikes AS bicycle_available,
+        CAST(last_update AS TIMESTAMP) AS last_statement_date,
+        {created_date} AS created_date,
+        TRUE AS described
+    FROM {raw_data}
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY station_natural_id, created_date ORDER BY filename DESC) = 1
+    """)
+
+
+@instrumented
+def stage_gbfs_data(con, cities, raw_files=None):
+    """
+    Loads the GBFS station status of the GBFS cities (Montpellier), with the
+    attributes of each station from the station information feed, into the
+    STAGING_GBFS temporary table. Stations missing from the information feed are
+    staged without attributes (described is false).
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        cities (list[dict]): The registry entries of the cities.
+        raw_files (dict | None): Raw files of past days to stage instead of the
+            current run's, by source file name. The information feed may be left
+            out, as when polling the status feed.
+    """
+    status_data, created_date = feed_source(cities, "station_status", raw_files)
+    information_data, information_date = feed_source(cities, "station_information", raw_files)
+
+    if information_data is None:
+        information = """
+        SELECT
+            NULL::INTEGER AS city_key,
+            NULL::VARCHAR AS station_id,
+            NULL::VARCHAR AS name,
+            NULL::DOUBLE AS lon,
+            NULL::DOUBLE AS lat,
+            NULL::INTEGER AS capacity,
+            NULL::DATE AS created_date
+        WHERE false
+        """
+    else:
+        information = f"""
+        SELECT * EXCLUDE (filename)
+        FROM (
+            SELECT city_key, UNNEST(data.stations, recursive := true), {information_date} AS created_date, filename
+            FROM {information_data}
         )
-    ),
-    station_status AS (
-        SELECT UNNEST(data.stations) AS s
-        FROM status_data
-    ),
-    info_data AS (
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY city_key, station_id, created_date ORDER BY filename DESC) = 1
+        """
+
+    con.execute(f"""
+    CREATE OR REPLACE TEMP TABLE STAGING_GBFS AS
+    WITH status AS (
         SELECT *
-        FROM read_json(
-            'data/raw_data/{today_date}/montpellier_realtime_bicycle_station_information_data.json',
-            columns = {{
-                data: 'STRUCT(stations STRUCT(
-                    station_id VARCHAR,
-                    name VARCHAR,
-                    lon DOUBLE,
-                    lat DOUBLE,
-                    capacity INTEGER
-                )[])'
-            }}
+        FROM (
+            SELECT city, city_key, insee_code, UNNEST(data.stations, recursive := true), {created_date} AS created_date, filename
+            FROM {status_data}
         )
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY city_key, station_id, created_date ORDER BY filename DESC) = 1
     ),
-    station_info AS (
-        SELECT UNNEST(data.stations) AS i
-        FROM info_data
-    )
-
+    information AS ({information})
     SELECT
-        '{MONTPELLIER_CITY_CODE}' || '-' || s.station_id AS id,
+        s.city,
+        s.city_key || '-' || s.station_id AS station_natural_id,
+        CAST(NULL AS INTEGER) AS station_key,
         s.station_id AS code,
         i.name,
-        'Montpellier' AS city_name,
-        '34172' AS city_code,
+        s.city AS city_name,
+        s.insee_code AS city_code,
         NULL AS address,
         i.lon AS longitude,
         i.lat AS latitude,
@@ -119,216 +634,314 @@ def consolidate_montpellier_station():
             WHEN s.is_installed = 1 THEN 'OUI'
             WHEN s.is_installed = 0 THEN 'NON'
         END AS status,
-        CURRENT_DATE AS created_date,
-        i.capacity
-    FROM station_status s
-    JOIN station_info i
-    ON s.station_id = i.station_id
+        i.capacity,
+        s.num_docks_available AS bicycle_docks_available,
+        s.num_bikes_available AS bicycle_available,
+        CAST(TO_TIMESTAMP(s.last_reported) AS TIMESTAMP) AS last_statement_date,
+        s.created_date,
+        i.station_id IS NOT NULL AS described
+    FROM status s
+    LEFT JOIN information i
+    ON s.city_key = i.city_key
+    AND s.station_id = i.station_id
+    AND s.created_date = i.created_date
     """)
 
-    logging.info("Montpellier Bicycle data consolidated")
+
+FORMAT_STAGING_FUNCTIONS = {
+    "opendatasoft": stage_opendatasoft_data,
+    "jcdecaux": stage_jcdecaux_data,
+    "gbfs": stage_gbfs_data,
+}
 
 
-def consolidate_nantes_toulouse_station_data(city="Nantes"):
+@instrumented
+def stage_feed_format(con, feed_format, cities=None, raw_files=None):
     """
-    Consolidates the station data for Nantes and Toulouse by reading the corresponding
-    real-time bicycle data, processing it, and storing it in the CONSOLIDATE_STATION table.
+    Loads the feeds of every city of a format into the STAGING_<FORMAT> temporary
+    table, in one query. Whatever the format, the staged rows have the same columns:
+    the station attributes and statement of each station and day, the station
+    surrogate key being filled by the consolidation. Both the station and the
+    station statement consolidations read from this table.
 
     Args:
-        city (str): The city name for consolidation ('Nantes' or 'Toulouse').
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        feed_format (str): The feed format, from FEED_FORMATS.
+        cities (list[str] | None): Only these cities, all the cities of the format if None.
+        raw_files (dict | None): Raw files of past days to stage instead of the
+            current run's, by source file name.
     """
-    con = duckdb.connect(
-        database="data/duckdb/mobility_analysis.duckdb", read_only=False
-    )
+    FORMAT_STAGING_FUNCTIONS[feed_format](con, cities_of_format(feed_format, cities), raw_files)
 
-    city_code = NANTES_CITY_CODE
-    city_code_insee_commune = "44109"
+    logging.info(f"{feed_format} Bicycle data staged successfully.")
 
-    # Handle Toulouse specific data
-    if city == "Toulouse":
-        city_code = TOULOUSE_CITY_CODE
-        city_code_insee_commune = "31555"
-    
-    json_path = f"data/raw_data/{today_date}/{city.lower()}_realtime_bicycle_data.json"
 
-    con.execute(f"""
-    INSERT OR REPLACE INTO CONSOLIDATE_STATION
-    SELECT 
-        '{city_code}' || '-' || number AS id,
-        CAST(number AS VARCHAR) AS code,
-        COALESCE(SPLIT_PART(name, '-', 2), name) AS name,
-        '{city}' AS city_name,
-        {city_code_insee_commune} AS city_code,
+@instrumented
+def consolidate_station(con, feed_format, cities=None):
+    """
+    Consolidates the stations staged for a format into the CONSOLIDATE_STATION
+    table, for all its cities at once.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        feed_format (str): The feed format.
+        cities (list[str] | None): Only these cities, all the cities of the format if None.
+    """
+    cities = [city["name"] for city in cities_of_format(feed_format, cities)]
+
+    city_names = ", ".join("'{}'".format(city.replace("'", "''")) for city in cities)
+    write_scd_versions(con, "CONSOLIDATE_STATION", f"""
+    SELECT
+        station_key AS id,
+        code,
+        name,
+        city_name,
+        city_code,
         address,
-        position.lon AS longitude,
-        position.lat AS latitude,
-        CASE
-            WHEN status = 'OPEN' THEN 'OUI'
-            WHEN status = 'CLOSED' THEN 'NON'
-            ELSE status
-        END AS status,
-        CURRENT_date AS created_date,
-        bike_stands AS capacity
-    FROM read_json(
-        '{json_path}',
-        columns = {{
-            number: 'INTEGER',
-            name: 'VARCHAR',
-            address: 'VARCHAR',
-            position: 'STRUCT(lon DOUBLE, lat DOUBLE)',
-            status: 'VARCHAR',
-            bike_stands: 'INTEGER'
-    }})
+        longitude,
+        latitude,
+        status,
+        created_date,
+        capacity AS capacitty
+    FROM {staging_table(feed_format)}
+    WHERE described
+    AND city IN ({city_names})
     """)
-    
-    logging.info(f"{city} Bicycle data consolidated successfully.")
 
+    logging.info(f"{feed_format} Bicycle data consolidated successfully.")
 
-def consolidate_station_data():
-    """
-    Consolidates station data for Paris, Nantes, Toulouse, and Montpellier by
-    calling the respective consolidation functions.
-    """
-    consolidate_paris_station()
-    consolidate_nantes_toulouse_station_data("Nantes")
-    consolidate_nantes_toulouse_station_data("Toulouse")
-    consolidate_montpellier_station()
 
-
-def consolidate_city_data():
+@instrumented
+def consolidate_city_data(con, raw_paths=None):
     """
     Consolidates city data by reading from the commune data JSON, processing it,
     and inserting it into the CONSOLIDATE_CITY table.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        raw_paths (list[str] | None): Raw files of past days to consolidate instead
+            of the current run's.
     """
-    con = duckdb.connect(
-        database="data/duckdb/mobility_analysis.duckdb", read_only=False
-    )
+    raw_data, created_date = raw_data_source(["commune_data.json"], raw_paths)
 
     con.execute(f"""
-    INSERT OR REPLACE INTO CONSOLIDATE_CITY
+    INSERT INTO CITY_KEY (NATURAL_ID)
+    SELECT DISTINCT code
+    FROM {raw_data}
+    WHERE code NOT IN (SELECT NATURAL_ID FROM CITY_KEY);
+    """)
+
+    write_scd_versions(con, "CONSOLIDATE_CITY", f"""
     SELECT 
-        code AS id,
+        k.ID AS id,
         nom AS name,
         population AS nb_inhabitants,
-        CURRENT_DATE as created_date
-    FROM read_json('data/raw_data/{today_date}/commune_data.json')
+        {created_date} as created_date
+    FROM {raw_data}
+    JOIN CITY_KEY k ON k.NATURAL_ID = code
     """)
 
     logging.info("Cities data consolidated successfully")
 
 
-def consolidate_station_statement_paris_data():
+@instrumented
+def consolidate_station_statement(con, feed_format):
     """
-    Consolidates station statement data for Paris by processing real-time bicycle data
-    and inserting it into the CONSOLIDATE_STATION_STATEMENT table.
+    Consolidates the station statements staged for a format into the
+    CONSOLIDATE_STATION_STATEMENT table, for all its cities at once. The rows are
+    loaded as a new batch, queued in LOAD_BATCH for the fact aggregation; both
+    are committed together by the caller's transaction.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        feed_format (str): The feed format.
     """
-    con = duckdb.connect(
-        database="data/duckdb/mobility_analysis.duckdb", read_only=False
-    )
+    load_batch = con.execute("SELECT nextval('LOAD_BATCH_SEQUENCE')").fetchone()[0]
 
-    # Insert data into database
     con.execute(f"""
     INSERT OR REPLACE INTO CONSOLIDATE_STATION_STATEMENT
-    SELECT 
-        '{PARIS_CITY_CODE}' || '-' || stationcode AS station_id,
-        numdocksavailable AS bicycle_docks_available,
-        numbikesavailable AS bicycle_available,
-        duedate AS last_statement_date,
-        CURRENT_date AS created_date,
-    FROM read_json('data/raw_data/{today_date}/paris_realtime_bicycle_data.json')
-    """)
+    SELECT
+        station_key AS station_id,
+        bicycle_docks_available,
+        bicycle_available,
+        last_statement_date,
+        created_date,
+        CURRENT_TIMESTAMP AS loaded_at,
+        $load_batch AS load_batch
+    FROM {staging_table(feed_format)}
+    """, {"load_batch": load_batch})
+
+    con.execute(
+        "INSERT INTO LOAD_BATCH VALUES (?, ?, CURRENT_TIMESTAMP)", [load_batch, feed_format]
+    )
 
-    logging.info("Paris Station Statement data consolidated successfully.")
+    logging.info(f"{feed_format} Station Statement data consolidated successfully.")
 
 
-def consolidate_station_statement_montpellier_data():
+@instrumented
+def snapshot_station_statement_data(con, feed_format, snapshot_ts):
     """
-    Consolidates station statement data for Montpellier by processing real-time station
-    status data and inserting it into the CONSOLIDATE_STATION_STATEMENT table.
+    Appends the staged station statements of a format to the snapshot store as one
+    Parquet file per run, under a snapshot_date=<YYYY-MM-DD> partition. Unlike
+    CONSOLIDATE_STATION_STATEMENT, which keeps the last reading of the day, every
+    run is kept, keyed on (STATION_ID, SNAPSHOT_TS), with the full reading timestamp.
+    As in CONSOLIDATE_STATION_STATEMENT, STATION_ID is the station surrogate key.
+
+    The file is not part of any transaction: it must be written once the
+    consolidation of the statements is committed, so a rolled back consolidation
+    leaves no snapshot. It is written under a temporary name, never read, then
+    renamed.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        feed_format (str): The feed format.
+        snapshot_ts (datetime): Start time of the ETL run.
     """
-    con = duckdb.connect(
-        database="data/duckdb/mobility_analysis.duckdb", read_only=False
-    )
+    directory = f"{SNAPSHOT_DIRECTORY}/snapshot_date={snapshot_ts:%Y-%m-%d}"
+    path = f"{directory}/{snapshot_ts:%H%M%S}_{feed_format}.parquet"
+    os.makedirs(directory, exist_ok=True)
 
     con.execute(f"""
-    INSERT OR REPLACE INTO CONSOLIDATE_STATION_STATEMENT
-    WITH raw_status AS (
-        SELECT UNNEST(data.stations) AS s
-        FROM read_json(
-            'data/raw_data/{today_date}/montpellier_realtime_bicycle_station_status_data.json',
-            columns = {{
-                data: 'STRUCT(stations STRUCT(
-                    station_id VARCHAR,
-                    num_docks_available INTEGER,
-                    num_bikes_available INTEGER,
-                    last_reported BIGINT
-                )[])'
-            }}
-        )
-    )
-
-    SELECT
-        '{MONTPELLIER_CITY_CODE}' || '-' || s.station_id AS station_id,
-        s.num_docks_available AS bicycle_docks_available,
-        s.num_bikes_available AS bicycle_available,
-        STRFTIME(
-            TO_TIMESTAMP(s.last_reported),
-            '%Y-%m-%dT%H:%M:%S+00:00'
-        ) AS last_statement_date,
-        CURRENT_DATE AS created_date
-    FROM raw_status
+    COPY (
+        SELECT
+            station_key AS station_id,
+            bicycle_docks_available,
+            bicycle_available,
+            last_statement_date AS last_statement_ts,
+            TIMESTAMP '{snapshot_ts:%Y-%m-%d %H:%M:%S}' AS snapshot_ts
+        FROM {staging_table(feed_format)}
+    ) TO '{path}.tmp'
+    (FORMAT parquet, COMPRESSION zstd)
     """)
+    os.replace(f"{path}.tmp", path)
 
-    logging.info("Montpellier Station Statement data consolidated successfully.")
+    logging.info(f"{feed_format} Station Statement snapshot appended successfully.")
 
 
-def consolidate_station_statement_nantes_toulouse_data(city="Nantes"):
+@instrumented
+def create_snapshot_view(con):
     """
-    Consolidates station statement data for Nantes or Toulouse by processing real-time
-    bicycle data and inserting it into the CONSOLIDATE_STATION_STATEMENT table.
+    Creates the STATION_STATEMENT_SNAPSHOT view over every Parquet snapshot file,
+    exposing the snapshot_date partition as a column so date filters prune files.
+    Does nothing until the first snapshot is written.
 
     Args:
-        city (str): The city name for consolidation ('Nantes' or 'Toulouse').
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
     """
-    con = duckdb.connect(
-        database="data/duckdb/mobility_analysis.duckdb", read_only=False
-    )
+    if not os.path.isdir(SNAPSHOT_DIRECTORY):
+        return
 
-    city_code = NANTES_CITY_CODE
+    con.execute(f"""
+    CREATE OR REPLACE VIEW STATION_STATEMENT_SNAPSHOT AS
+    SELECT *
+    FROM read_parquet('{SNAPSHOT_DIRECTORY}/*/*.parquet', hive_partitioning = true)
+    """)
 
-    # Add city-specific identifiers
-    if city == "Toulouse":
-        city_code = TOULOUSE_CITY_CODE
 
-    json_path = f"data/raw_data/{today_date}/{city.lower()}_realtime_bicycle_data.json"
+@instrumented
+def stage_format_cities(con, feed_format, cities=None, raw_files=None):
+    """
+    Stages the feeds of the cities of a format in bulk, see `stage_feed_format`.
+    When the bulk read fails, every city is read on its own to find the broken
+    feeds, then the other cities are staged again in bulk: a broken feed only
+    fails its own city. Must run outside a transaction, as a failed read aborts
+    the transaction it runs in.
 
-    # Insert data into database
-    con.execute(f"""
-    INSERT OR REPLACE INTO CONSOLIDATE_STATION_STATEMENT
-    SELECT 
-        '{city_code}' || '-' || number AS station_id,
-        available_bike_stands AS bicycle_docks_available,
-        available_bikes AS bicycle_available,
-        last_update AS last_statement_date,
-        CURRENT_date AS created_date,
-    FROM read_json(
-        '{json_path}',
-        columns = {{
-            number: 'INTEGER',
-            available_bike_stands: 'INTEGER',
-            available_bikes: 'INTEGER',
-            last_update: 'DATE',
-    }})
-    """)
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        feed_format (str): The feed format, from FEED_FORMATS.
+        cities (list[str] | None): Only these cities, all the cities of the format if None.
+        raw_files (dict | None): Raw files of past days to stage instead of the
+            current run's, by source file name.
+
+    Returns:
+        dict: The error of each city whose feeds could not be staged.
+    """
+    if feed_format not in FEED_FORMATS:
+        raise ValueError(f"Unknown feed format: {feed_format}")
+
+    format_cities = cities_of_format(feed_format, cities)
+    try:
+        stage_feed_format(con, feed_format, cities, raw_files)
+        return {}
+    except duckdb.Error as e:
+        if len(format_cities) == 1:
+            raise
+        logging.warning(f"{feed_format} bulk staging failed, staging city by city: {e}")
+
+    failed_cities = {}
+    for city in format_cities:
+        try:
+            FORMAT_STAGING_FUNCTIONS[feed_format](con, [city], raw_files)
+        except duckdb.Error as e:
+            logging.error(f"{city['name']} staging failed: {e}")
+            failed_cities[city["name"]] = repr(e)
+
+    staged = [city["name"] for city in format_cities if city["name"] not in failed_cities]
+    if not staged:
+        raise RuntimeError(f"No {feed_format} city could be staged: {failed_cities}")
+
+    stage_feed_format(con, feed_format, staged, raw_files)
+    return failed_cities
+
+
+@instrumented
+def consolidate_staged_format(con, feed_format, cities=None, failed_cities=None):
+    """
+    Consolidates the stations and station statements staged for a format, with one
+    query per step whatever the number of cities. In snapshot mode, the caller
+    appends the statements to the snapshot store once this is committed.
 
-    logging.info(f"{city} Station Statement data consolidated successfully.")
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        feed_format (str): The feed format, from FEED_FORMATS.
+        cities (list[str] | None): Only these cities, all the cities of the format if None.
+        failed_cities (dict | None): The cities that could not be staged, skipped.
+
+    Returns:
+        dict: The error of each city that could not be staged.
+    """
+    failed_cities = failed_cities or {}
+    staged = [
+        city["name"]
+        for city in cities_of_format(feed_format, cities)
+        if city["name"] not in failed_cities
+    ]
 
+    # Keys are given in the transaction: concurrent stagings of the same stations
+    # would otherwise insert them twice
+    assign_station_keys(con, staging_table(feed_format))
+    consolidate_station(con, feed_format, staged)
+    consolidate_station_statement(con, feed_format)
 
-def consolidate_station_statement_data():
+    return failed_cities
+
+
+@instrumented
+def consolidate_feed_format(con, feed_format, snapshot_ts=None, raw_files=None, cities=None):
     """
-    Consolidates station statement data for all cities: Paris, Nantes, Toulouse, and Montpellier.
+    Stages the real-time feeds of every city of a format, then consolidates their
+    stations and station statements from it in a single transaction, appending the
+    statements to the snapshot store once it is committed. A city whose feeds
+    cannot be read is left out, the others are still consolidated.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection, outside a transaction.
+        feed_format (str): The feed format, from FEED_FORMATS.
+        snapshot_ts (datetime | None): Run timestamp; in snapshot mode the statements
+            are also appended to the snapshot store.
+        raw_files (dict | None): Raw files of past days to consolidate instead of the
+            current run's, by source file name.
+        cities (list[str] | None): Only these cities, all the cities of the format if None.
+
+    Returns:
+        dict: The error of each city that could not be staged.
     """
-    consolidate_station_statement_paris_data()
-    consolidate_station_statement_nantes_toulouse_data("Nantes")
-    consolidate_station_statement_nantes_toulouse_data("Toulouse")
-    consolidate_station_statement_montpellier_data()
+    failed_cities = stage_format_cities(con, feed_format, cities, raw_files)
+    with transaction(con):
+        consolidate_staged_format(con, feed_format, cities, failed_cities)
+
+    if SNAPSHOT_MODE and snapshot_ts is not None:
+        snapshot_station_statement_data(con, feed_format, snapshot_ts)
+
+    return failed_cities
@@ -1,74 +1,400 @@
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+import gzip
+import hashlib
 import json
 import logging
 import os
+import threading
+import time
 
 import requests
+from requests.adapters import HTTPAdapter
 
-def get_realtime_bicycle_data():
-    """
-    Fetches real-time bicycle data from predefined URLs and serializes it to corresponding files.
-    """
-    datasets = [
-        (
-            "https://opendata.paris.fr/api/explore/v2.1/catalog/datasets/velib-disponibilite-en-temps-reel/exports/json",
-            "paris_realtime_bicycle_data.json",
-        ),
-        (
-            "https://data.nantesmetropole.fr/api/explore/v2.1/catalog/datasets/244400404_stations-velos-libre-service-nantes-metropole-disponibilites/exports/json?lang=fr&timezone=Europe%2FBerlin",
-            "nantes_realtime_bicycle_data.json",
-        ),
-        (
-            "https://data.toulouse-metropole.fr/api/explore/v2.1/catalog/datasets/api-velo-toulouse-temps-reel/exports/json?lang=fr&timezone=Europe%2FParis",
-            "toulouse_realtime_bicycle_data.json",
-        ),
-        (
-            "https://montpellier-fr.fifteen.site/gbfs/en/station_status.json",
-            "montpellier_realtime_bicycle_station_status_data.json",
-        ),
-        (
-            "https://montpellier-fr.fifteen.site/gbfs/en/station_information.json",
-            "montpellier_realtime_bicycle_station_information_data.json",
-        ),
+from city_registry import city_of_source, get_city_registry
+from etl_metrics import instrumented, record_metric
+
+# Opendatasoft exports can be requested as newline-delimited JSON ("jsonl"),
+# which read_json detects on its own and scans without materializing one big array
+OPENDATASOFT_EXPORT_FORMAT = os.environ.get("OPENDATASOFT_EXPORT_FORMAT", "json")
+
+COMMUNE_DATASETS = [
+    ("https://geo.api.gouv.fr/communes", "commune_data.json"),
+]
+
+# (connect, read) timeouts in seconds. The read timeout of the city feeds is set
+# in the registry, these sources override the default.
+REQUEST_TIMEOUT = (5, 60)
+SOURCE_TIMEOUTS = {
+    "commune_data.json": (5, 120),
+}
+MAX_ATTEMPTS = 3
+BACKOFF_SECONDS = 1.0
+MAX_WORKERS = 6
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Response bodies are streamed to disk in chunks of this size and stored gzipped
+CHUNK_SIZE = 64 * 1024
+GZIP_COMPRESS_LEVEL = 6
+
+# In snapshot mode every run gets its own raw directory, data/raw_data/<date>/<HHMMSS>,
+# instead of one directory per day overwritten by each run of the day
+SNAPSHOT_MODE = os.environ.get("ETL_SNAPSHOT_MODE", "0") == "1"
+
+# Per-source ETag/Last-Modified, content hash and path of the latest stored snapshot
+MANIFEST_FILE = "data/raw_data/manifest.json"
+_manifest_lock = threading.Lock()
+
+
+def realtime_bicycle_datasets():
+    """
+    Returns the (url, file name) of the feeds of every city of the registry.
+    """
+    return [
+        (url.format(export_format=OPENDATASOFT_EXPORT_FORMAT), file_name)
+        for city in get_city_registry()
+        for url, file_name in city["feeds"].values()
     ]
 
-    for url, file_name in datasets:
+
+def source_timeout(file_name):
+    """
+    Returns the (connect, read) timeouts of a source.
+
+    Args:
+        file_name (str): The source file name.
+    """
+    if file_name in SOURCE_TIMEOUTS:
+        return SOURCE_TIMEOUTS[file_name]
+
+    try:
+        return (REQUEST_TIMEOUT[0], city_of_source(file_name)["read_timeout"])
+    except ValueError:
+        return REQUEST_TIMEOUT
+
+
+def create_session(pool_size: int = MAX_WORKERS) -> requests.Session:
+    """
+    Creates an HTTP session whose connection pool is shared by all fetch threads,
+    so connections to the same host are kept alive and reused.
+
+    Args:
+        pool_size (int): Maximum number of pooled connections per host.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def fetch_dataset(
+    session: requests.Session,
+    url: str,
+    file_name: str,
+    timeout=REQUEST_TIMEOUT,
+    max_attempts: int = MAX_ATTEMPTS,
+    previous: dict | None = None,
+    run_at: datetime | None = None,
+    directory: str | None = None,
+) -> dict:
+    """
+    Fetches one dataset and serializes it to its file. Connection errors, timeouts
+    and retryable status codes are retried with exponential backoff; a 404 produces
+    an empty dataset.
+
+    When the previous snapshot of the source is still on disk, the request is made
+    conditional on its ETag/Last-Modified, and a body whose hash matches the previous
+    one is not written again. In both cases the source is reported as unchanged.
+
+    Args:
+        session (requests.Session): The shared HTTP session.
+        url (str): The dataset URL.
+        file_name (str): The name of the file to save the data.
+        timeout: Requests timeout, either a number or a (connect, read) tuple.
+        max_attempts (int): Maximum number of attempts.
+        previous (dict | None): The manifest entry of the previous fetch.
+        run_at (datetime | None): Start time of the ETL run, used for the raw directory.
+        directory (str | None): Directory to write to instead of the raw directory.
+
+    Returns:
+        dict: Fetch metrics for the source (status, latency, bytes received and
+            written compressed to disk, attempts) and its new manifest entry.
+    """
+    start = time.perf_counter()
+    previous = previous or {}
+    has_previous_snapshot = bool(previous.get("path")) and os.path.exists(previous["path"])
+
+    headers = {}
+    if has_previous_snapshot:
+        if previous.get("etag"):
+            headers["If-None-Match"] = previous["etag"]
+        if previous.get("last_modified"):
+            headers["If-Modified-Since"] = previous["last_modified"]
+
+    for attempt in range(1, max_attempts + 1):
         try:
-            response = requests.request("GET", url)
-            response.raise_for_status()  # Raise an error for bad status codes
-            serialize_data(response.text, file_name)
-        except requests.exceptions.HTTPError as e:
-            if response.status_code == 404:
-                logging.warning(f"{url} not found (404). Creating empty dataset.")
-                serialize_data(json.dumps([]), file_name)  # fichier vide
-            else:
+            response = session.get(url, headers=headers, timeout=timeout, stream=True)
+            if (
+                response.status_code in RETRYABLE_STATUS_CODES
+                and attempt < max_attempts
+            ):
+                response.close()
+                raise requests.exceptions.RetryError(
+                    f"{url} returned {response.status_code}"
+                )
+            break
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            requests.exceptions.RetryError,
+        ) as e:
+            if attempt == max_attempts:
                 raise
+            delay = BACKOFF_SECONDS * 2 ** (attempt - 1)
+            logging.warning(f"{url} attempt {attempt} failed ({e}), retrying in {delay}s.")
+            time.sleep(delay)
+
+    entry = {
+        **previous,
+        "url": url,
+        "checked_at": datetime.now(timezone.utc).isoformat(),
+    }
+
+    with response:
+        if response.status_code == 304:
+            logging.info(f"{file_name}: not modified since last fetch.")
+            chunks = None
+        elif response.status_code == 404:
+            logging.warning(f"{url} not found (404). Creating empty dataset.")
+            chunks = [json.dumps([]).encode("utf-8")]  # fichier vide
+        else:
+            response.raise_for_status()  # Raise an error for bad status codes
+            chunks = response.iter_content(chunk_size=CHUNK_SIZE)
+            entry["etag"] = response.headers.get("ETag")
+            entry["last_modified"] = response.headers.get("Last-Modified")
+
+        if chunks is not None:
+            path, content_hash, size = serialize_stream(
+                chunks,
+                file_name,
+                previous.get("sha256") if has_previous_snapshot else None,
+                run_at,
+                directory,
+            )
+        else:
+            path, content_hash, size = None, previous.get("sha256"), 0
 
+    metrics = {
+        "file_name": file_name,
+        "url": url,
+        "status_code": response.status_code,
+        "attempts": attempt,
+        "latency_seconds": round(time.perf_counter() - start, 3),
+        "bytes_received": size,
+        "bytes_written": os.path.getsize(path) if path else 0,
+    }
 
-def get_commune_data():
+    if path is None:
+        if chunks is not None:
+            logging.info(f"{file_name}: content unchanged since last fetch, write skipped.")
+        return {**metrics, "changed": False, "manifest_entry": {**entry, "changed": False}}
+
+    entry.update(
+        {
+            "sha256": content_hash,
+            "path": path,
+            "changed": True,
+            "changed_at": entry["checked_at"],
+        }
+    )
+
+    logging.info(
+        f"{file_name}: {metrics['bytes_received']} bytes in {metrics['latency_seconds']}s "
+        f"({metrics['attempts']} attempt(s))"
+    )
+    return {**metrics, "changed": True, "manifest_entry": entry}
+
+
+@instrumented
+def fetch_datasets(
+    datasets, max_workers: int = MAX_WORKERS, run_at: datetime | None = None
+) -> list[dict]:
     """
-    Fetches commune data from a predefined URL and serializes it to a file.
+    Fetches datasets concurrently on a thread pool sharing one pooled session.
+    Every source is fetched even if another one fails; the first error is raised
+    once all of them are done.
+
+    Args:
+        datasets (list[tuple[str, str]]): (url, file_name) pairs.
+        max_workers (int): Number of concurrent fetches.
+        run_at (datetime | None): Start time of the ETL run, used for the raw directory.
+
+    Returns:
+        list[dict]: Fetch metrics for each source.
     """
-    url = "https://geo.api.gouv.fr/communes"
-    file_name = "commune_data.json"
-    response = requests.request("GET", url)
-    response.raise_for_status()
-    serialize_data(response.text, file_name)
+    results = []
+    errors = []
+    manifest = read_manifest()
+
+    with create_session(max_workers) as session:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(
+                    fetch_dataset,
+                    session,
+                    url,
+                    file_name,
+                    source_timeout(file_name),
+                    previous=manifest.get(file_name),
+                    run_at=run_at,
+                ): (url, file_name)
+                for url, file_name in datasets
+            }
+            for future in as_completed(futures):
+                url, file_name = futures[future]
+                try:
+                    result = future.result()
+                    manifest[result["file_name"]] = result.pop("manifest_entry")
+                    results.append(result)
+                    record_metric(
+                        file_name,
+                        "fetch",
+                        datetime.now() - timedelta(seconds=result["latency_seconds"]),
+                        result["latency_seconds"],
+                        str(result["status_code"]),
+                        bytes_read=result["bytes_received"],
+                        bytes_written=result["bytes_written"],
+                    )
+                except Exception as e:
+                    logging.error(f"Failed to fetch {url}: {e}")
+                    errors.append(e)
+                    record_metric(file_name, "fetch", datetime.now(), 0, "failed")
+
+    update_manifest(manifest)
+
+    if errors:
+        raise errors[0]
+
+    return results
 
 
-def serialize_data(raw_json: str, file_name: str):
+@instrumented
+def get_all_data(run_at: datetime | None = None):
     """
-    Saves raw JSON data to a file, creating directories as needed.
+    Fetches the real-time bicycle data and the commune data in a single concurrent
+    batch, so ingestion takes about as long as the slowest source.
 
     Args:
-        raw_json (str): The raw JSON data to save.
-        file_name (str): The name of the file to save the data.
+        run_at (datetime | None): Start time of the ETL run, used for the raw directory.
+    """
+    return fetch_datasets(realtime_bicycle_datasets() + COMMUNE_DATASETS, run_at=run_at)
+
+
+def read_manifest() -> dict:
+    """
+    Reads the ingestion manifest.
+
+    Returns:
+        dict: Manifest entries keyed by file name, empty if nothing was fetched yet.
+    """
+    try:
+        with open(MANIFEST_FILE, encoding="utf-8") as fd:
+            return json.load(fd)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def update_manifest(entries: dict):
+    """
+    Merges entries into the ingestion manifest and atomically rewrites it.
+
+    Args:
+        entries (dict): Manifest entries keyed by file name.
+    """
+    with _manifest_lock:
+        manifest = read_manifest()
+        manifest.update(entries)
+        os.makedirs(os.path.dirname(MANIFEST_FILE), exist_ok=True)
+        tmp_file = f"{MANIFEST_FILE}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as fd:
+            json.dump(manifest, fd, indent=2)
+        os.replace(tmp_file, MANIFEST_FILE)
+
+
+def raw_data_path(file_name: str) -> str:
     """
-    today_date = datetime.now().strftime("%Y-%m-%d")
-    directory = f"data/raw_data/{today_date}"
+    Returns the path of the latest stored snapshot of a source. Unchanged sources
+    are not written again, so this may be a previous day's directory.
+
+    Args:
+        file_name (str): The name of the source file.
+    """
+    entry = read_manifest().get(file_name)
+    if entry and entry.get("path") and os.path.exists(entry["path"]):
+        return entry["path"]
+
+    return f"{raw_data_directory()}/{file_name}.gz"
+
+
+def raw_data_directory(run_at: datetime | None = None) -> str:
+    """
+    Returns the raw data directory of a run: one directory per day, or per run
+    timestamp within its day directory in snapshot mode.
+
+    Args:
+        run_at (datetime | None): Start time of the ETL run, defaults to now.
+    """
+    run_at = run_at or datetime.now()
+    directory = f"data/raw_data/{run_at:%Y-%m-%d}"
+    if SNAPSHOT_MODE:
+        directory = f"{directory}/{run_at:%H%M%S}"
+
+    return directory
+
+
+def serialize_stream(
+    chunks,
+    file_name: str,
+    previous_hash: str | None = None,
+    run_at: datetime | None = None,
+    directory: str | None = None,
+):
+    """
+    Streams raw JSON chunks into a gzip-compressed file, creating directories as
+    needed. Only one chunk is held in memory at a time, and the content is hashed
+    on the fly: when it matches `previous_hash` the file is discarded.
+
+    Args:
+        chunks (Iterable[bytes]): The raw JSON body, chunk by chunk.
+        file_name (str): The name of the source file, stored as `<file_name>.gz`.
+        previous_hash (str | None): SHA-256 of the previously stored content.
+        run_at (datetime | None): Start time of the ETL run, used for the raw directory.
+        directory (str | None): Directory to write to instead of the raw directory.
+
+    Returns:
+        tuple[str | None, str, int]: The path of the written file (None when the
+            content is unchanged), the SHA-256 of the content and its size in bytes.
+    """
+    directory = directory or raw_data_directory(run_at)
+
+    os.makedirs(directory, exist_ok=True)
+
+    path = f"{directory}/{file_name}.gz"
+    tmp_path = f"{path}.tmp"
+    digest = hashlib.sha256()
+    size = 0
+
+    with gzip.open(tmp_path, "wb", compresslevel=GZIP_COMPRESS_LEVEL) as fd:
+        for chunk in chunks:
+            digest.update(chunk)
+            size += len(chunk)
+            fd.write(chunk)
 
-    if not os.path.exists(directory):
-        os.makedirs(directory)
+    content_hash = digest.hexdigest()
+    if content_hash == previous_hash:
+        os.remove(tmp_path)
+        return None, content_hash, size
 
-    with open(f"{directory}/{file_name}", "w", encoding="utf-8") as fd:
-        fd.write(raw_json)
+    os.replace(tmp_path, path)
+    return path, content_hash, size
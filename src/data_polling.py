@@ -0,0 +1,239 @@
+from datetime import datetime
+import logging
+import os
+import time
+
+from city_registry import city_of_source, get_city_registry
+from data_consolidation import assign_station_keys, stage_feed_format, staging_table
+from data_ingestion import fetch_dataset, realtime_bicycle_datasets, source_timeout
+from database import connect, transaction
+
+# Polling mode: between two ETL runs, the station status feeds are polled on their
+# own schedule and only the stations whose status changed are appended to DuckDB
+POLLING_MODE = os.environ.get("ETL_POLLING_MODE", "0") == "1"
+# Poll interval of the feeds that publish no TTL (Opendatasoft exports)
+POLL_INTERVAL_SECONDS = int(os.environ.get("POLL_INTERVAL_SECONDS", 60))
+# Shortest interval between two polls of a feed, whatever its TTL
+POLL_MIN_INTERVAL_SECONDS = int(os.environ.get("POLL_MIN_INTERVAL_SECONDS", 10))
+# Days of station status changes kept, older changes are deleted by the compaction
+STATUS_CHANGE_RETENTION_DAYS = int(os.environ.get("STATUS_CHANGE_RETENTION_DAYS", 7))
+
+# Latest polled body of each feed, kept apart from the raw data of the ETL runs
+POLLING_DIRECTORY = "data/polling"
+
+# Feeds polled for station status changes: the real-time feed of each city, the
+# station status feed of the GBFS cities, polled according to the ttl it publishes
+POLLED_FEEDS = ("realtime", "station_status")
+
+
+def polled_feeds():
+    """
+    Returns the (url, file name) of the feeds of the registry polled for station
+    status changes.
+    """
+    file_names = {
+        file_name
+        for city in get_city_registry()
+        for feed, (_, file_name) in city["feeds"].items()
+        if feed in POLLED_FEEDS
+    }
+    return [
+        (url, file_name)
+        for url, file_name in realtime_bicycle_datasets()
+        if file_name in file_names
+    ]
+
+
+def stage_polled_feed(con, file_name, path):
+    """
+    Stages a polled feed with the staging function of its format, and returns the
+    query of the station status it gives.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        file_name (str): The source file name.
+        path (str): The polled file.
+    """
+    if file_name not in {polled for _, polled in polled_feeds()}:
+        raise ValueError(f"Unknown polled feed: {file_name}")
+
+    city = city_of_source(file_name)
+    stage_feed_format(con, city["format"], [city["name"]], {file_name: [path]})
+    assign_station_keys(con, staging_table(city["format"]))
+
+    return f"""
+    SELECT
+        station_key AS STATION_ID,
+        bicycle_docks_available AS BICYCLE_DOCKS_AVAILABLE,
+        bicycle_available AS BICYCLE_AVAILABLE,
+        last_statement_date AS LAST_STATEMENT_DATE
+    FROM {staging_table(city["format"])}
+    """
+
+
+def append_status_changes(con, file_name, path, polled_at):
+    """
+    Compares a polled feed with the latest status of its stations and appends the
+    stations whose counts or last statement changed to STATION_STATUS_CHANGE, in a
+    single micro-batch. STATION_STATUS_LATEST is updated with the same rows.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        file_name (str): The source file name.
+        path (str): The polled file.
+        polled_at (datetime): The poll time.
+
+    Returns:
+        int: Number of stations whose status changed.
+    """
+    with transaction(con):
+        statuses = stage_polled_feed(con, file_name, path)
+        con.execute(f"""
+        CREATE OR REPLACE TEMP TABLE POLL_CHANGES AS
+        SELECT n.*
+        FROM ({statuses}) AS n
+        LEFT JOIN STATION_STATUS_LATEST AS l ON l.STATION_ID = n.STATION_ID
+        WHERE l.STATION_ID IS NULL
+            OR n.LAST_STATEMENT_DATE IS DISTINCT FROM l.LAST_STATEMENT_DATE
+            OR n.BICYCLE_AVAILABLE IS DISTINCT FROM l.BICYCLE_AVAILABLE
+            OR n.BICYCLE_DOCKS_AVAILABLE IS DISTINCT FROM l.BICYCLE_DOCKS_AVAILABLE;
+        """)
+        con.execute("""
+        INSERT INTO STATION_STATUS_CHANGE BY NAME
+        SELECT *, $polled_at AS POLLED_AT FROM POLL_CHANGES;
+        """, {"polled_at": polled_at})
+        con.execute("""
+        INSERT OR REPLACE INTO STATION_STATUS_LATEST BY NAME
+        SELECT *, $polled_at AS POLLED_AT FROM POLL_CHANGES;
+        """, {"polled_at": polled_at})
+
+    return con.execute("SELECT COUNT(*) FROM POLL_CHANGES").fetchone()[0]
+
+
+def prune_status_changes(con, retention_days=STATUS_CHANGE_RETENTION_DAYS):
+    """
+    Deletes the station status changes polled more than `retention_days` days ago.
+    STATION_STATUS_LATEST, one row per station, is kept.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        retention_days (int): Number of days of changes kept.
+
+    Returns:
+        int: Number of changes deleted.
+    """
+    nb_deleted = con.execute(f"""
+    DELETE FROM STATION_STATUS_CHANGE
+    WHERE POLLED_AT < now()::TIMESTAMP - INTERVAL {retention_days} DAY
+    """).fetchone()[0]
+
+    logging.info(f"{nb_deleted} station status changes deleted.")
+    return nb_deleted
+
+
+def read_gbfs_ttl(con, path):
+    """
+    Returns the ttl published by a GBFS feed, the number of seconds its content
+    stays valid.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        path (str): The polled file.
+    """
+    return con.execute(
+        f"SELECT ttl FROM read_json('{path}', columns = {{ttl: 'INTEGER'}})"
+    ).fetchone()[0]
+
+
+def poll_feed(con, session, url, file_name, previous=None):
+    """
+    Polls a feed: a conditional request on the ETag/Last-Modified of the previous
+    poll, then, when the content changed, the micro-batch of the stations whose
+    status changed.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        session (requests.Session): The shared HTTP session.
+        url (str): The feed URL.
+        file_name (str): The source file name.
+        previous (dict | None): The state of the previous poll.
+
+    Returns:
+        dict: The state of the poll, with the number of stations changed and the
+            interval until the next poll.
+    """
+    previous = previous or {}
+    polled_at = datetime.now()
+    result = fetch_dataset(
+        session,
+        url,
+        file_name,
+        source_timeout(file_name),
+        max_attempts=1,
+        previous=previous,
+        # Dated directory, the staging queries read the date from the path
+        directory=f"{POLLING_DIRECTORY}/{polled_at.strftime('%Y-%m-%d')}",
+    )
+    state = result["manifest_entry"]
+    state["interval_seconds"] = previous.get("interval_seconds", POLL_INTERVAL_SECONDS)
+    state["nb_changes"] = 0
+
+    if result["changed"]:
+        state["nb_changes"] = append_status_changes(con, file_name, state["path"], polled_at)
+        # Only the latest body of a feed is kept
+        previous_path = previous.get("path")
+        if previous_path and previous_path != state["path"] and os.path.exists(previous_path):
+            os.remove(previous_path)
+        if city_of_source(file_name)["format"] == "gbfs":
+            ttl = read_gbfs_ttl(con, state["path"])
+            state["interval_seconds"] = POLL_INTERVAL_SECONDS if ttl is None else ttl
+
+    state["interval_seconds"] = max(state["interval_seconds"], POLL_MIN_INTERVAL_SECONDS)
+    logging.info(
+        f"{file_name}: {state['nb_changes']} stations changed, "
+        f"next poll in {state['interval_seconds']}s."
+    )
+    return state
+
+
+def poll_due_feeds(session, feeds):
+    """
+    Polls the feeds whose next poll time has come. A failing feed is logged and
+    polled again after its interval.
+
+    Args:
+        session (requests.Session): The shared HTTP session.
+        feeds (dict): The state of each feed by file name, updated in place with
+            the time of its next poll (time.monotonic).
+
+    Returns:
+        float: The time of the next poll due (time.monotonic).
+    """
+    polled = polled_feeds()
+    due = [
+        (url, file_name)
+        for url, file_name in polled
+        if feeds.get(file_name, {}).get("next_poll_at", 0) <= time.monotonic()
+    ]
+
+    if due:
+        # Connection opened for the polls only, the refresher may replace the
+        # database file while compacting it
+        with connect() as con:
+            for url, file_name in due:
+                previous = feeds.get(file_name, {})
+                try:
+                    state = poll_feed(con, session, url, file_name, previous)
+                except Exception as e:
+                    logging.error(f"Polling {file_name} failed: {e}")
+                    state = {
+                        **previous,
+                        "interval_seconds": previous.get("interval_seconds", POLL_INTERVAL_SECONDS),
+                    }
+                state["next_poll_at"] = time.monotonic() + state["interval_seconds"]
+                feeds[file_name] = state
+
+    return min(
+        feeds.get(file_name, {}).get("next_poll_at", 0)
+        for _, file_name in polled
+    )
@@ -0,0 +1,84 @@
+import glob
+import logging
+import os
+
+from database import PUBLISHED_DIRECTORY, published_database_path
+
+# Publish mode: after each run the star schema is copied into a new database file
+# that the dashboard reads, so it never opens the database the ETL writes to
+PUBLISH_MODE = os.environ.get("ETL_PUBLISH_MODE", "1") == "1"
+# Number of published versions kept, readers may still use the previous ones
+PUBLISHED_VERSIONS_KEPT = int(os.environ.get("PUBLISHED_VERSIONS_KEPT", 3))
+# Number of runs whose metrics are published, the ones the dashboard plots
+PUBLISHED_METRICS_RUNS = int(os.environ.get("PUBLISHED_METRICS_RUNS", 50))
+
+# Tables read by the dashboard: the dimensions and the rollups, small whatever the
+# history, the fact table staying in the ETL database
+PUBLISHED_TABLES = [
+    "DIM_CITY",
+    "DIM_STATION",
+    "DIM_STATION_GRID",
+    "AGG_STATION",
+    "AGG_STATION_DAILY",
+    "AGG_CITY_LATEST",
+    "AGG_STATION_LATEST",
+    "ETL_RUN_METRICS",
+]
+
+# Rows published of the tables that grow with every run
+PUBLISHED_ROWS = {
+    "ETL_RUN_METRICS": f"""
+    WHERE RUN_AT IN (
+        SELECT DISTINCT RUN_AT FROM ETL_RUN_METRICS ORDER BY RUN_AT DESC LIMIT {PUBLISHED_METRICS_RUNS}
+    )
+    """,
+}
+
+
+def publish_database(con, run_id):
+    """
+    Copies the dimensions, the rollups and the metrics of the last runs into a new
+    database file for the run. The file is
+    written under a temporary name and renamed once complete, so it is never read
+    half-written; it is not modified afterwards. Readers switch to it when the run
+    is recorded in the ETL state.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        run_id (str): The ETL run.
+
+    Returns:
+        str: The published database file.
+    """
+    published_path = published_database_path(run_id)
+    tmp_path = f"{published_path}.tmp"
+    os.makedirs(PUBLISHED_DIRECTORY, exist_ok=True)
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    con.execute(f"ATTACH '{tmp_path}' AS published")
+    try:
+        for table_name in PUBLISHED_TABLES:
+            con.execute(f"""
+            CREATE TABLE published.{table_name} AS
+            SELECT * FROM {table_name} {PUBLISHED_ROWS.get(table_name, "")}
+            """)
+    finally:
+        con.execute("DETACH published")
+
+    os.replace(tmp_path, published_path)
+    logging.info(f"Star schema published to {published_path}.")
+    return published_path
+
+
+def remove_old_publications(keep=PUBLISHED_VERSIONS_KEPT):
+    """
+    Deletes the published database files older than the `keep` latest ones.
+
+    Args:
+        keep (int): Number of published versions kept.
+    """
+    # Run ids are UTC timestamps, so file names sort by date
+    published_paths = sorted(glob.glob(f"{PUBLISHED_DIRECTORY}/*.duckdb"))
+    for path in published_paths[:-keep]:
+        os.remove(path)
@@ -1,105 +1,156 @@
-import duckdb
+from datetime import datetime, timezone
+
+import pyarrow.compute as pc
 import streamlit as st
 
+from dashboard_data import (
+    DETAIL_ZOOM,
+    MAP_HEIGHT_PX,
+    MAP_WIDTH_PX,
+    get_avg_bikes_histogram,
+    get_cities,
+    get_docks_by_city,
+    get_map_center,
+    get_map_points,
+    get_nearest_stations,
+    get_slowest_functions,
+    get_stage_timings,
+    get_station_count,
+    get_station_summary,
+    get_top_stations,
+    viewport_bounds,
+)
+from etl_state import read_etl_state
+
+
+def show_data_freshness(etl_state: dict):
+    """
+    Displays when the background refresher last loaded data successfully.
+
+    Args:
+        etl_state (dict): The ETL freshness marker.
+    """
+    last_success_at = datetime.fromisoformat(etl_state["last_success_at"])
+    age_minutes = int((datetime.now(timezone.utc) - last_success_at).total_seconds() // 60)
+    st.caption(
+        f"🕒 Data last refreshed {last_success_at:%Y-%m-%d %H:%M} UTC ({age_minutes} min ago)"
+    )
+
+    if etl_state.get("last_error"):
+        st.warning(f"The last data refresh failed, showing previous data: {etl_state['last_error']}")
+
+    if etl_state.get("failed_cities"):
+        st.warning(
+            "Some cities could not be refreshed and show previous data: "
+            + ", ".join(etl_state["failed_cities"])
+        )
+
+
 def mobility_analysis_dashboard():
 
     import plotly.express as px
 
     st.title("🚲 Bicycle Station Data Visualization From Some French Cities")
 
-    # Global ETL loading message
-    with st.spinner("⏳ Please wait while the ETL process is running and data is being prepared..."):
+    etl_state = read_etl_state()
+    if not etl_state.get("last_success_at"):
+        st.info("⏳ No data available yet, the first ETL run is in progress. Please come back in a few minutes.")
+        return
+
+    show_data_freshness(etl_state)
+
+    # Cached results are keyed on the ETL run, so a new run evicts them
+    run_id = etl_state["run_id"]
+
+    # Filters are passed to DuckDB as query parameters, only the rows
+    # each chart needs are fetched
+    cities = get_cities(run_id).to_pydict()
+    city_ids = dict(zip(cities["NAME"], cities["ID"]))
+    city_filter = st.selectbox("City", ["All", *city_ids])
+    city_id = city_ids.get(city_filter)
+
+    with st.spinner("⏳ Loading data..."):
 
         # -------------------------
         # 📍 Station Locations
         # -------------------------
         st.header("📍 Station Locations")
 
-        @st.cache_data
-        def get_data_from_duckdb():
-            con = duckdb.connect(
-                database="data/duckdb/mobility_analysis.duckdb", read_only=True
-            )
-            sql_statement = """
-            SELECT 
-                s.NAME AS station_name,
-                s.ADDRESS AS address,
-                s.STATUS AS status,
-                s.LONGITUDE AS longitude,
-                s.LATITUDE AS latitude,
-                s.CAPACITTY AS capacity
-            FROM DIM_STATION s;
-            """
-            df = con.execute(sql_statement).fetchdf()
-            return df
+        status_filter = st.selectbox("Station status", ["All", "OUI", "NON"])
+        status = None if status_filter == "All" else status_filter
+
+        # The map is drawn from clusters computed by DuckDB for the viewport,
+        # individual stations only show up once zoomed in
+        zoom = st.slider("Map zoom", min_value=4, max_value=16, value=5 if city_id is None else 12)
+        center = get_map_center(run_id, city_id)
+        bounds = viewport_bounds(center, zoom)
 
         with st.spinner("Loading station location data..."):
-            data = get_data_from_duckdb()
+            data = get_map_points(run_id, zoom, bounds, status, city_id)
 
         st.dataframe(data)
 
-        status_filter = st.selectbox("Station status", ["All", "OUI", "NON"])
+        if data.num_rows == 0:
+            st.info("No station matches the selected filters in this area.")
+        else:
+            with st.spinner("Rendering map..."):
+                fig = px.scatter_mapbox(
+                    data,
+                    lat="latitude",
+                    lon="longitude",
+                    hover_name="label",
+                    hover_data={
+                        "address": True,
+                        "nb_stations": True,
+                        "capacity": True,
+                    },
+                    size="capacity",
+                    size_max=15 if zoom >= DETAIL_ZOOM else 30,
+                    zoom=zoom,
+                    center=center,
+                    width=MAP_WIDTH_PX,
+                    height=MAP_HEIGHT_PX
+                )
+
+                fig.update_layout(
+                    mapbox_style="open-street-map",
+                    margin={"r":0,"t":0,"l":0,"b":0}
+                )
+
+                st.plotly_chart(fig, width="content")
+
+        st.metric("Number of stations", get_station_count(run_id, status, city_id))
 
-        if status_filter != "All":
-            data = data[data["status"] == status_filter]
-
-        with st.spinner("Rendering map..."):
-            fig = px.scatter_mapbox(
-                data,
-                lat="latitude",
-                lon="longitude",
-                hover_name="station_name",
-                hover_data={
-                    "address": True,
-                    "capacity": True,
-                },
-                size="capacity",
-                size_max=15,
-                zoom=5,
-                center={"lat": 46.5, "lon": 2.5},
-                height=600
-            )
+        # -------------------------
+        # 🔎 Nearest Available Bikes
+        # -------------------------
+        st.header("🔎 Nearest Available Bikes")
 
-            fig.update_layout(
-                mapbox_style="open-street-map",
-                margin={"r":0,"t":0,"l":0,"b":0}
-            )
+        col_lat, col_lon = st.columns(2)
+        latitude = col_lat.number_input("Latitude", value=round(center["lat"], 5), format="%.5f")
+        longitude = col_lon.number_input("Longitude", value=round(center["lon"], 5), format="%.5f")
+        col_k, col_bikes = st.columns(2)
+        k = col_k.slider("Number of stations", min_value=1, max_value=20, value=5)
+        min_bicycles = col_bikes.slider("Minimum bikes available", min_value=1, max_value=20, value=1)
 
-            st.plotly_chart(fig)
+        with st.spinner("Searching nearest stations..."):
+            nearest = get_nearest_stations(run_id, longitude, latitude, k, min_bicycles)
 
-        st.metric("Number of stations", len(data))
+        if nearest.num_rows == 0:
+            st.info("No station with bikes available within 50 km.")
+        else:
+            st.dataframe(nearest)
 
         # -------------------------
         # 🏙️ Available Docks by City
         # -------------------------
         st.header("🏙️ Available Docks by City")
 
-        @st.cache_data
-        def get_docks_by_city():
-            con = duckdb.connect(
-                database="data/duckdb/mobility_analysis.duckdb", read_only=True
-            )
-            
-            query = """
-            SELECT dm.NAME, tmp.SUM_BICYCLE_DOCKS_AVAILABLE
-            FROM DIM_CITY dm INNER JOIN (
-                SELECT CITY_ID, SUM(BICYCLE_DOCKS_AVAILABLE) AS SUM_BICYCLE_DOCKS_AVAILABLE
-                FROM FACT_STATION_STATEMENT
-                WHERE CREATED_DATE = (SELECT MAX(CREATED_DATE) FROM CONSOLIDATE_STATION)
-                GROUP BY CITY_ID
-            ) tmp ON dm.ID = tmp.CITY_ID
-            WHERE lower(dm.NAME) in ('paris', 'nantes', 'vincennes', 'toulouse', 'montpellier');
-            """
-            
-            return con.execute(query).fetchdf()
-
         with st.spinner("Aggregating available docks by city..."):
-            df_city = get_docks_by_city()
+            df_city = get_docks_by_city(run_id)
 
         st.dataframe(df_city)
 
-        df_city = df_city.sort_values(by="SUM_BICYCLE_DOCKS_AVAILABLE", ascending=False)
-
         with st.spinner("Building city chart..."):
             fig = px.bar(
                 df_city,
@@ -111,7 +162,7 @@ def mobility_analysis_dashboard():
 
             st.plotly_chart(fig)
 
-        total_docks = df_city["SUM_BICYCLE_DOCKS_AVAILABLE"].sum()
+        total_docks = pc.sum(df_city["SUM_BICYCLE_DOCKS_AVAILABLE"]).as_py()
         st.metric("Total available docks", total_docks)
 
         # -------------------------
@@ -119,56 +170,80 @@ def mobility_analysis_dashboard():
         # -------------------------
         st.header("🚲 Station Analysis")
 
-        @st.cache_data
-        def get_avg_bikes_per_station():
-            con = duckdb.connect(
-                database="data/duckdb/mobility_analysis.duckdb", read_only=True
-            )
-            
-            query = """
-            SELECT ds.name, ds.code, ds.address, tmp.avg_dock_available
-            FROM DIM_STATION ds JOIN (
-                SELECT station_id, AVG(BICYCLE_AVAILABLE) AS avg_dock_available
-                FROM FACT_STATION_STATEMENT
-                GROUP BY station_id
-            ) AS tmp ON ds.id = tmp.station_id;
-            """
-            
-            return con.execute(query).fetchdf()
+        top_n = st.slider("Number of top stations", min_value=5, max_value=50, value=10, step=5)
 
         with st.spinner("Computing average bikes per station..."):
-            df_station = get_avg_bikes_per_station()
+            top_stations = get_top_stations(run_id, top_n, city_id)
 
-        st.dataframe(df_station)
+        st.dataframe(top_stations)
 
         with st.spinner("Generating top stations chart..."):
-            top_stations = df_station.sort_values(
-                by="avg_dock_available",
-                ascending=False
-            ).head(10)
-
             fig_top = px.bar(
                 top_stations,
                 x="avg_dock_available",
                 y="NAME",
                 orientation="h",
-                title="Top 10 Stations (Most Bikes Available)"
+                title=f"Top {top_n} Stations (Most Bikes Available)"
             )
 
             st.plotly_chart(fig_top)
 
         with st.spinner("Generating distribution histogram..."):
-            fig_hist = px.histogram(
-                df_station,
-                x="avg_dock_available",
-                nbins=30,
-                title="Distribution of Average Bikes Available"
+            # Bins are computed by DuckDB, the chart only draws them
+            df_hist = get_avg_bikes_histogram(run_id, 30, city_id)
+
+            fig_hist = px.bar(
+                df_hist,
+                x="bin_start",
+                y="nb_stations",
+                hover_data=["bin_end"],
+                title="Distribution of Average Bikes Available",
+                labels={"bin_start": "avg_dock_available", "nb_stations": "count"}
+            )
+            fig_hist.update_traces(
+                width=pc.subtract(df_hist["bin_end"], df_hist["bin_start"]).to_pylist(),
+                offset=0
             )
 
             st.plotly_chart(fig_hist)
 
-        st.metric("Total stations", len(df_station))
-        st.metric("Average bikes per station", round(df_station["avg_dock_available"].mean(), 2))
+        summary = get_station_summary(run_id, city_id).to_pylist()[0]
+        st.metric("Total stations", summary["nb_stations"])
+        st.metric("Average bikes per station", summary["avg_dock_available"])
+
+        # -------------------------
+        # ⏱️ ETL Runs
+        # -------------------------
+        st.header("⏱️ ETL Runs")
+
+        with st.spinner("Loading run metrics..."):
+            task_timings = get_stage_timings(run_id, "task")
+            fetch_timings = get_stage_timings(run_id, "fetch")
+
+        fig_tasks = px.line(
+            task_timings,
+            x="RUN_AT",
+            y="DURATION_SECONDS",
+            color="STAGE",
+            markers=True,
+            hover_data=["ROWS_ADDED", "BYTES_READ", "STATUS"],
+            title="Pipeline Task Wall Time by Run (skipped tasks are not shown)"
+        )
+        st.plotly_chart(fig_tasks)
+
+        fig_fetch = px.line(
+            fetch_timings,
+            x="RUN_AT",
+            y="DURATION_SECONDS",
+            color="STAGE",
+            markers=True,
+            hover_data=["BYTES_READ", "BYTES_WRITTEN", "STATUS"],
+            title="Source Fetch Latency by Run"
+        )
+        st.plotly_chart(fig_fetch)
+
+        st.subheader("Slowest functions of the last run")
+        st.dataframe(get_slowest_functions(run_id))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,50 @@
+from contextlib import contextmanager
+import os
+
+import duckdb
+
+DATABASE_PATH = "data/duckdb/mobility_analysis.duckdb"
+# Read-only copies of the star schema, one per ETL run, read by the dashboard
+PUBLISHED_DIRECTORY = "data/duckdb/published"
+
+
+def connect(read_only=False):
+    """
+    Opens a connection to the mobility analysis DuckDB database. The ETL opens a
+    single connection per run and passes it (or cursors from it) to every stage.
+
+    Args:
+        read_only (bool): Open the database in read-only mode.
+    """
+    if not read_only:
+        os.makedirs(os.path.dirname(DATABASE_PATH), exist_ok=True)
+
+    return duckdb.connect(database=DATABASE_PATH, read_only=read_only)
+
+
+def published_database_path(run_id):
+    """
+    Returns the database file the star schema of an ETL run is published to.
+
+    Args:
+        run_id (str): The ETL run.
+    """
+    return f"{PUBLISHED_DIRECTORY}/mobility_{run_id}.duckdb"
+
+
+@contextmanager
+def transaction(con):
+    """
+    Runs the enclosed statements in a single explicit transaction, committed on
+    success and rolled back if any statement fails.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+    """
+    con.execute("BEGIN TRANSACTION")
+    try:
+        yield con
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    con.execute("COMMIT")
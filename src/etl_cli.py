@@ -0,0 +1,144 @@
+from datetime import datetime
+import argparse
+import logging
+import os
+import sys
+
+# Command line entry point. Stage modules are imported by the commands that use
+# them, so a scheduled ETL run never loads Streamlit. The data directory is read
+# relative to the current directory: the command runs from the project root.
+DATA_DIRECTORY = "data"
+
+
+def print_summary(summary):
+    """
+    Prints the summary of an ETL run: the published database and the cities
+    whose consolidation failed.
+
+    Args:
+        summary (dict): The summary returned by run_etl.
+    """
+    if summary["published_database"]:
+        print(f"Published database: {summary['published_database']}")
+    if not summary["failed_cities"]:
+        print("All cities consolidated.")
+        return
+    print(f"{len(summary['failed_cities'])} cities failed:")
+    for city, error in summary["failed_cities"].items():
+        print(f"  {city}: {error}")
+
+
+def ingest(args):
+    """
+    Fetches every source into the raw data directory.
+
+    Args:
+        args (argparse.Namespace): The parsed command line.
+    """
+    from data_ingestion import get_all_data
+
+    get_all_data(datetime.now())
+
+
+def consolidate(args):
+    """
+    Consolidates the cities, stations and station statements from the last
+    ingested raw data.
+
+    Args:
+        args (argparse.Namespace): The parsed command line.
+    """
+    from etl_refresher import run_etl
+
+    print_summary(run_etl(select=lambda name: name.startswith("consolidate_")))
+
+
+def aggregate(args):
+    """
+    Builds the dimensions, the fact table and the rollups from the consolidated
+    tables.
+
+    Args:
+        args (argparse.Namespace): The parsed command line.
+    """
+    from etl_refresher import run_etl
+
+    print_summary(
+        run_etl(select=lambda name: name.startswith("agregate_") or name == "build_station_grid")
+    )
+
+
+def run_all(args):
+    """
+    Runs the whole pipeline once, publishes the star schema and records the run
+    in the freshness marker read by the dashboard.
+
+    Args:
+        args (argparse.Namespace): The parsed command line.
+
+    Returns:
+        int: The exit code, 1 if the run failed.
+    """
+    from etl_refresher import refresh_once
+
+    return 0 if refresh_once() else 1
+
+
+def serve(args):
+    """
+    Starts the Streamlit dashboard.
+
+    Args:
+        args (argparse.Namespace): The parsed command line.
+    """
+    from streamlit.web import cli as streamlit_cli
+
+    sys.argv = [
+        "streamlit",
+        "run",
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py"),
+        *args.streamlit_args,
+    ]
+    return streamlit_cli.main()
+
+
+def main(argv=None):
+    """
+    Parses the command line and runs the command.
+
+    Args:
+        argv (list[str] | None): The arguments, sys.argv[1:] if None.
+
+    Returns:
+        int: The exit code.
+    """
+    parser = argparse.ArgumentParser(
+        prog="velo-etl", description="Bicycle station ETL pipeline and dashboard."
+    )
+    commands = parser.add_subparsers(required=True, metavar="command")
+    commands.add_parser("ingest", help="fetch every source").set_defaults(func=ingest)
+    commands.add_parser(
+        "consolidate", help="consolidate the last ingested data"
+    ).set_defaults(func=consolidate)
+    commands.add_parser(
+        "aggregate", help="build the star schema from the consolidated tables"
+    ).set_defaults(func=aggregate)
+    commands.add_parser(
+        "run-all", help="run the whole pipeline once and publish it"
+    ).set_defaults(func=run_all)
+    commands.add_parser(
+        "serve", help="start the dashboard, other options are passed to streamlit run"
+    ).set_defaults(func=serve)
+
+    args, streamlit_args = parser.parse_known_args(argv)
+    if streamlit_args and args.func is not serve:
+        parser.error(f"unrecognized arguments: {' '.join(streamlit_args)}")
+    if not os.path.isdir(os.path.join(DATA_DIRECTORY, "sql_statements")):
+        parser.error(f"no {DATA_DIRECTORY}/sql_statements directory, run from the project root")
+    args.streamlit_args = streamlit_args
+    logging.basicConfig(level=logging.INFO)
+    return args.func(args) or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,187 @@
+from contextlib import contextmanager
+from datetime import datetime
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+import duckdb
+
+# Profile mode: instrumented functions also record the DuckDB profile (as
+# EXPLAIN ANALYZE) of the last query they ran
+PROFILE_MODE = os.environ.get("ETL_PROFILE_MODE", "0") == "1"
+# Metrics of the runs older than this are deleted
+METRICS_RETENTION_DAYS = int(os.environ.get("METRICS_RETENTION_DAYS", 30))
+
+METRICS_COLUMNS = [
+    "TASK",
+    "STAGE",
+    "KIND",
+    "STARTED_AT",
+    "DURATION_SECONDS",
+    "STATUS",
+    "ROWS_ADDED",
+    "BYTES_READ",
+    "BYTES_WRITTEN",
+    "PROFILE",
+]
+
+# Metrics recorded by every thread since the last flush, only while a run
+# collects them (polls and backfills are not recorded)
+recorded_metrics = []
+recorded_metrics_lock = threading.Lock()
+collecting = threading.Event()
+# Pipeline task run by the current thread
+current_task = threading.local()
+
+
+def record_metric(stage, kind, started_at, duration_seconds, status="success", **values):
+    """
+    Records the metrics of a stage of the current run.
+
+    Args:
+        stage (str): The stage: task name, function or fetched source.
+        kind (str): 'task', 'function' or 'fetch'.
+        started_at (datetime): When the stage started.
+        duration_seconds (float): Wall time of the stage.
+        status (str): 'success', 'failed', or the HTTP status of a fetch.
+        values: ROWS_ADDED, BYTES_READ, BYTES_WRITTEN or PROFILE.
+    """
+    if not collecting.is_set():
+        return
+
+    metric = {
+        "TASK": getattr(current_task, "name", None),
+        "STAGE": stage,
+        "KIND": kind,
+        "STARTED_AT": started_at,
+        "DURATION_SECONDS": round(duration_seconds, 6),
+        "STATUS": status,
+        **{name.upper(): value for name, value in values.items()},
+    }
+    with recorded_metrics_lock:
+        recorded_metrics.append(metric)
+
+
+def instrumented(function):
+    """
+    Decorator recording the wall time of every call of a stage function. In
+    profile mode, the profile of the last query the function ran on its
+    connection (first argument) is recorded with it.
+
+    Args:
+        function (callable): The stage function.
+    """
+    stage = f"{function.__module__}.{function.__name__}"
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        started_at = datetime.now()
+        start = time.perf_counter()
+        status = "failed"
+        try:
+            result = function(*args, **kwargs)
+            status = "success"
+            return result
+        finally:
+            values = {}
+            if PROFILE_MODE and args and isinstance(args[0], duckdb.DuckDBPyConnection):
+                values = read_profile(args[0])
+            record_metric(stage, "function", started_at, time.perf_counter() - start, status, **values)
+
+    return wrapper
+
+
+def enable_profiling(con):
+    """
+    Enables the profiling of the queries of a connection in profile mode.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+    """
+    if PROFILE_MODE:
+        con.execute("SET enable_profiling = 'no_output'")
+
+
+def read_profile(con):
+    """
+    Returns the profile of the last query of a connection, with the bytes it read
+    and wrote.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+    """
+    try:
+        profile = con.get_profiling_information(format="json")
+    except duckdb.Error:
+        return {}
+
+    summary = json.loads(profile)
+    if "query_name" not in summary:
+        return {}
+
+    return {
+        "bytes_read": summary.get("total_bytes_read"),
+        "bytes_written": summary.get("total_bytes_written"),
+        "profile": profile,
+    }
+
+
+def flush_metrics(con, run_id, run_at):
+    """
+    Writes the metrics recorded since the last flush to ETL_RUN_METRICS.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        run_id (str | None): The ETL run.
+        run_at (datetime): Start time of the ETL run.
+    """
+    with recorded_metrics_lock:
+        metrics = recorded_metrics.copy()
+        recorded_metrics.clear()
+
+    if not metrics:
+        return
+
+    con.executemany(
+        f"""
+        INSERT INTO ETL_RUN_METRICS (RUN_ID, RUN_AT, {', '.join(METRICS_COLUMNS)})
+        VALUES (?, ?, {', '.join('?' for _ in METRICS_COLUMNS)})
+        """,
+        [
+            [run_id, run_at, *(metric.get(column) for column in METRICS_COLUMNS)]
+            for metric in metrics
+        ],
+    )
+
+
+@contextmanager
+def collecting_metrics(con, run_id, run_at):
+    """
+    Records the metrics of the stages run in the enclosed block, and writes them
+    to ETL_RUN_METRICS at the end, whether the run succeeded or not. Metrics older
+    than METRICS_RETENTION_DAYS are deleted.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        run_id (str | None): The ETL run.
+        run_at (datetime): Start time of the ETL run.
+    """
+    with recorded_metrics_lock:
+        recorded_metrics.clear()
+    collecting.set()
+    try:
+        yield
+    finally:
+        collecting.clear()
+        # Never hides the error of the run
+        try:
+            flush_metrics(con, run_id, run_at)
+            con.execute(f"""
+            DELETE FROM ETL_RUN_METRICS
+            WHERE RUN_AT < now()::TIMESTAMP - INTERVAL {METRICS_RETENTION_DAYS} DAY
+            """)
+        except duckdb.Error:
+            logging.exception("Run metrics could not be written.")
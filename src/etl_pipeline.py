@@ -0,0 +1,361 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+import hashlib
+import json
+import logging
+import os
+import time
+
+from data_ingestion import read_manifest
+from database import transaction
+from etl_metrics import current_task, enable_profiling, record_metric
+from etl_state import read_etl_state, write_etl_state
+
+# Key of the last successful run of each task, and the failed run to resume
+PIPELINE_STATE_FILE = "data/pipeline_state.json"
+# Number of tasks run concurrently, each on its own cursor, 1 runs them one by one
+PIPELINE_WORKERS = int(os.environ.get("PIPELINE_WORKERS", 4))
+
+
+def task(
+    name,
+    function,
+    inputs=(),
+    outputs=(),
+    allow_partial=False,
+    always=False,
+    prepare=None,
+    finalize=None,
+    may_fail=False,
+):
+    """
+    Declares a pipeline task. Artifacts are named "raw:<file name>" for the raw
+    files, versioned by their content hash in the ingestion manifest,
+    "table:<table name>" for the tables, versioned by the keys of the tasks
+    writing them, and "run" for the ETL run itself.
+
+    Args:
+        name (str): The task name, unique in the pipeline.
+        function (callable): Called with a cursor of the run connection, in its own
+            transaction when the task writes tables. Its result must be JSON
+            serializable.
+        inputs (list[str]): The artifacts read by the task.
+        outputs (list[str]): The artifacts written by the task.
+        allow_partial (bool): Run even if some tasks writing an input failed, as
+            long as one of them succeeded for every input.
+        always (bool): Never skip the task.
+        prepare (callable | None): Called with the cursor before the transaction of
+            the task is opened, its result being passed to `function` as second
+            argument. For reads that may fail without aborting the transaction.
+        finalize (callable | None): Called with the cursor and the result of
+            `function` once its transaction is committed. For writes outside the
+            database, which a rolled back transaction would not undo.
+        may_fail (bool): The run does not fail when the task fails, so it is not
+            recorded as resumable for it.
+
+    Returns:
+        dict: The task.
+    """
+    return {
+        "name": name,
+        "function": function,
+        "inputs": list(inputs),
+        "outputs": list(outputs),
+        "allow_partial": allow_partial,
+        "always": always,
+        "prepare": prepare,
+        "finalize": finalize,
+        "may_fail": may_fail,
+    }
+
+
+def get_resumable_run():
+    """
+    Returns the version of the failed run to resume, None if the last run did not
+    fail or was already a resumed run.
+    """
+    return read_etl_state(PIPELINE_STATE_FILE).get("resumable_run")
+
+
+def task_key(task, run_version, keys, producers, manifest):
+    """
+    Returns the key of a task: a hash of the versions of its inputs. The task is
+    skipped when its key is the one of its last successful run.
+
+    Args:
+        task (dict): The task.
+        run_version (str): The version of the "run" artifact.
+        keys (dict): The key of each task of the run, None for the failed ones.
+        producers (dict): The tasks writing each artifact.
+        manifest (dict): The ingestion manifest.
+    """
+    versions = {}
+    for artifact in task["inputs"]:
+        if artifact == "run":
+            versions[artifact] = run_version
+        elif artifact.startswith("raw:"):
+            versions[artifact] = manifest.get(artifact.removeprefix("raw:"), {}).get("sha256")
+        else:
+            versions[artifact] = [keys.get(name) for name in producers.get(artifact, [])]
+
+    return hashlib.sha256(
+        json.dumps([task["name"], versions], sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def outputs_exist(con, task):
+    """
+    Tells whether the tables written by a task exist, a migration may have dropped
+    them since its last run.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        task (dict): The task.
+    """
+    tables = [
+        artifact.removeprefix("table:")
+        for artifact in task["outputs"]
+        if artifact.startswith("table:")
+    ]
+    if not tables:
+        return True
+
+    return con.execute(
+        """
+        SELECT count(*)
+        FROM duckdb_tables()
+        WHERE database_name = current_database() AND table_name IN $tables
+        """,
+        {"tables": tables},
+    ).fetchone()[0] == len(tables)
+
+
+def count_rows(con, tables):
+    """
+    Returns the total number of rows of tables.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        tables (list[str]): The table names.
+    """
+    return con.execute(
+        f"SELECT {' + '.join(f'(SELECT count(*) FROM {table})' for table in tables)}"
+    ).fetchone()[0]
+
+
+def raw_input_bytes(task):
+    """
+    Returns the size of the raw files read by a task.
+
+    Args:
+        task (dict): The task.
+    """
+    manifest = read_manifest()
+    paths = [
+        manifest.get(artifact.removeprefix("raw:"), {}).get("path")
+        for artifact in task["inputs"]
+        if artifact.startswith("raw:")
+    ]
+    return sum(os.path.getsize(path) for path in paths if path and os.path.exists(path))
+
+
+def run_task(con, task):
+    """
+    Runs a task on its own cursor of `con`, in its own transaction when it writes
+    tables, so a failing task is rolled back without affecting the others; its
+    `prepare` step runs first, outside the transaction, and its `finalize` step
+    once the transaction is committed. Its
+    wall time, the rows it added to its tables and the size of the raw files it
+    read are recorded in the run metrics.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        task (dict): The task.
+
+    Returns:
+        The result of the task function.
+    """
+    tables = [
+        artifact.removeprefix("table:")
+        for artifact in task["outputs"]
+        if artifact.startswith("table:")
+    ]
+    cursor = con.cursor()
+    current_task.name = task["name"]
+    started_at = datetime.now()
+    start = time.perf_counter()
+    status = "failed"
+    rows_added = None
+    try:
+        enable_profiling(cursor)
+        args = [cursor]
+        if task["prepare"] is not None:
+            args.append(task["prepare"](cursor))
+        if tables:
+            with transaction(cursor):
+                rows_before = count_rows(cursor, tables)
+                result = task["function"](*args)
+                rows_added = count_rows(cursor, tables) - rows_before
+        else:
+            result = task["function"](*args)
+        if task["finalize"] is not None:
+            task["finalize"](cursor, result)
+        status = "success"
+        return result
+    finally:
+        record_metric(
+            task["name"],
+            "task",
+            started_at,
+            time.perf_counter() - start,
+            status,
+            rows_added=rows_added,
+            bytes_read=raw_input_bytes(task),
+        )
+        current_task.name = None
+        cursor.close()
+
+
+def schedule_task(
+    con, task, run_version, completed, producers, results, keys, running, executor, select=None
+):
+    """
+    Resolves a task whose upstream tasks have all finished: blocked if one of them
+    failed, skipped if its inputs are unchanged or it is not selected, otherwise
+    submitted to the executor.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        task (dict): The task.
+        run_version (str): The version of the "run" artifact.
+        completed (dict): The last successful run of each task.
+        producers (dict): The tasks writing each artifact.
+        results (dict): The result of each finished task, updated in place.
+        keys (dict): The key of each task of the run, updated in place.
+        running (dict): The task of each submitted future, updated in place.
+        executor (concurrent.futures.Executor): The executor running the tasks.
+        select (set[str] | None): The tasks to run, all of them if None.
+    """
+    name = task["name"]
+    if name in results or name in running.values():
+        return
+
+    last_run = completed.get(name, {})
+    if select is not None and name not in select:
+        # Outputs as of its last successful run
+        results[name] = {"status": "skipped", "result": last_run.get("result"), "error": None}
+        keys[name] = last_run.get("key")
+        return
+
+    upstream = [producers.get(artifact, []) for artifact in task["inputs"]]
+    if any(producer not in results for names in upstream for producer in names):
+        return
+
+    succeeded = [
+        [producer for producer in names if results[producer]["status"] in ("ran", "skipped")]
+        for names in upstream
+    ]
+    partial = any(len(ok) < len(names) for ok, names in zip(succeeded, upstream))
+    if partial and not (
+        task["allow_partial"] and all(ok for ok, names in zip(succeeded, upstream) if names)
+    ):
+        logging.warning(f"Task {name} blocked by a failed upstream task.")
+        results[name] = {"status": "blocked", "result": None, "error": None}
+        keys[name] = None
+        return
+
+    keys[name] = task_key(task, run_version, keys, producers, read_manifest())
+    if not task["always"] and last_run.get("key") == keys[name] and outputs_exist(con, task):
+        logging.info(f"Task {name} skipped, inputs unchanged.")
+        results[name] = {"status": "skipped", "result": last_run.get("result"), "error": None}
+        return
+
+    logging.info(f"Task {name} started.")
+    running[executor.submit(run_task, con, task)] = name
+
+
+def run_pipeline(
+    con, tasks, run_version, resumable=True, select=None, max_workers=PIPELINE_WORKERS
+):
+    """
+    Runs the tasks in dependency order, a task being ready once every task writing
+    one of its inputs has finished; ready tasks run concurrently. A task whose
+    inputs did not change since its last successful run, and whose tables still
+    exist, is skipped. A failed task blocks the tasks depending on it, the others
+    still run. When only some tasks are selected, the others keep the outputs of
+    their last successful run.
+
+    The key of every successful task is recorded in the pipeline state as soon as
+    it finishes. When a task fails or is blocked, unless it may fail, the run is
+    recorded as resumable: the next run reuses its run version, so the tasks that
+    succeeded are skipped and the pipeline resumes from the failed ones.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        tasks (list[dict]): The tasks, see `task`.
+        run_version (str): The version of the "run" artifact.
+        resumable (bool): Record the run as resumable if it fails.
+        select (set[str] | None): The tasks to run, all of them if None.
+        max_workers (int): Number of tasks run concurrently.
+
+    Returns:
+        dict: For each task, its status ('ran', 'skipped', 'failed' or 'blocked'),
+            its result and the error it raised.
+    """
+    state = read_etl_state(PIPELINE_STATE_FILE)
+    completed = state.setdefault("tasks", {})
+
+    producers = {}
+    for t in tasks:
+        for artifact in t["outputs"]:
+            producers.setdefault(artifact, []).append(t["name"])
+
+    results = {}
+    keys = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while len(results) < len(tasks):
+            # Skipped and blocked tasks are resolved at once, and may make other
+            # tasks ready: scan until no task changes
+            scanned = None
+            while scanned != len(results) + len(running):
+                scanned = len(results) + len(running)
+                for t in tasks:
+                    schedule_task(
+                        con, t, run_version, completed, producers, results, keys, running,
+                        executor, select,
+                    )
+
+            if len(results) == len(tasks):
+                break
+            if not running:
+                pending = {t["name"] for t in tasks} - set(results)
+                raise ValueError(f"Pipeline tasks never ready: {pending}")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logging.error(f"Task {name} failed: {e}")
+                    results[name] = {"status": "failed", "result": None, "error": e}
+                    keys[name] = None
+                    completed.pop(name, None)
+                else:
+                    logging.info(f"Task {name} ended.")
+                    results[name] = {"status": "ran", "result": result, "error": None}
+                    completed[name] = {
+                        "key": keys[name],
+                        "completed_at": datetime.now(timezone.utc).isoformat(),
+                        "result": result,
+                    }
+                write_etl_state(state, PIPELINE_STATE_FILE)
+
+    failed = any(
+        results[t["name"]]["status"] in ("failed", "blocked") and not t["may_fail"]
+        for t in tasks
+    )
+    state["resumable_run"] = run_version if failed and resumable else None
+    write_etl_state(state, PIPELINE_STATE_FILE)
+    return results
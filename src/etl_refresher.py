@@ -0,0 +1,374 @@
+from datetime import datetime, timedelta, timezone
+import logging
+import os
+import time
+
+from data_agregation import (
+    create_agregate_tables,
+    agregate_dim_city,
+    agregate_dim_station,
+    agregate_fact_station_statements,
+    agregate_rollups,
+)
+from city_registry import FEED_FORMATS, cities_of_format, city_sources
+from data_consolidation import (
+    create_consolidate_tables,
+    create_snapshot_view,
+    consolidate_city_data,
+    consolidate_staged_format,
+    snapshot_station_statement_data,
+    stage_format_cities,
+)
+from data_compaction import COMPACTION_INTERVAL_HOURS, run_compaction
+from data_ingestion import (
+    COMMUNE_DATASETS,
+    SNAPSHOT_MODE,
+    create_session,
+    get_all_data,
+    realtime_bicycle_datasets,
+)
+from data_polling import POLLING_MODE, poll_due_feeds
+from data_publication import (
+    PUBLISH_MODE,
+    PUBLISHED_TABLES,
+    publish_database,
+    remove_old_publications,
+)
+from database import connect
+from etl_metrics import collecting_metrics, flush_metrics
+from etl_pipeline import get_resumable_run, run_pipeline, task
+from etl_state import read_etl_state, write_etl_state
+from spatial_index import build_station_grid
+
+DEFAULT_REFRESH_INTERVAL_SECONDS = 900
+
+
+def agregate_facts(con):
+    """
+    Merges the new station statements into the fact table, then updates the
+    rollups from the same delta.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+    """
+    if SNAPSHOT_MODE:
+        create_snapshot_view(con)
+    agregate_fact_station_statements(con)
+    agregate_rollups(con)
+
+
+def etl_tasks(run_at, run_id=None):
+    """
+    Declares the ETL pipeline: each stage, with the raw files and tables it reads
+    and writes. The cities of each feed format are consolidated together, as a
+    separate task per format, so a broken feed only affects the cities of its format.
+
+    Args:
+        run_at (datetime): Start time of the ETL run.
+        run_id (str | None): The ETL run, names the published database.
+
+    Returns:
+        list[dict]: The pipeline tasks.
+    """
+    raw_files = [
+        f"raw:{file_name}"
+        for _, file_name in realtime_bicycle_datasets() + COMMUNE_DATASETS
+    ]
+
+    def ingest(con):
+        get_all_data(run_at)
+
+    def consolidate_format(feed_format):
+        def snapshot(con, failed_cities):
+            snapshot_station_statement_data(con, feed_format, run_at)
+
+        # The feeds are staged before the transaction of the task, so a broken feed
+        # only fails its own city, and a failed task only the cities of its format.
+        # In snapshot mode every run appends its own snapshot, once committed.
+        return task(
+            f"consolidate_{feed_format}",
+            lambda con, failed_cities: consolidate_staged_format(
+                con, feed_format, failed_cities=failed_cities
+            ),
+            prepare=lambda con: stage_format_cities(con, feed_format),
+            finalize=snapshot if SNAPSHOT_MODE else None,
+            inputs=[
+                f"raw:{file_name}"
+                for city in cities_of_format(feed_format)
+                for file_name in city_sources(city["name"])
+            ]
+            + (["run"] if SNAPSHOT_MODE else []),
+            outputs=["table:CONSOLIDATE_STATION", "table:CONSOLIDATE_STATION_STATEMENT"],
+            may_fail=True,
+        )
+
+    rollup_tables = ["AGG_STATION", "AGG_STATION_DAILY", "AGG_CITY_LATEST", "AGG_STATION_LATEST"]
+    if SNAPSHOT_MODE:
+        rollup_tables.append("AGG_STATION_HOURLY")
+
+    tasks = [
+        # Also run when resuming a run, the sources may have changed since: the
+        # tasks reading them only run again if they did
+        task("ingest", ingest, inputs=["run"], outputs=raw_files, always=True),
+        task(
+            "consolidate_cities",
+            consolidate_city_data,
+            inputs=["raw:commune_data.json"],
+            outputs=["table:CONSOLIDATE_CITY"],
+        ),
+        *[
+            consolidate_format(feed_format)
+            for feed_format in FEED_FORMATS
+            if cities_of_format(feed_format)
+        ],
+        task(
+            "agregate_dim_city",
+            agregate_dim_city,
+            inputs=["table:CONSOLIDATE_CITY"],
+            outputs=["table:DIM_CITY"],
+        ),
+        # The station dimension and the facts are built from the cities that were
+        # consolidated when others failed
+        task(
+            "agregate_dim_station",
+            agregate_dim_station,
+            # City keys are assigned when the cities are consolidated
+            inputs=["table:CONSOLIDATE_STATION", "table:CONSOLIDATE_CITY"],
+            outputs=["table:DIM_STATION"],
+            allow_partial=True,
+        ),
+        task(
+            "build_station_grid",
+            build_station_grid,
+            inputs=["table:DIM_STATION"],
+            outputs=["table:DIM_STATION_GRID"],
+        ),
+        task(
+            "agregate_facts",
+            agregate_facts,
+            # The fact table references both dimensions
+            inputs=[
+                "table:CONSOLIDATE_STATION",
+                "table:CONSOLIDATE_STATION_STATEMENT",
+                "table:DIM_CITY",
+                "table:DIM_STATION",
+            ],
+            outputs=["table:FACT_STATION_STATEMENT"]
+            + [f"table:{table_name}" for table_name in rollup_tables],
+            allow_partial=True,
+        ),
+    ]
+
+    def publish(con):
+        # The metrics of the run so far are published with it
+        flush_metrics(con, run_id, run_at)
+        return publish_database(con, run_id)
+
+    if PUBLISH_MODE and run_id is not None:
+        # Every run publishes its own file, read by the dashboard with its run id
+        tasks.append(
+            task(
+                "publish",
+                publish,
+                inputs=[f"table:{table_name}" for table_name in PUBLISHED_TABLES],
+                always=True,
+            )
+        )
+
+    return tasks
+
+
+def run_etl(run_id=None, select=None):
+    """
+    Runs the ETL pipeline once: ingestion, consolidation and aggregation, then the
+    publication of the star schema in publish mode. Stages run as soon as their
+    inputs are ready, and are skipped when their inputs are unchanged since their
+    last successful run. After a failed run, the next full run resumes it: the
+    sources are fetched again and only the stages that did not succeed, or whose
+    sources changed, run again. A failed consolidation of a feed format does not
+    fail the run, its cities are reported as failed.
+
+    Args:
+        run_id (str | None): The ETL run, names the published database.
+        select (Callable[[str], bool] | None): Runs only the stages whose task
+            name it accepts, all of them if None.
+
+    Returns:
+        dict: Run summary, with the cities whose consolidation failed and the
+            published database.
+    """
+    logging.info("Process start.")
+
+    resumable_run = get_resumable_run() if select is None else None
+    if resumable_run:
+        logging.info(f"Resuming the run started at {resumable_run}.")
+        run_at = datetime.fromisoformat(resumable_run)
+    else:
+        run_at = datetime.now()
+
+    # One connection for the whole run; each stage runs on its own cursor and in
+    # its own transaction, so a failing stage is rolled back without affecting
+    # the others
+    tasks = etl_tasks(run_at, run_id)
+    with connect() as con, collecting_metrics(con, run_id, run_at):
+        create_consolidate_tables(con)
+        create_agregate_tables(con)
+        results = run_pipeline(
+            con,
+            tasks,
+            run_at.isoformat(),
+            resumable=resumable_run is None and select is None,
+            select=None if select is None else {t["name"] for t in tasks if select(t["name"])},
+        )
+
+    # A failed format task fails all its cities, a successful one gives the cities
+    # whose feeds could not be read
+    format_tasks = {f"consolidate_{feed_format}": feed_format for feed_format in FEED_FORMATS}
+    failed_cities = {}
+    for name, result in results.items():
+        if name not in format_tasks:
+            continue
+        if result["status"] == "failed":
+            failed_cities.update(
+                {city["name"]: repr(result["error"]) for city in cities_of_format(format_tasks[name])}
+            )
+        elif result["status"] in ("ran", "skipped"):
+            failed_cities.update(result["result"] or {})
+    failed_tasks = {
+        t["name"]: results[t["name"]]["status"]
+        for t in tasks
+        if results[t["name"]]["status"] in ("failed", "blocked") and not t["may_fail"]
+    }
+    if failed_tasks:
+        raise RuntimeError(f"ETL tasks did not complete: {failed_tasks}")
+
+    logging.info("Process ended.")
+
+    return {
+        "published_database": results.get("publish", {}).get("result"),
+        "failed_cities": failed_cities,
+    }
+
+
+def refresh_once() -> bool:
+    """
+    Runs the ETL once and records the outcome in the freshness marker.
+    The "last successful run" watermark is only moved forward when the run succeeds.
+
+    Returns:
+        bool: True if the run succeeded.
+    """
+    state = read_etl_state()
+    started_at = datetime.now(timezone.utc)
+    run_id = started_at.strftime("%Y%m%dT%H%M%SZ")
+    state["last_run_started_at"] = started_at.isoformat()
+
+    try:
+        summary = run_etl(run_id)
+    except Exception as e:
+        logging.exception("ETL run failed.")
+        state["last_error"] = repr(e)
+        state["last_error_at"] = datetime.now(timezone.utc).isoformat()
+        write_etl_state(state)
+        return False
+
+    ended_at = datetime.now(timezone.utc)
+    state.update(
+        {
+            "run_id": run_id,
+            "last_success_at": ended_at.isoformat(),
+            "last_duration_seconds": round((ended_at - started_at).total_seconds(), 3),
+            "last_error": None,
+            "failed_cities": summary["failed_cities"],
+            "published_database": summary["published_database"],
+        }
+    )
+    # Readers switch to the published database of the run with the new run id
+    write_etl_state(state)
+    remove_old_publications()
+    compact_if_due(state)
+    return True
+
+
+def compact_if_due(state: dict):
+    """
+    Compacts the raw data and the database when the last compaction is older than
+    COMPACTION_INTERVAL_HOURS. Runs between two ETL runs, while nothing writes to
+    the database; a failure, or a database compaction skipped while the dashboard
+    reads the file, is logged and retried after the next run.
+
+    Args:
+        state (dict): The ETL freshness marker, updated with the compaction time.
+    """
+    if COMPACTION_INTERVAL_HOURS <= 0:
+        return
+
+    last_compaction_at = state.get("last_compaction_at")
+    if last_compaction_at and datetime.now(timezone.utc) - datetime.fromisoformat(
+        last_compaction_at
+    ) < timedelta(hours=COMPACTION_INTERVAL_HOURS):
+        return
+
+    try:
+        if run_compaction() is None:
+            return
+    except Exception:
+        logging.exception("Compaction failed.")
+        return
+
+    state["last_compaction_at"] = datetime.now(timezone.utc).isoformat()
+    write_etl_state(state)
+
+
+def run_refresher(interval_seconds: int | None = None):
+    """
+    Runs the ETL in a loop, waiting `interval_seconds` between the start of two runs.
+
+    Args:
+        interval_seconds (int | None): Refresh interval. Defaults to the
+            ETL_REFRESH_INTERVAL_SECONDS environment variable, or 15 minutes.
+    """
+    if interval_seconds is None:
+        interval_seconds = int(
+            os.environ.get(
+                "ETL_REFRESH_INTERVAL_SECONDS", DEFAULT_REFRESH_INTERVAL_SECONDS
+            )
+        )
+
+    if POLLING_MODE:
+        run_polling_refresher(interval_seconds)
+        return
+
+    while True:
+        started = time.monotonic()
+        refresh_once()
+        time.sleep(max(0, interval_seconds - (time.monotonic() - started)))
+
+
+def run_polling_refresher(interval_seconds: int):
+    """
+    Polling mode: runs the ETL every `interval_seconds` and, in between, polls the
+    station status feeds on their own schedule, appending the stations whose status
+    changed. Both run in this process, DuckDB allowing a single writer.
+
+    Args:
+        interval_seconds (int): Refresh interval of the full ETL.
+    """
+    with connect() as con:
+        create_consolidate_tables(con)
+
+    feeds = {}
+    next_refresh_at = time.monotonic()
+    with create_session() as session:
+        while True:
+            if time.monotonic() >= next_refresh_at:
+                next_refresh_at = time.monotonic() + interval_seconds
+                refresh_once()
+
+            next_poll_at = poll_due_feeds(session, feeds)
+            time.sleep(max(0, min(next_refresh_at, next_poll_at) - time.monotonic()))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    run_refresher()
@@ -0,0 +1,36 @@
+import json
+import os
+
+ETL_STATE_FILE = "data/etl_state.json"
+
+
+def read_etl_state(path: str = ETL_STATE_FILE) -> dict:
+    """
+    Reads the ETL freshness marker written by the refresher.
+
+    Args:
+        path (str): The state file.
+
+    Returns:
+        dict: The last recorded state, or an empty dict if no run was recorded yet.
+    """
+    try:
+        with open(path, encoding="utf-8") as fd:
+            return json.load(fd)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def write_etl_state(state: dict, path: str = ETL_STATE_FILE):
+    """
+    Atomically replaces the ETL freshness marker so readers never see a partial file.
+
+    Args:
+        state (dict): The state to persist.
+        path (str): The state file.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_file = f"{path}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as fd:
+        json.dump(state, fd, indent=2)
+    os.replace(tmp_file, path)
@@ -0,0 +1,88 @@
+import glob
+import logging
+import os
+
+from database import transaction
+
+# Versioned migrations, applied in order: <version>_<name>.sql
+MIGRATIONS_DIRECTORY = "data/sql_statements/migrations"
+
+
+def list_migrations():
+    """
+    Lists the migration scripts, sorted by version.
+
+    Returns:
+        list[tuple]: The (version, name, path) of each migration.
+    """
+    migrations = []
+    for path in glob.glob(f"{MIGRATIONS_DIRECTORY}/*.sql"):
+        version, name = os.path.basename(path).removesuffix(".sql").split("_", 1)
+        migrations.append((int(version), name, path))
+
+    return sorted(migrations)
+
+
+def get_schema_version(con):
+    """
+    Returns the version of the database schema, the last migration applied.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+    """
+    return con.execute("SELECT coalesce(max(VERSION), 0) FROM SCHEMA_VERSION").fetchone()[0]
+
+
+def migrate_schema(con):
+    """
+    Brings the database schema to the latest version. Each pending migration runs
+    in its own transaction and is recorded in SCHEMA_VERSION. A new database is
+    created directly with the latest schema by the create scripts, so it is only
+    marked as up to date.
+
+    Must run before the tables are created, on a single connection.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+    """
+    new_database = con.execute("""
+    SELECT count(*) = 0
+    FROM duckdb_tables()
+    WHERE database_name = current_database()
+    AND table_name IN ('SCHEMA_VERSION', 'CONSOLIDATE_STATION')
+    """).fetchone()[0]
+
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS SCHEMA_VERSION (
+        VERSION INTEGER PRIMARY KEY,
+        NAME VARCHAR,
+        APPLIED_AT TIMESTAMP
+    );
+    """)
+
+    migrations = list_migrations()
+    if new_database:
+        con.executemany(
+            "INSERT INTO SCHEMA_VERSION VALUES (?, ?, CURRENT_TIMESTAMP)",
+            [[version, name] for version, name, _ in migrations],
+        )
+        return
+
+    schema_version = get_schema_version(con)
+    for version, name, path in migrations:
+        if version <= schema_version:
+            continue
+
+        with open(path) as fd:
+            statements = fd.read()
+
+        with transaction(con):
+            for statement in statements.split(";"):
+                if statement.strip():
+                    con.execute(statement)
+            con.execute(
+                "INSERT INTO SCHEMA_VERSION VALUES (?, ?, CURRENT_TIMESTAMP)",
+                [version, name],
+            )
+
+        logging.info(f"Schema migrated to version {version} ({name}).")
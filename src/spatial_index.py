@@ -0,0 +1,133 @@
+import math
+
+# Side of the grid cells stations are bucketed into, in degrees (about 1.1 km of latitude)
+GRID_CELL_DEGREES = 0.01
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE_LATITUDE = 111.32
+
+# k-nearest searches start with this radius and double it until enough stations are found
+KNN_START_RADIUS_KM = 0.5
+KNN_MAX_RADIUS_KM = 50.0
+
+
+def build_station_grid(con):
+    """
+    Rebuilds the grid index of station locations from DIM_STATION. Rows are stored
+    sorted by cell, so the zone maps of the table skip the cells a search does not cover.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+    """
+    con.execute("DELETE FROM DIM_STATION_GRID;")
+    con.execute(f"""
+    INSERT INTO DIM_STATION_GRID
+    SELECT
+        ID,
+        floor(LONGITUDE / {GRID_CELL_DEGREES})::INTEGER AS CELL_X,
+        floor(LATITUDE / {GRID_CELL_DEGREES})::INTEGER AS CELL_Y,
+        LONGITUDE,
+        LATITUDE
+    FROM DIM_STATION
+    WHERE LONGITUDE IS NOT NULL AND LATITUDE IS NOT NULL
+    ORDER BY CELL_Y, CELL_X;
+    """)
+
+
+def find_stations_within_radius(con, longitude, latitude, radius_km, min_bicycles=1, limit=None):
+    """
+    Returns the stations within `radius_km` of a location that had at least
+    `min_bicycles` bikes available in their latest statement, nearest first.
+    Only the grid cells overlapping the search radius are read.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        longitude (float): Longitude of the location.
+        latitude (float): Latitude of the location.
+        radius_km (float): Search radius, in kilometers.
+        min_bicycles (int): Minimum number of bikes available.
+        limit (int | None): Maximum number of stations returned.
+
+    Returns:
+        pyarrow.Table: The stations with their latest availability and distance_km.
+    """
+    delta_latitude = radius_km / KM_PER_DEGREE_LATITUDE
+    delta_longitude = radius_km / (
+        KM_PER_DEGREE_LATITUDE * max(math.cos(math.radians(latitude)), 0.01)
+    )
+    params = {
+        "longitude": longitude,
+        "latitude": latitude,
+        "radius_km": radius_km,
+        "min_bicycles": min_bicycles,
+        "limit": limit,
+        "min_cell_x": math.floor((longitude - delta_longitude) / GRID_CELL_DEGREES),
+        "max_cell_x": math.floor((longitude + delta_longitude) / GRID_CELL_DEGREES),
+        "min_cell_y": math.floor((latitude - delta_latitude) / GRID_CELL_DEGREES),
+        "max_cell_y": math.floor((latitude + delta_latitude) / GRID_CELL_DEGREES),
+    }
+
+    return con.execute(f"""
+    WITH candidates AS (
+        SELECT
+            STATION_ID,
+            2 * {EARTH_RADIUS_KM} * asin(sqrt(
+                pow(sin(radians(LATITUDE - $latitude) / 2), 2)
+                + cos(radians($latitude)) * cos(radians(LATITUDE))
+                * pow(sin(radians(LONGITUDE - $longitude) / 2), 2)
+            )) AS distance_km
+        FROM DIM_STATION_GRID
+        WHERE CELL_Y BETWEEN $min_cell_y AND $max_cell_y
+        AND CELL_X BETWEEN $min_cell_x AND $max_cell_x
+    ),
+    latest_statement AS (
+        -- Latest statement of the candidate stations only
+        SELECT l.STATION_ID, l.BICYCLE_AVAILABLE, l.BICYCLE_DOCKS_AVAILABLE, l.LAST_STATEMENT_DATE
+        FROM AGG_STATION_LATEST l
+        WHERE l.STATION_ID IN (SELECT STATION_ID FROM candidates WHERE distance_km <= $radius_km)
+    )
+    SELECT
+        s.ID AS station_id,
+        s.NAME AS station_name,
+        s.ADDRESS AS address,
+        s.LONGITUDE AS longitude,
+        s.LATITUDE AS latitude,
+        f.BICYCLE_AVAILABLE AS bicycle_available,
+        f.BICYCLE_DOCKS_AVAILABLE AS bicycle_docks_available,
+        f.LAST_STATEMENT_DATE AS last_statement_date,
+        round(c.distance_km, 3) AS distance_km
+    FROM candidates c
+    JOIN latest_statement f ON c.STATION_ID = f.STATION_ID
+    JOIN DIM_STATION s ON c.STATION_ID = s.ID
+    WHERE c.distance_km <= $radius_km
+    AND f.BICYCLE_AVAILABLE >= $min_bicycles
+    ORDER BY c.distance_km
+    LIMIT $limit;
+    """, params).fetch_arrow_table()
+
+
+def find_nearest_stations(con, longitude, latitude, k=5, min_bicycles=1):
+    """
+    Returns the `k` stations nearest to a location that had at least `min_bicycles`
+    bikes available in their latest statement, nearest first. The search radius
+    starts small and doubles until `k` stations are found, up to KNN_MAX_RADIUS_KM.
+
+    Args:
+        con (duckdb.DuckDBPyConnection): The DuckDB connection.
+        longitude (float): Longitude of the location.
+        latitude (float): Latitude of the location.
+        k (int): Number of stations to return.
+        min_bicycles (int): Minimum number of bikes available.
+
+    Returns:
+        pyarrow.Table: The stations with their latest availability and distance_km.
+    """
+    radius_km = KNN_START_RADIUS_KM
+    while True:
+        stations = find_stations_within_radius(
+            con, longitude, latitude, radius_km, min_bicycles, limit=k
+        )
+        # Every station within the radius is found, so the k nearest are exact
+        if stations.num_rows >= k or radius_km >= KNN_MAX_RADIUS_KM:
+            return stations
+        radius_km = min(radius_km * 2, KNN_MAX_RADIUS_KM)
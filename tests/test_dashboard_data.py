@@ -0,0 +1,134 @@
+from unittest import mock
+import math
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPOSITORY_DIRECTORY, "src"))
+
+import dashboard_data  # noqa: E402
+from dashboard_data import (  # noqa: E402
+    DETAIL_ZOOM,
+    GRID_CELL_PX,
+    get_map_points,
+    viewport_bounds,
+)
+from data_agregation import create_agregate_tables  # noqa: E402
+from data_consolidation import create_consolidate_tables  # noqa: E402
+from database import connect  # noqa: E402
+
+# Notre-Dame de Paris
+CENTER = {"lat": 48.8530, "lon": 2.3499}
+NB_STATIONS = 3000
+
+
+def float_32(value):
+    """
+    Rounds a coordinate to the single precision it is stored with.
+    """
+    return struct.unpack("f", struct.pack("f", value))[0]
+
+
+class MapPointsTest(unittest.TestCase):
+    """
+    Queries the station map of a scratch ETL database, without a published file.
+    """
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="velo-test-")
+        self.addCleanup(shutil.rmtree, self.workdir, ignore_errors=True)
+        shutil.copytree(
+            os.path.join(REPOSITORY_DIRECTORY, "data", "sql_statements"),
+            os.path.join(self.workdir, "data", "sql_statements"),
+        )
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.workdir)
+        self.addCleanup(get_map_points.clear)
+
+        rng = random.Random(0)
+        self.stations = [
+            (
+                station_id,
+                1 + station_id % 2,
+                CENTER["lon"] + rng.uniform(-0.2, 0.2),
+                CENTER["lat"] + rng.uniform(-0.1, 0.1),
+                rng.randint(10, 40),
+            )
+            for station_id in range(1, NB_STATIONS + 1)
+        ]
+        with connect() as con:
+            create_consolidate_tables(con)
+            create_agregate_tables(con)
+            rows = ", ".join(f"({', '.join(map(str, station))})" for station in self.stations)
+            con.execute(f"""
+            INSERT INTO DIM_STATION (ID, CITY_ID, NAME, LONGITUDE, LATITUDE, CAPACITTY)
+            SELECT id, city_id, 'Station', longitude, latitude, capacity
+            FROM (VALUES {rows}) AS t (id, city_id, longitude, latitude, capacity)
+            """)
+
+    def stations_within(self, bounds, city_id=None):
+        """
+        Returns the stations inside the bounds, as stored (single precision coordinates).
+        """
+        min_lon, min_lat, max_lon, max_lat = bounds
+        return [
+            station for station in self.stations
+            if min_lon <= float_32(station[2]) <= max_lon
+            and min_lat <= float_32(station[3]) <= max_lat
+            and city_id in (None, station[1])
+        ]
+
+    def test_stations_are_clustered_below_the_detail_zoom(self):
+        zoom = 11
+        bounds = viewport_bounds(CENTER, zoom)
+
+        points = get_map_points("r1", zoom, bounds, city_id=1).to_pylist()
+
+        stations = self.stations_within(bounds, city_id=1)
+        self.assertGreater(len(stations), 100)
+        self.assertLess(len(points), len(stations))
+        self.assertEqual(sum(point["nb_stations"] for point in points), len(stations))
+        self.assertEqual(sum(point["capacity"] for point in points), sum(s[4] for s in stations))
+        # Each cluster is the centroid of the stations of one grid cell
+        cell_size = 360 / (256 * 2 ** zoom) * GRID_CELL_PX
+        cells = {
+            (math.floor(float_32(lon) / cell_size), math.floor(float_32(lat) / cell_size))
+            for _, _, lon, lat, _ in stations
+        }
+        self.assertEqual(len(points), len(cells))
+        self.assertEqual(
+            [point["label"] for point in points],
+            ["Station" if point["nb_stations"] == 1 else f"{point['nb_stations']} stations" for point in points],
+        )
+
+    def test_stations_are_drawn_one_by_one_from_the_detail_zoom(self):
+        bounds = viewport_bounds(CENTER, DETAIL_ZOOM)
+
+        points = get_map_points("r1", DETAIL_ZOOM, bounds).to_pylist()
+
+        stations = self.stations_within(bounds)
+        self.assertGreater(len(stations), 0)
+        self.assertEqual(len(points), len(stations))
+        self.assertEqual({point["nb_stations"] for point in points}, {1})
+
+    def test_map_points_are_capped(self):
+        with mock.patch.object(dashboard_data, "MAX_MAP_POINTS", 20):
+            clusters = get_map_points("r1", 12, viewport_bounds(CENTER, 12)).to_pylist()
+            stations = get_map_points("r1", DETAIL_ZOOM, (2.0, 48.5, 2.7, 49.2)).to_pylist()
+
+        self.assertEqual(len(clusters), 20)
+        self.assertEqual(len(stations), 20)
+        # The largest stations are kept
+        self.assertEqual(
+            sorted((point["capacity"] for point in stations), reverse=True),
+            sorted((station[4] for station in self.stations), reverse=True)[:20],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
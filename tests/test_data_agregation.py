@@ -0,0 +1,280 @@
+from datetime import date, datetime
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import duckdb
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPOSITORY_DIRECTORY, "src"))
+
+from data_agregation import (  # noqa: E402
+    agregate_dim_city,
+    agregate_dim_station,
+    agregate_fact_station_statements,
+    agregate_rollups,
+    agregate_station_hourly,
+    create_agregate_tables,
+)
+from data_consolidation import (  # noqa: E402
+    SNAPSHOT_DIRECTORY,
+    consolidate_station_statement,
+    create_consolidate_tables,
+)
+from database import transaction  # noqa: E402
+
+DAY_1 = date(2025, 1, 1)
+DAY_2 = date(2025, 1, 2)
+
+# The rollups as a full recompute from the fact table gives them
+FULL_ROLLUPS = {
+    "AGG_STATION_DAILY": """
+    SELECT
+        STATION_ID,
+        CREATED_DATE,
+        SUM(BICYCLE_AVAILABLE),
+        COUNT(*),
+        MIN(BICYCLE_AVAILABLE),
+        MAX(BICYCLE_AVAILABLE)
+    FROM FACT_STATION_STATEMENT
+    GROUP BY ALL
+    """,
+    "AGG_STATION": """
+    SELECT STATION_ID, SUM(BICYCLE_AVAILABLE), COUNT(*)
+    FROM FACT_STATION_STATEMENT
+    GROUP BY ALL
+    """,
+    "AGG_STATION_LATEST": """
+    SELECT STATION_ID, CREATED_DATE, BICYCLE_DOCKS_AVAILABLE, BICYCLE_AVAILABLE, LAST_STATEMENT_DATE
+    FROM FACT_STATION_STATEMENT
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY STATION_ID ORDER BY CREATED_DATE DESC) = 1
+    """,
+    "AGG_CITY_LATEST": """
+    SELECT CITY_ID, CREATED_DATE, COUNT(*), SUM(BICYCLE_DOCKS_AVAILABLE), SUM(BICYCLE_AVAILABLE)
+    FROM FACT_STATION_STATEMENT
+    WHERE (CITY_ID, CREATED_DATE) IN (
+        SELECT (CITY_ID, MAX(CREATED_DATE)) FROM FACT_STATION_STATEMENT GROUP BY CITY_ID
+    )
+    GROUP BY ALL
+    """,
+}
+
+
+class AgregationTest(unittest.TestCase):
+    """
+    Aggregates station statements loaded directly into the consolidated tables of
+    a scratch database.
+    """
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="velo-test-")
+        self.addCleanup(shutil.rmtree, self.workdir, ignore_errors=True)
+        shutil.copytree(
+            os.path.join(REPOSITORY_DIRECTORY, "data", "sql_statements"),
+            os.path.join(self.workdir, "data", "sql_statements"),
+        )
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.workdir)
+
+        self.con = duckdb.connect(os.path.join(self.workdir, "test.duckdb"))
+        self.addCleanup(self.con.close)
+        create_consolidate_tables(self.con)
+        create_agregate_tables(self.con)
+
+    def add_city(self, code, name):
+        city_id = self.con.execute(
+            "INSERT INTO CITY_KEY (NATURAL_ID) VALUES (?) RETURNING ID", [code]
+        ).fetchone()[0]
+        self.con.execute(
+            "INSERT INTO CONSOLIDATE_CITY (ID, NAME, NB_INHABITANTS, CREATED_DATE) VALUES (?, ?, 1000, ?)",
+            [city_id, name, DAY_1],
+        )
+        return city_id
+
+    def add_station(self, natural_id, city_code, longitude=2.35, latitude=48.85):
+        station_id = self.con.execute(
+            "INSERT INTO STATION_KEY (NATURAL_ID) VALUES (?) RETURNING ID", [natural_id]
+        ).fetchone()[0]
+        self.con.execute(
+            """
+            INSERT INTO CONSOLIDATE_STATION
+                (ID, CODE, NAME, CITY_CODE, LONGITUDE, LATITUDE, CREATED_DATE, CAPACITTY)
+            VALUES (?, ?, ?, ?, ?, ?, ?, 20)
+            """,
+            [station_id, natural_id, natural_id, city_code, longitude, latitude, DAY_1],
+        )
+        return station_id
+
+    def load_statements(self, statements):
+        """
+        Loads (station id, day, bikes available) statements as one load batch.
+        """
+        self.con.execute("""
+        CREATE OR REPLACE TEMP TABLE STAGING_JCDECAUX (
+            station_key INTEGER,
+            bicycle_docks_available SMALLINT,
+            bicycle_available SMALLINT,
+            last_statement_date TIMESTAMP,
+            created_date DATE
+        )
+        """)
+        self.con.executemany(
+            "INSERT INTO STAGING_JCDECAUX VALUES (?, 20 - ?, ?, ?, ?)",
+            [
+                [station_id, bikes, bikes, datetime.combine(day, datetime.min.time()), day]
+                for station_id, day, bikes in statements
+            ],
+        )
+        with transaction(self.con):
+            consolidate_station_statement(self.con, "jcdecaux")
+
+    def write_snapshot(self, snapshot_ts, feed_format, statements):
+        """
+        Writes the snapshot file of a run of a format, with the (station id, bikes
+        available) readings taken at `snapshot_ts`.
+        """
+        directory = f"{SNAPSHOT_DIRECTORY}/snapshot_date={snapshot_ts:%Y-%m-%d}"
+        os.makedirs(directory, exist_ok=True)
+        rows = ", ".join(
+            f"({station_id}, {20 - bikes}, {bikes}, TIMESTAMP '{snapshot_ts}')"
+            for station_id, bikes in statements
+        )
+        self.con.execute(f"""
+        COPY (
+            SELECT
+                station_id::INTEGER AS station_id,
+                bicycle_docks_available::SMALLINT AS bicycle_docks_available,
+                bicycle_available::SMALLINT AS bicycle_available,
+                snapshot_ts AS last_statement_ts,
+                snapshot_ts
+            FROM (VALUES {rows}) AS t (station_id, bicycle_docks_available, bicycle_available, snapshot_ts)
+        ) TO '{directory}/{snapshot_ts:%H%M%S}_{feed_format}.parquet' (FORMAT parquet)
+        """)
+
+    def assert_rollups_recomputed(self):
+        for table_name, full_query in FULL_ROLLUPS.items():
+            self.assertEqual(
+                self.con.execute(
+                    f"SELECT COLUMNS(c -> c != 'UPDATED_AT') FROM {table_name} ORDER BY ALL"
+                ).fetchall(),
+                self.con.execute(f"{full_query} ORDER BY ALL").fetchall(),
+                table_name,
+            )
+
+    def aggregate(self):
+        with transaction(self.con):
+            agregate_dim_city(self.con)
+            agregate_dim_station(self.con)
+            agregate_fact_station_statements(self.con)
+            agregate_rollups(self.con)
+
+    def test_alphanumeric_city_codes_are_aggregated(self):
+        corsica = self.add_city("2A004", "Ajaccio")
+        paris = self.add_city("75056", "Paris")
+        ajaccio_station = self.add_station("2A004-1", "2A004")
+        paris_station = self.add_station("75056-1", "75056")
+        self.load_statements([(ajaccio_station, DAY_1, 3), (paris_station, DAY_1, 5)])
+
+        self.aggregate()
+
+        self.assertEqual(
+            self.con.execute(
+                "SELECT STATION_ID, CITY_ID, BICYCLE_AVAILABLE FROM FACT_STATION_STATEMENT ORDER BY 1"
+            ).fetchall(),
+            [(ajaccio_station, corsica, 3), (paris_station, paris, 5)],
+        )
+
+
+    def test_incremental_rollups_match_a_full_recompute(self):
+        self.add_city("75056", "Paris")
+        self.add_city("44109", "Nantes")
+        paris_station = self.add_station("75056-1", "75056")
+        nantes_station = self.add_station("44109-1", "44109")
+        other_paris_station = self.add_station("75056-2", "75056")
+        self.load_statements([
+            (paris_station, DAY_1, 3),
+            (nantes_station, DAY_1, 5),
+            (other_paris_station, DAY_1, 8),
+            (paris_station, DAY_2, 4),
+        ])
+        self.aggregate()
+        self.assert_rollups_recomputed()
+
+        # Revises an aggregated (station, day), adds a day to another station
+        self.load_statements([(paris_station, DAY_1, 7), (nantes_station, DAY_2, 6)])
+        self.aggregate()
+
+        self.assertEqual(
+            self.con.execute(
+                "SELECT BICYCLE_AVAILABLE FROM FACT_STATION_STATEMENT WHERE STATION_ID = ? AND CREATED_DATE = ?",
+                [paris_station, DAY_1],
+            ).fetchone(),
+            (7,),
+        )
+        self.assertEqual(self.con.execute("SELECT count(*) FROM LOAD_BATCH").fetchone()[0], 0)
+        self.assert_rollups_recomputed()
+
+    def test_polled_status_changes_update_the_latest_statements(self):
+        self.add_city("75056", "Paris")
+        updated_station = self.add_station("75056-1", "75056")
+        stale_station = self.add_station("75056-2", "75056")
+        self.load_statements([(updated_station, DAY_1, 3), (stale_station, DAY_2, 5)])
+        self.aggregate()
+
+        # Two polls of the first station, and a change of the second one reported
+        # before its latest statement
+        self.con.executemany(
+            "INSERT INTO STATION_STATUS_CHANGE VALUES (?, 20 - ?, ?, ?, ?)",
+            [
+                [updated_station, 6, 6, datetime(2025, 1, 2, 8), datetime(2025, 1, 2, 8, 1)],
+                [updated_station, 9, 9, datetime(2025, 1, 2, 9), datetime(2025, 1, 2, 9, 1)],
+                [stale_station, 1, 1, datetime(2025, 1, 1, 23), datetime(2025, 1, 2, 9, 1)],
+            ],
+        )
+        self.aggregate()
+
+        self.assertEqual(
+            self.con.execute(
+                "SELECT STATION_ID, CREATED_DATE, BICYCLE_AVAILABLE, LAST_STATEMENT_DATE "
+                "FROM AGG_STATION_LATEST ORDER BY 1"
+            ).fetchall(),
+            [
+                (updated_station, DAY_2, 9, datetime(2025, 1, 2, 9)),
+                (stale_station, DAY_2, 5, datetime(2025, 1, 2)),
+            ],
+        )
+
+    def test_hourly_rollup_rebuilds_the_hours_since_its_watermark(self):
+        self.write_snapshot(datetime(2025, 1, 1, 10, 0), "jcdecaux", [(1, 3), (2, 5)])
+        self.write_snapshot(datetime(2025, 1, 1, 10, 30), "jcdecaux", [(1, 4), (2, 5)])
+        with transaction(self.con):
+            self.assertEqual(agregate_station_hourly(self.con), [DAY_1])
+
+        # A resumed run writes the snapshot of its failed format with the timestamp
+        # of the watermark, then the next run moves on to the next day
+        self.write_snapshot(datetime(2025, 1, 1, 10, 30), "gbfs", [(3, 9)])
+        self.write_snapshot(datetime(2025, 1, 2, 0, 15), "jcdecaux", [(1, 2), (2, 2)])
+        with transaction(self.con):
+            self.assertEqual(sorted(agregate_station_hourly(self.con)), [DAY_1, DAY_2])
+
+        self.assertEqual(
+            self.con.execute("SELECT * FROM AGG_STATION_HOURLY ORDER BY ALL").fetchall(),
+            self.con.execute(f"""
+            SELECT
+                station_id,
+                DATE_TRUNC('hour', snapshot_ts),
+                SUM(bicycle_available),
+                COUNT(*),
+                MIN(bicycle_available),
+                MAX(bicycle_available)
+            FROM read_parquet('{SNAPSHOT_DIRECTORY}/*/*.parquet')
+            GROUP BY ALL
+            ORDER BY ALL
+            """).fetchall(),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
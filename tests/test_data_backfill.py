@@ -0,0 +1,115 @@
+from datetime import date, timedelta
+from unittest import mock
+import gzip
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import duckdb
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [
+    os.path.join(REPOSITORY_DIRECTORY, "src"),
+    os.path.join(REPOSITORY_DIRECTORY, "benchmarks"),
+]
+
+import city_registry  # noqa: E402
+from data_backfill import backfill  # noqa: E402
+from database import DATABASE_PATH  # noqa: E402
+from generate_feeds import generate_feeds, write_city_registry  # noqa: E402
+
+NB_CITIES = 4
+NB_STATIONS = 10
+NB_DAYS = 5
+FIRST_DAY = date(2025, 1, 1)
+# Paris station renamed from this day on
+RENAMED_FROM = date(2025, 1, 3)
+
+
+class BackfillTest(unittest.TestCase):
+    """
+    Backfills synthetic raw files of a few days in a scratch directory.
+    """
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="velo-test-")
+        self.addCleanup(shutil.rmtree, self.workdir, ignore_errors=True)
+        shutil.copytree(
+            os.path.join(REPOSITORY_DIRECTORY, "data", "sql_statements"),
+            os.path.join(self.workdir, "data", "sql_statements"),
+        )
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.workdir)
+
+        registry_file = os.path.join(self.workdir, "data", "cities.toml")
+        write_city_registry(registry_file, NB_CITIES, "http://127.0.0.1")
+        patched_environ = mock.patch.dict(os.environ, {"CITY_REGISTRY_FILE": registry_file})
+        patched_environ.start()
+        self.addCleanup(patched_environ.stop)
+        city_registry.get_city_registry.cache_clear()
+        self.addCleanup(city_registry.get_city_registry.cache_clear)
+
+        for day_index in range(NB_DAYS):
+            self.write_raw_day(FIRST_DAY + timedelta(days=day_index), day_index)
+
+    def write_raw_day(self, day, snapshot):
+        feeds_directory = os.path.join(self.workdir, "feeds")
+        generate_feeds(feeds_directory, NB_CITIES, NB_STATIONS, snapshot=snapshot)
+        if day >= RENAMED_FROM:
+            paris_feed = os.path.join(feeds_directory, "paris_realtime_bicycle_data.json")
+            with open(paris_feed) as fd:
+                stations = json.load(fd)
+            stations[0]["name"] = "Renamed"
+            with open(paris_feed, "w") as fd:
+                json.dump(stations, fd)
+
+        raw_directory = f"data/raw_data/{day:%Y-%m-%d}"
+        os.makedirs(raw_directory)
+        for file_name in os.listdir(feeds_directory):
+            with open(os.path.join(feeds_directory, file_name), "rb") as source:
+                with gzip.open(f"{raw_directory}/{file_name}.gz", "wb") as fd:
+                    fd.write(source.read())
+
+    def backfilled_tables(self):
+        """
+        Returns the station versions and the facts of the database, by natural
+        station id: keys depend on the order the chunks are consolidated in.
+        """
+        with duckdb.connect(DATABASE_PATH, read_only=True) as con:
+            stations = con.execute("""
+            SELECT k.NATURAL_ID, s.NAME, s.CREATED_DATE, s.VALID_TO
+            FROM CONSOLIDATE_STATION s
+            JOIN STATION_KEY k ON k.ID = s.ID
+            ORDER BY k.NATURAL_ID, s.CREATED_DATE
+            """).fetchall()
+            facts = con.execute("""
+            SELECT k.NATURAL_ID, f.CREATED_DATE, f.BICYCLE_AVAILABLE, f.LAST_STATEMENT_DATE
+            FROM FACT_STATION_STATEMENT f
+            JOIN STATION_KEY k ON k.ID = f.STATION_ID
+            ORDER BY ALL
+            """).fetchall()
+        return stations, facts
+
+    def test_concurrent_chunks_match_a_serial_backfill(self):
+        last_day = FIRST_DAY + timedelta(days=NB_DAYS - 1)
+
+        results = backfill(FIRST_DAY, last_day, max_workers=4, chunk_size=2)
+        concurrent_tables = self.backfilled_tables()
+        os.remove(DATABASE_PATH)
+        backfill(FIRST_DAY, last_day, max_workers=1, chunk_size=2)
+
+        self.assertEqual(results, {city["name"]: NB_DAYS for city in city_registry.get_city_registry()})
+        self.assertEqual(concurrent_tables, self.backfilled_tables())
+        stations, facts = concurrent_tables
+        self.assertEqual(len(facts), NB_DAYS * NB_CITIES * NB_STATIONS)
+        self.assertEqual(
+            [(name, created_date) for natural_id, name, created_date, _ in stations
+             if natural_id == "1-000000"][:2],
+            [("Station 75056 0", FIRST_DAY), ("Renamed", RENAMED_FROM)],
+        )
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+from datetime import date, datetime
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import duckdb
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPOSITORY_DIRECTORY, "src"))
+
+from data_agregation import create_agregate_tables, set_watermark  # noqa: E402
+from data_compaction import compact_database, prune_snapshots  # noqa: E402
+from data_consolidation import (  # noqa: E402
+    RAW_DATA_DIRECTORY,
+    SNAPSHOT_DIRECTORY,
+    create_consolidate_tables,
+    list_raw_files,
+)
+from database import DATABASE_PATH, connect  # noqa: E402
+
+TODAY = date(2025, 3, 1)
+
+
+class CompactionTest(unittest.TestCase):
+    """
+    Runs the compaction steps on the data directory of a scratch database.
+    """
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="velo-test-")
+        self.addCleanup(shutil.rmtree, self.workdir, ignore_errors=True)
+        shutil.copytree(
+            os.path.join(REPOSITORY_DIRECTORY, "data", "sql_statements"),
+            os.path.join(self.workdir, "data", "sql_statements"),
+        )
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.workdir)
+
+        self.con = duckdb.connect(os.path.join(self.workdir, "test.duckdb"))
+        self.addCleanup(self.con.close)
+        create_consolidate_tables(self.con)
+        create_agregate_tables(self.con)
+
+    def write_snapshot_days(self, *days):
+        for day in days:
+            directory = f"{SNAPSHOT_DIRECTORY}/snapshot_date={day:%Y-%m-%d}"
+            os.makedirs(directory)
+            open(f"{directory}/000000_jcdecaux.parquet", "w").close()
+
+    def snapshot_days(self):
+        return sorted(os.listdir(SNAPSHOT_DIRECTORY))
+
+    def test_snapshots_out_of_retention_are_deleted(self):
+        self.write_snapshot_days(date(2025, 1, 1), date(2025, 1, 2), date(2025, 2, 27))
+        set_watermark(self.con, "AGG_STATION_HOURLY", datetime(2025, 2, 27, 10))
+
+        nb_days = prune_snapshots(self.con, retention_days=58, today=TODAY)
+
+        self.assertEqual(nb_days, 1)
+        self.assertEqual(self.snapshot_days(), ["snapshot_date=2025-01-02", "snapshot_date=2025-02-27"])
+
+    def test_snapshots_not_rolled_up_are_kept(self):
+        self.write_snapshot_days(date(2025, 1, 1), date(2025, 1, 2), date(2025, 1, 3))
+
+        self.assertEqual(prune_snapshots(self.con, retention_days=7, today=TODAY), 0)
+
+        set_watermark(self.con, "AGG_STATION_HOURLY", datetime(2025, 1, 2, 23, 30))
+        self.assertEqual(prune_snapshots(self.con, retention_days=7, today=TODAY), 1)
+        self.assertEqual(self.snapshot_days(), ["snapshot_date=2025-01-02", "snapshot_date=2025-01-03"])
+
+    def test_downloads_in_progress_are_not_listed(self):
+        paths = [
+            f"{RAW_DATA_DIRECTORY}/2025-01-01/paris.json",
+            f"{RAW_DATA_DIRECTORY}/2025-01-02/080000/paris.json.gz",
+            f"{RAW_DATA_DIRECTORY}/2025-01-02/080000/paris.json.gz.tmp",
+            f"{RAW_DATA_DIRECTORY}/2025-01-02/080000/paris.json.bak",
+            f"{RAW_DATA_DIRECTORY}/2025-01-02/080000/paris.json.gz.tmp.gz",
+        ]
+        for path in paths:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "w").close()
+
+        files = list_raw_files(self.con, "paris.json", date(2025, 1, 1), date(2025, 1, 2))
+
+        self.assertEqual(
+            files,
+            {date(2025, 1, 1): [paths[0]], date(2025, 1, 2): [paths[1]]},
+        )
+
+    def write_database(self):
+        """
+        Writes a database file holding space freed by deleted rows.
+        """
+        with connect() as con:
+            con.execute("CREATE TABLE T AS SELECT range AS ID, md5(range::VARCHAR) AS V FROM range(500000)")
+            con.execute("DELETE FROM T WHERE ID >= 100")
+
+    def test_database_file_is_replaced(self):
+        self.write_database()
+
+        size_before, size_after = compact_database()
+
+        self.assertLess(size_after, size_before)
+        self.assertEqual(os.path.getsize(DATABASE_PATH), size_after)
+        with duckdb.connect(DATABASE_PATH, read_only=True) as con:
+            self.assertEqual(con.execute("SELECT count(*) FROM T").fetchone()[0], 100)
+
+    def test_database_compaction_is_skipped_while_the_file_is_read(self):
+        self.write_database()
+        size = os.path.getsize(DATABASE_PATH)
+        # The dashboard reading the ETL database from another process
+        reader = subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                "import sys, duckdb\n"
+                f"con = duckdb.connect({DATABASE_PATH!r}, read_only=True)\n"
+                "print('ready', flush=True)\n"
+                "sys.stdin.read()\n",
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        self.addCleanup(reader.wait)
+        self.addCleanup(reader.stdin.close)
+        self.assertEqual(reader.stdout.readline().strip(), "ready")
+
+        self.assertIsNone(compact_database())
+        self.assertEqual(os.path.getsize(DATABASE_PATH), size)
+        self.assertFalse(os.path.exists(f"{DATABASE_PATH}.compact"))
+
+
+if __name__ == "__main__":
+    unittest.main()
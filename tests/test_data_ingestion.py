@@ -0,0 +1,166 @@
+from unittest import mock
+import gzip
+import http.server
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+import requests
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [
+    os.path.join(REPOSITORY_DIRECTORY, "src"),
+    os.path.join(REPOSITORY_DIRECTORY, "benchmarks"),
+]
+
+import data_ingestion  # noqa: E402
+from stub_server import FeedHandler  # noqa: E402
+
+
+class FlakyFeedHandler(FeedHandler):
+    """
+    Serves the feeds as the stub server does, after answering the status codes
+    queued for a file, one per request.
+    """
+
+    failures = {}
+    requests = []
+
+    def do_GET(self):
+        file_name = self.path.rsplit("/", 1)[-1]
+        self.requests.append((file_name, self.headers.get("If-None-Match")))
+        if self.failures.get(file_name):
+            self.send_response(self.failures[file_name].pop(0))
+            self.end_headers()
+            return
+
+        super().do_GET()
+
+
+class FetchDatasetsTest(unittest.TestCase):
+    """
+    Fetches feeds from a local stub server into a scratch directory.
+    """
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="velo-test-")
+        self.addCleanup(shutil.rmtree, self.workdir, ignore_errors=True)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.workdir)
+
+        self.feeds_directory = os.path.join(self.workdir, "feeds")
+        os.makedirs(self.feeds_directory)
+        handler = type(
+            "Handler",
+            (FlakyFeedHandler,),
+            {"directory": self.feeds_directory, "failures": {}, "requests": []},
+        )
+        self.handler = handler
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.base_url = f"http://127.0.0.1:{server.server_port}"
+
+        patched_backoff = mock.patch.object(data_ingestion, "BACKOFF_SECONDS", 0)
+        patched_backoff.start()
+        self.addCleanup(patched_backoff.stop)
+
+    def write_feed(self, file_name, content):
+        with open(os.path.join(self.feeds_directory, file_name), "w") as fd:
+            json.dump(content, fd)
+
+    def fetch(self, *file_names):
+        results = data_ingestion.fetch_datasets(
+            [(f"{self.base_url}/{file_name}", file_name) for file_name in file_names]
+        )
+        return {result["file_name"]: result for result in results}
+
+    def stored_content(self, file_name):
+        with gzip.open(data_ingestion.raw_data_path(file_name)) as fd:
+            return json.load(fd)
+
+    def test_fetched_source_is_recorded_in_manifest(self):
+        self.write_feed("paris.json", [{"stationcode": "1"}])
+
+        result = self.fetch("paris.json")["paris.json"]
+
+        self.assertEqual(result["status_code"], 200)
+        self.assertTrue(result["changed"])
+        entry = data_ingestion.read_manifest()["paris.json"]
+        self.assertTrue(entry["changed"])
+        self.assertIsNotNone(entry["etag"])
+        self.assertEqual(entry["path"], data_ingestion.raw_data_path("paris.json"))
+        self.assertEqual(self.stored_content("paris.json"), [{"stationcode": "1"}])
+        self.assertEqual(result["bytes_received"], len(json.dumps([{"stationcode": "1"}])))
+        self.assertEqual(result["bytes_written"], os.path.getsize(entry["path"]))
+
+    def test_not_modified_source_keeps_its_snapshot(self):
+        self.write_feed("paris.json", [{"stationcode": "1"}])
+        self.fetch("paris.json")
+        first_entry = data_ingestion.read_manifest()["paris.json"]
+
+        result = self.fetch("paris.json")["paris.json"]
+
+        self.assertEqual(result["status_code"], 304)
+        self.assertFalse(result["changed"])
+        self.assertEqual(result["bytes_written"], 0)
+        self.assertEqual(self.handler.requests[-1], ("paris.json", first_entry["etag"]))
+        entry = data_ingestion.read_manifest()["paris.json"]
+        self.assertFalse(entry["changed"])
+        self.assertEqual(entry["path"], first_entry["path"])
+        self.assertEqual(entry["sha256"], first_entry["sha256"])
+
+    def test_changed_source_replaces_its_snapshot(self):
+        self.write_feed("paris.json", [{"stationcode": "1"}])
+        self.fetch("paris.json")
+        first_entry = data_ingestion.read_manifest()["paris.json"]
+
+        self.write_feed("paris.json", [{"stationcode": "2"}])
+        result = self.fetch("paris.json")["paris.json"]
+
+        self.assertEqual(result["status_code"], 200)
+        self.assertTrue(result["changed"])
+        entry = data_ingestion.read_manifest()["paris.json"]
+        self.assertTrue(entry["changed"])
+        self.assertNotEqual(entry["sha256"], first_entry["sha256"])
+        self.assertEqual(self.stored_content("paris.json"), [{"stationcode": "2"}])
+
+    def test_missing_source_gives_an_empty_dataset(self):
+        result = self.fetch("missing.json")["missing.json"]
+
+        self.assertEqual(result["status_code"], 404)
+        self.assertEqual(result["attempts"], 1)
+        self.assertEqual(self.stored_content("missing.json"), [])
+
+    def test_retryable_status_is_retried(self):
+        self.write_feed("paris.json", [{"stationcode": "1"}])
+        self.handler.failures["paris.json"] = [503, 502]
+
+        result = self.fetch("paris.json")["paris.json"]
+
+        self.assertEqual(result["status_code"], 200)
+        self.assertEqual(result["attempts"], 3)
+        self.assertEqual(self.stored_content("paris.json"), [{"stationcode": "1"}])
+
+    def test_failed_source_does_not_stop_the_others(self):
+        self.write_feed("paris.json", [{"stationcode": "1"}])
+        self.write_feed("nantes.json", [{"number": 1}])
+        self.handler.failures["nantes.json"] = [503] * data_ingestion.MAX_ATTEMPTS
+
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.fetch("paris.json", "nantes.json")
+
+        nantes_requests = [r for r in self.handler.requests if r[0] == "nantes.json"]
+        self.assertEqual(len(nantes_requests), data_ingestion.MAX_ATTEMPTS)
+        manifest = data_ingestion.read_manifest()
+        self.assertIn("paris.json", manifest)
+        self.assertNotIn("nantes.json", manifest)
+
+
+if __name__ == "__main__":
+    unittest.main()
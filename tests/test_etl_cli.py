@@ -0,0 +1,64 @@
+from contextlib import redirect_stderr, redirect_stdout
+from unittest import mock
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPOSITORY_DIRECTORY, "src"))
+
+import etl_refresher  # noqa: E402
+from etl_cli import main  # noqa: E402
+
+
+class EtlCliTest(unittest.TestCase):
+    """
+    Runs the velo-etl commands in a scratch directory, with the ETL run mocked.
+    """
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="velo-test-")
+        self.addCleanup(shutil.rmtree, self.workdir, ignore_errors=True)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.workdir)
+
+    def run_command(self, *argv):
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            try:
+                exit_code = main(list(argv))
+            except SystemExit as e:
+                exit_code = e.code
+        return exit_code, stdout.getvalue(), stderr.getvalue()
+
+    def test_summary_is_printed_for_humans(self):
+        os.makedirs("data/sql_statements")
+        summary = {
+            "published_database": None,
+            "failed_cities": {"Nantes": "ValueError('bad feed')", "Toulouse": "ValueError('bad feed')"},
+        }
+
+        with mock.patch.object(etl_refresher, "run_etl", return_value=summary) as run_etl:
+            exit_code, stdout, _ = self.run_command("consolidate")
+
+        self.assertEqual(exit_code, 0)
+        self.assertTrue(run_etl.call_args.kwargs["select"]("consolidate_gbfs"))
+        self.assertEqual(
+            stdout.splitlines(),
+            ["2 cities failed:", "  Nantes: ValueError('bad feed')", "  Toulouse: ValueError('bad feed')"],
+        )
+
+    def test_command_outside_the_project_root_fails(self):
+        with mock.patch.object(etl_refresher, "run_etl") as run_etl:
+            exit_code, _, stderr = self.run_command("aggregate")
+
+        self.assertEqual(exit_code, 2)
+        self.assertIn("run from the project root", stderr)
+        run_etl.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
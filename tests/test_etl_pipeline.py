@@ -0,0 +1,86 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import duckdb
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPOSITORY_DIRECTORY, "src"))
+
+from etl_pipeline import run_pipeline, task  # noqa: E402
+
+
+class RunPipelineTest(unittest.TestCase):
+    """
+    Runs small pipelines on an in-memory database, the pipeline state being kept
+    in a scratch directory.
+    """
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="velo-test-")
+        self.addCleanup(shutil.rmtree, self.workdir, ignore_errors=True)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.workdir)
+        os.makedirs("data")
+
+        self.con = duckdb.connect()
+        self.addCleanup(self.con.close)
+        self.con.execute("CREATE TABLE T (X INTEGER)")
+
+    def count_committed(self):
+        # A new cursor only sees committed rows
+        cursor = self.con.cursor()
+        try:
+            return cursor.execute("SELECT count(*) FROM T").fetchone()[0]
+        finally:
+            cursor.close()
+
+    def test_finalize_runs_once_committed(self):
+        finalized = []
+
+        def write(con):
+            con.execute("INSERT INTO T VALUES (1)")
+            return "written"
+
+        def finalize(con, result):
+            finalized.append((result, self.count_committed()))
+
+        results = run_pipeline(
+            self.con,
+            [task("write", write, outputs=["table:T"], finalize=finalize)],
+            "v1",
+        )
+
+        self.assertEqual(results["write"]["status"], "ran")
+        self.assertEqual(finalized, [("written", 1)])
+
+    def test_finalize_skipped_when_the_task_is_rolled_back(self):
+        finalized = []
+
+        def write(con):
+            con.execute("INSERT INTO T VALUES (1)")
+            raise RuntimeError("boom")
+
+        results = run_pipeline(
+            self.con,
+            [
+                task(
+                    "write",
+                    write,
+                    outputs=["table:T"],
+                    finalize=lambda con, result: finalized.append(result),
+                    may_fail=True,
+                )
+            ],
+            "v1",
+        )
+
+        self.assertEqual(results["write"]["status"], "failed")
+        self.assertEqual(finalized, [])
+        self.assertEqual(self.count_committed(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
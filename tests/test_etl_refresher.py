@@ -0,0 +1,302 @@
+from contextlib import redirect_stdout
+from unittest import mock
+import glob
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import duckdb
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [
+    os.path.join(REPOSITORY_DIRECTORY, "src"),
+    os.path.join(REPOSITORY_DIRECTORY, "benchmarks"),
+]
+
+import city_registry  # noqa: E402
+import data_agregation  # noqa: E402
+import data_consolidation  # noqa: E402
+import data_ingestion  # noqa: E402
+import etl_pipeline  # noqa: E402
+import etl_refresher  # noqa: E402
+from data_consolidation import consolidate_station_statement  # noqa: E402
+from city_registry import feed_file_name  # noqa: E402
+from database import DATABASE_PATH, transaction  # noqa: E402
+from generate_feeds import generate_feeds, write_city_registry  # noqa: E402
+from stub_server import start_stub_server, use_stub_server  # noqa: E402
+
+NB_CITIES = 4
+NB_STATIONS = 20
+
+
+class EtlRunTest(unittest.TestCase):
+    """
+    Runs the ETL in a scratch directory on synthetic feeds served by the stub
+    server of the benchmarks: Paris, Nantes and Toulouse, and Montpellier, the
+    only GBFS city.
+    """
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="velo-test-")
+        self.addCleanup(shutil.rmtree, self.workdir, ignore_errors=True)
+        shutil.copytree(
+            os.path.join(REPOSITORY_DIRECTORY, "data", "sql_statements"),
+            os.path.join(self.workdir, "data", "sql_statements"),
+        )
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.workdir)
+
+        self.feeds_directory = os.path.join(self.workdir, "feeds")
+        generate_feeds(self.feeds_directory, NB_CITIES, NB_STATIONS)
+        server, base_url = start_stub_server(self.feeds_directory)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        registry_file = os.path.join(self.workdir, "data", "cities.toml")
+        write_city_registry(registry_file, NB_CITIES, base_url)
+        patched_environ = mock.patch.dict(os.environ, {"CITY_REGISTRY_FILE": registry_file})
+        patched_environ.start()
+        self.addCleanup(patched_environ.stop)
+        city_registry.get_city_registry.cache_clear()
+        self.addCleanup(city_registry.get_city_registry.cache_clear)
+
+        commune_datasets = list(data_ingestion.COMMUNE_DATASETS)
+        self.addCleanup(data_ingestion.COMMUNE_DATASETS.__setitem__, slice(None), commune_datasets)
+        use_stub_server(base_url)
+
+    def use_snapshot_mode(self):
+        for module in (data_ingestion, data_consolidation, data_agregation, etl_refresher):
+            patched_mode = mock.patch.object(module, "SNAPSHOT_MODE", True)
+            patched_mode.start()
+            self.addCleanup(patched_mode.stop)
+
+    def snapshot_files(self):
+        return sorted(glob.glob(f"{data_consolidation.SNAPSHOT_DIRECTORY}/*/*"))
+
+    def run_etl(self, run_id):
+        with redirect_stdout(io.StringIO()):
+            return etl_refresher.run_etl(run_id)
+
+    def query(self, sql, parameters=None):
+        with duckdb.connect(DATABASE_PATH, read_only=True) as con:
+            return con.execute(sql, parameters).fetchall()
+
+    def task_statuses(self, run_id):
+        """
+        Returns the status of each task run (not skipped) by an ETL run.
+        """
+        return dict(self.query(
+            "SELECT STAGE, STATUS FROM ETL_RUN_METRICS WHERE RUN_ID = ? AND KIND = 'task'",
+            [run_id],
+        ))
+
+    def bicycles_available(self, city_key):
+        """
+        Returns the total bicycles available of the consolidated statements of a city.
+        """
+        return self.query(
+            """
+            SELECT sum(s.BICYCLE_AVAILABLE)
+            FROM CONSOLIDATE_STATION_STATEMENT s
+            JOIN STATION_KEY k ON k.ID = s.STATION_ID
+            WHERE k.NATURAL_ID LIKE ?
+            """,
+            [f"{city_key}-%"],
+        )[0][0]
+
+    def feed(self, name, feed="realtime"):
+        with open(os.path.join(self.feeds_directory, feed_file_name(name, feed))) as fd:
+            return json.load(fd)
+
+    def test_failed_format_is_not_resumed(self):
+        self.run_etl("r1")
+
+        status_file = feed_file_name("Montpellier", "station_status")
+        with open(os.path.join(self.feeds_directory, status_file), "w") as fd:
+            fd.write('{"data": {"stations": [{"station_id": ')
+        summary = self.run_etl("r2")
+
+        self.assertEqual(list(summary["failed_cities"]), ["Montpellier"])
+        self.assertIsNone(etl_pipeline.get_resumable_run())
+
+        generate_feeds(self.feeds_directory, NB_CITIES, NB_STATIONS, snapshot=1)
+        summary = self.run_etl("r3")
+
+        self.assertEqual(summary["failed_cities"], {})
+        self.assertEqual(self.task_statuses("r3")["ingest"], "success")
+        status = self.feed("Montpellier", "station_status")["data"]["stations"]
+        self.assertEqual(self.bicycles_available(4), sum(s["num_bikes_available"] for s in status))
+
+    def test_broken_feed_only_fails_its_city(self):
+        self.run_etl("r1")
+
+        generate_feeds(self.feeds_directory, NB_CITIES, NB_STATIONS, snapshot=1)
+        nantes_feed = os.path.join(self.feeds_directory, feed_file_name("Nantes", "realtime"))
+        with open(nantes_feed, "w") as fd:
+            fd.write('[{"number": 1, "name": ')
+        summary = self.run_etl("r2")
+
+        self.assertEqual(list(summary["failed_cities"]), ["Nantes"])
+        toulouse = self.feed("Toulouse")
+        self.assertEqual(self.bicycles_available(3), sum(s["available_bikes"] for s in toulouse))
+
+    def test_unknown_station_status_is_left_empty(self):
+        paris = self.feed("Paris")
+        paris[0]["is_installed"] = "MAINTENANCE"
+        paris_feed = os.path.join(self.feeds_directory, feed_file_name("Paris", "realtime"))
+        with open(paris_feed, "w") as fd:
+            json.dump(paris, fd)
+        summary = self.run_etl("r1")
+
+        self.assertEqual(summary["failed_cities"], {})
+        statuses = self.query(
+            """
+            SELECT s.STATUS
+            FROM DIM_STATION s
+            JOIN STATION_KEY k ON k.ID = s.ID
+            WHERE k.NATURAL_ID = ?
+            """,
+            [f"1-{paris[0]['stationcode']}"],
+        )
+        self.assertEqual(statuses, [(None,)])
+
+    def test_statements_committed_late_are_merged(self):
+        self.run_etl("r1")
+
+        with duckdb.connect(DATABASE_PATH) as con:
+            station_id, created_date = con.execute(
+                "SELECT STATION_ID, CREATED_DATE FROM CONSOLIDATE_STATION_STATEMENT LIMIT 1"
+            ).fetchone()
+            loader = con.cursor()
+            loader.execute(
+                """
+                CREATE TEMP TABLE STAGING_JCDECAUX AS
+                SELECT
+                    ?::INTEGER AS station_key,
+                    1 AS bicycle_docks_available,
+                    99 AS bicycle_available,
+                    CURRENT_TIMESTAMP AS last_statement_date,
+                    ?::DATE AS created_date
+                """,
+                [station_id, created_date],
+            )
+            # The load commits after an aggregation that started later
+            loader.execute("BEGIN TRANSACTION")
+            consolidate_station_statement(loader, "jcdecaux")
+            aggregator = con.cursor()
+            with transaction(aggregator):
+                etl_refresher.agregate_facts(aggregator)
+            loader.execute("COMMIT")
+            with transaction(aggregator):
+                etl_refresher.agregate_facts(aggregator)
+
+            self.assertEqual(
+                con.execute(
+                    """
+                    SELECT BICYCLE_AVAILABLE
+                    FROM FACT_STATION_STATEMENT
+                    WHERE STATION_ID = ? AND CREATED_DATE = ?
+                    """,
+                    [station_id, created_date],
+                ).fetchall(),
+                [(99,)],
+            )
+            self.assertEqual(con.execute("SELECT count(*) FROM LOAD_BATCH").fetchone()[0], 0)
+
+    def test_rolled_back_consolidation_writes_no_snapshot(self):
+        self.use_snapshot_mode()
+        consolidate_statements = data_consolidation.consolidate_station_statement
+
+        def fail_gbfs(con, feed_format):
+            consolidate_statements(con, feed_format)
+            if feed_format == "gbfs":
+                raise RuntimeError("boom")
+
+        with mock.patch.object(
+            data_consolidation, "consolidate_station_statement", side_effect=fail_gbfs
+        ):
+            summary = self.run_etl("r1")
+
+        self.assertEqual(list(summary["failed_cities"]), ["Montpellier"])
+        self.assertEqual(
+            [os.path.basename(path).split("_", 1)[1] for path in self.snapshot_files()],
+            ["jcdecaux.parquet", "opendatasoft.parquet"],
+        )
+        self.assertEqual(
+            self.query("SELECT count(DISTINCT STATION_ID) FROM AGG_STATION_HOURLY")[0][0],
+            (NB_CITIES - 1) * NB_STATIONS,
+        )
+
+    def test_snapshots_keep_station_surrogate_keys(self):
+        self.use_snapshot_mode()
+        self.run_etl("r1")
+
+        snapshots = f"read_parquet('{data_consolidation.SNAPSHOT_DIRECTORY}/*/*.parquet')"
+        self.assertEqual(
+            self.query(f"""
+            SELECT count(*), count(k.ID)
+            FROM {snapshots} s
+            LEFT JOIN STATION_KEY k ON k.ID = s.station_id
+            """)[0],
+            (NB_CITIES * NB_STATIONS, NB_CITIES * NB_STATIONS),
+        )
+
+        # A file written when the snapshots kept the natural station ids
+        path = self.snapshot_files()[0]
+        snapshot = f"read_parquet('{path}', hive_partitioning = false)"
+        with duckdb.connect(DATABASE_PATH) as con:
+            expected = con.execute(f"SELECT * FROM {snapshot} ORDER BY ALL").fetchall()
+            con.execute(f"""
+            COPY (
+                SELECT k.NATURAL_ID AS station_id, s.* EXCLUDE (station_id)
+                FROM {snapshot} s
+                JOIN STATION_KEY k ON k.ID = s.station_id
+            ) TO '{path}.tmp' (FORMAT parquet)
+            """)
+            os.replace(f"{path}.tmp", path)
+
+            data_consolidation.create_consolidate_tables(con)
+
+            self.assertEqual(con.execute(f"SELECT * FROM {snapshot} ORDER BY ALL").fetchall(), expected)
+
+    def test_unchanged_sources_are_not_consolidated_again(self):
+        self.run_etl("r1")
+
+        # Only the Nantes feed changes
+        nantes = self.feed("Nantes")
+        nantes[0]["available_bikes"] += 1
+        nantes_feed = os.path.join(self.feeds_directory, feed_file_name("Nantes", "realtime"))
+        with open(nantes_feed, "w") as fd:
+            json.dump(nantes, fd)
+        self.run_etl("r2")
+
+        statuses = self.task_statuses("r2")
+        self.assertEqual(statuses["consolidate_jcdecaux"], "success")
+        self.assertNotIn("consolidate_cities", statuses)
+        self.assertNotIn("consolidate_opendatasoft", statuses)
+        self.assertNotIn("consolidate_gbfs", statuses)
+        self.assertEqual(self.bicycles_available(2), sum(s["available_bikes"] for s in nantes))
+
+    def test_resumed_run_fetches_the_sources_again(self):
+        with mock.patch.object(etl_refresher, "agregate_facts", side_effect=RuntimeError("boom")):
+            with self.assertRaises(RuntimeError):
+                self.run_etl("r1")
+        self.assertIsNotNone(etl_pipeline.get_resumable_run())
+
+        generate_feeds(self.feeds_directory, NB_CITIES, NB_STATIONS, snapshot=1)
+        self.run_etl("r2")
+
+        statuses = self.task_statuses("r2")
+        self.assertEqual(statuses["ingest"], "success")
+        self.assertEqual(statuses["consolidate_opendatasoft"], "success")
+        self.assertIsNone(etl_pipeline.get_resumable_run())
+        paris = self.feed("Paris")
+        self.assertEqual(self.bicycles_available(1), sum(s["numbikesavailable"] for s in paris))
+
+
+if __name__ == "__main__":
+    unittest.main()
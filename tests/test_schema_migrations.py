@@ -0,0 +1,231 @@
+from datetime import date
+from unittest import mock
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import duckdb
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPOSITORY_DIRECTORY, "src"))
+
+import schema_migrations  # noqa: E402
+from data_agregation import (  # noqa: E402
+    agregate_data,
+    agregate_dim_city,
+    agregate_dim_station,
+    create_agregate_tables,
+)
+from data_consolidation import create_consolidate_tables  # noqa: E402
+
+DAY_1 = date(2025, 1, 1)
+DAY_2 = date(2025, 1, 2)
+
+# The schema of the databases created before the versioned migrations
+BASELINE_SCHEMA = """
+CREATE TABLE CONSOLIDATE_STATION (
+    ID VARCHAR NOT NULL,
+    CODE VARCHAR NOT NULL,
+    NAME VARCHAR,
+    CITY_NAME VARCHAR,
+    CITY_CODE VARCHAR,
+    ADDRESS VARCHAR,
+    LONGITUDE FLOAT,
+    LATITUDE FLOAT,
+    STATUS VARCHAR,
+    CREATED_DATE DATE,
+    CAPACITTY INTEGER,
+    PRIMARY KEY (ID, CREATED_DATE)
+);
+
+CREATE TABLE CONSOLIDATE_CITY (
+    ID VARCHAR,
+    NAME VARCHAR,
+    NB_INHABITANTS INTEGER,
+    CREATED_DATE VARCHAR,
+    PRIMARY KEY (ID, CREATED_DATE)
+);
+
+CREATE TABLE CONSOLIDATE_STATION_STATEMENT (
+    STATION_ID VARCHAR NOT NULL,
+    BICYCLE_DOCKS_AVAILABLE INTEGER,
+    BICYCLE_AVAILABLE INTEGER,
+    LAST_STATEMENT_DATE DATE,
+    CREATED_DATE VARCHAR,
+    PRIMARY KEY (STATION_ID, CREATED_DATE)
+);
+
+CREATE TABLE DIM_STATION (
+    ID VARCHAR PRIMARY KEY,
+    CODE VARCHAR,
+    NAME VARCHAR,
+    ADDRESS VARCHAR,
+    LONGITUDE FLOAT,
+    LATITUDE FLOAT,
+    STATUS VARCHAR,
+    CAPACITTY INTEGER
+);
+
+CREATE TABLE DIM_CITY (
+    ID VARCHAR PRIMARY KEY,
+    NAME VARCHAR,
+    NB_INHABITANTS INTEGER
+);
+
+CREATE TABLE FACT_STATION_STATEMENT (
+    STATION_ID VARCHAR NOT NULL,
+    CITY_ID VARCHAR NOT NULL,
+    BICYCLE_DOCKS_AVAILABLE INTEGER,
+    BICYCLE_AVAILABLE INTEGER,
+    LAST_STATEMENT_DATE DATETIME,
+    CREATED_DATE DATE DEFAULT current_date,
+    PRIMARY KEY (STATION_ID, CITY_ID, CREATED_DATE),
+    FOREIGN KEY (STATION_ID) REFERENCES DIM_STATION (ID),
+    FOREIGN KEY (CITY_ID) REFERENCES DIM_CITY (ID)
+);
+
+INSERT INTO CONSOLIDATE_CITY VALUES
+    ('75056', 'Paris', 2100000, '2025-01-01'),
+    ('2A004', 'Ajaccio', 70000, '2025-01-01');
+
+-- Daily copies of the stations, one with a status outside the enum
+INSERT INTO CONSOLIDATE_STATION VALUES
+    ('75056-1', '1', 'Louvre', 'Paris', '75056', 'Rue de Rivoli', 2.34, 48.86, 'OUI', '2025-01-01', 20),
+    ('75056-1', '1', 'Louvre', 'Paris', '75056', 'Rue de Rivoli', 2.34, 48.86, 'OUI', '2025-01-02', 20),
+    ('2A004-1', '1', 'Gare', 'Ajaccio', '2A004', 'Cours Napoléon', 8.73, 41.93, 'MAINTENANCE', '2025-01-01', 10);
+
+INSERT INTO CONSOLIDATE_STATION_STATEMENT VALUES
+    ('75056-1', 17, 3, '2025-01-01', '2025-01-01'),
+    ('75056-1', 16, 4, '2025-01-02', '2025-01-02'),
+    ('2A004-1', 5, 5, '2025-01-01', '2025-01-01');
+
+INSERT INTO DIM_CITY VALUES ('75056', 'Paris', 2100000);
+INSERT INTO DIM_STATION VALUES ('75056-1', '1', 'Louvre', 'Rue de Rivoli', 2.34, 48.86, 'OUI', 20);
+INSERT INTO FACT_STATION_STATEMENT VALUES ('75056-1', '75056', 17, 3, '2025-01-01', '2025-01-01');
+"""
+
+
+class SchemaMigrationTest(unittest.TestCase):
+    """
+    Upgrades a database created with the baseline schema in a scratch directory.
+    """
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="velo-test-")
+        self.addCleanup(shutil.rmtree, self.workdir, ignore_errors=True)
+        shutil.copytree(
+            os.path.join(REPOSITORY_DIRECTORY, "data", "sql_statements"),
+            os.path.join(self.workdir, "data", "sql_statements"),
+        )
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.workdir)
+
+        self.con = duckdb.connect(os.path.join(self.workdir, "test.duckdb"))
+        self.addCleanup(self.con.close)
+        self.con.execute(BASELINE_SCHEMA)
+
+    def migrate_up_to(self, last_version):
+        """
+        Applies the migrations up to `last_version` only.
+        """
+        directory = os.path.join(self.workdir, "migrations")
+        os.makedirs(directory)
+        for version, _, path in schema_migrations.list_migrations():
+            if version <= last_version:
+                shutil.copy(path, directory)
+
+        with mock.patch.object(schema_migrations, "MIGRATIONS_DIRECTORY", directory):
+            schema_migrations.migrate_schema(self.con)
+
+    def column_type(self, table_name, column_name):
+        return self.con.execute(
+            "SELECT data_type FROM duckdb_columns() WHERE table_name = ? AND column_name = ?",
+            [table_name, column_name],
+        ).fetchone()[0]
+
+    def facts(self):
+        """
+        Returns the facts by natural station id and city code.
+        """
+        return self.con.execute("""
+        SELECT s.NATURAL_ID, c.NATURAL_ID, f.BICYCLE_AVAILABLE, f.CREATED_DATE
+        FROM FACT_STATION_STATEMENT f
+        JOIN STATION_KEY s ON s.ID = f.STATION_ID
+        JOIN CITY_KEY c ON c.ID = f.CITY_ID
+        ORDER BY ALL
+        """).fetchall()
+
+    def test_baseline_database_is_upgraded(self):
+        create_consolidate_tables(self.con)
+
+        self.assertEqual(
+            self.con.execute("SELECT VERSION FROM SCHEMA_VERSION ORDER BY 1").fetchall(),
+            [(version,) for version, _, _ in schema_migrations.list_migrations()],
+        )
+        self.assertEqual(self.column_type("CONSOLIDATE_STATION_STATEMENT", "STATION_ID"), "INTEGER")
+        self.assertEqual(self.column_type("CONSOLIDATE_STATION", "STATUS"), "ENUM('OUI', 'NON')")
+        # The daily copies are converted into versions
+        self.assertEqual(
+            self.con.execute("""
+            SELECT k.NATURAL_ID, s.STATUS, s.CREATED_DATE, s.VALID_TO
+            FROM CONSOLIDATE_STATION s
+            JOIN STATION_KEY k ON k.ID = s.ID
+            ORDER BY ALL
+            """).fetchall(),
+            [("2A004-1", None, DAY_1, None), ("75056-1", "OUI", DAY_1, None)],
+        )
+        # The existing statements form batch 0
+        self.assertEqual(self.con.execute("SELECT ID FROM LOAD_BATCH").fetchall(), [(0,)])
+        self.assertEqual(
+            self.con.execute(
+                "SELECT DISTINCT LOAD_BATCH FROM CONSOLIDATE_STATION_STATEMENT"
+            ).fetchall(),
+            [(0,)],
+        )
+
+        agregate_data(self.con)
+
+        self.assertEqual(
+            self.facts(),
+            [("2A004-1", "2A004", 5, DAY_1), ("75056-1", "75056", 3, DAY_1), ("75056-1", "75056", 4, DAY_2)],
+        )
+        self.assertEqual(self.con.execute("SELECT count(*) FROM LOAD_BATCH").fetchone()[0], 0)
+        self.assertEqual(
+            self.con.execute("""
+            SELECT s.NATURAL_ID, c.NATURAL_ID
+            FROM DIM_STATION d
+            JOIN STATION_KEY s ON s.ID = d.ID
+            JOIN CITY_KEY c ON c.ID = d.CITY_ID
+            ORDER BY ALL
+            """).fetchall(),
+            [("2A004-1", "2A004"), ("75056-1", "75056")],
+        )
+
+    def test_statements_missing_from_the_facts_are_merged_after_migration_3(self):
+        # A version 2 database whose last aggregation merged the first day only,
+        # before the second day was loaded and the first one revised
+        self.migrate_up_to(2)
+        create_agregate_tables(self.con)
+        agregate_dim_city(self.con)
+        agregate_dim_station(self.con)
+        self.con.execute("""
+        INSERT INTO FACT_STATION_STATEMENT
+        SELECT s.STATION_ID, d.CITY_ID, s.BICYCLE_DOCKS_AVAILABLE, 1, s.LAST_STATEMENT_DATE, s.CREATED_DATE
+        FROM CONSOLIDATE_STATION_STATEMENT s
+        JOIN DIM_STATION d ON d.ID = s.STATION_ID
+        WHERE s.CREATED_DATE = ?
+        """, [DAY_1])
+
+        create_consolidate_tables(self.con)
+        agregate_data(self.con)
+
+        self.assertEqual(
+            self.facts(),
+            [("2A004-1", "2A004", 5, DAY_1), ("75056-1", "75056", 3, DAY_1), ("75056-1", "75056", 4, DAY_2)],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,148 @@
+from datetime import date, datetime
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+import duckdb
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPOSITORY_DIRECTORY, "src"))
+
+from data_agregation import create_agregate_tables  # noqa: E402
+from data_consolidation import create_consolidate_tables  # noqa: E402
+from spatial_index import (  # noqa: E402
+    EARTH_RADIUS_KM,
+    GRID_CELL_DEGREES,
+    build_station_grid,
+    find_nearest_stations,
+    find_stations_within_radius,
+)
+
+# Notre-Dame de Paris
+LONGITUDE, LATITUDE = 2.3499, 48.8530
+
+
+def distance_km(longitude_1, latitude_1, longitude_2, latitude_2):
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(
+        math.sin(math.radians(latitude_2 - latitude_1) / 2) ** 2
+        + math.cos(math.radians(latitude_1)) * math.cos(math.radians(latitude_2))
+        * math.sin(math.radians(longitude_2 - longitude_1) / 2) ** 2
+    ))
+
+
+class SpatialIndexTest(unittest.TestCase):
+    """
+    Searches stations of the grid index of a scratch database, against the
+    distances to every station.
+    """
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="velo-test-")
+        self.addCleanup(shutil.rmtree, self.workdir, ignore_errors=True)
+        shutil.copytree(
+            os.path.join(REPOSITORY_DIRECTORY, "data", "sql_statements"),
+            os.path.join(self.workdir, "data", "sql_statements"),
+        )
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.workdir)
+
+        self.con = duckdb.connect(os.path.join(self.workdir, "test.duckdb"))
+        self.addCleanup(self.con.close)
+        create_consolidate_tables(self.con)
+        create_agregate_tables(self.con)
+
+        rng = random.Random(0)
+        self.stations = [
+            (LONGITUDE + rng.uniform(-0.1, 0.1), LATITUDE + rng.uniform(-0.05, 0.05), rng.randint(0, 3))
+            for _ in range(300)
+        ]
+        self.add_stations(self.stations)
+
+    def add_stations(self, stations):
+        """
+        Adds (longitude, latitude, bikes available) stations, then rebuilds the grid.
+        """
+        first_id = self.con.execute("SELECT COALESCE(MAX(ID), 0) + 1 FROM DIM_STATION").fetchone()[0]
+        for station_id, (longitude, latitude, bikes) in enumerate(stations, start=first_id):
+            self.con.execute(
+                "INSERT INTO DIM_STATION (ID, NAME, LONGITUDE, LATITUDE) VALUES (?, ?, ?, ?)",
+                [station_id, f"Station {station_id}", longitude, latitude],
+            )
+            self.con.execute(
+                "INSERT INTO AGG_STATION_LATEST VALUES (?, ?, ?, ?, ?, ?)",
+                [station_id, date(2025, 1, 1), 10, bikes, datetime(2025, 1, 1), datetime(2025, 1, 1)],
+            )
+        build_station_grid(self.con)
+
+    def expected_stations(self, longitude, latitude, radius_km, min_bicycles=1):
+        """
+        Returns the ids of the stations within the radius, nearest first, from the
+        distances to every station as stored (single precision coordinates).
+        """
+        rows = self.con.execute(
+            "SELECT s.ID, s.LONGITUDE, s.LATITUDE, l.BICYCLE_AVAILABLE FROM DIM_STATION s "
+            "JOIN AGG_STATION_LATEST l ON l.STATION_ID = s.ID"
+        ).fetchall()
+        distances = sorted(
+            (distance_km(longitude, latitude, station_longitude, station_latitude), station_id)
+            for station_id, station_longitude, station_latitude, bikes in rows
+            if bikes >= min_bicycles
+        )
+        return [station_id for distance, station_id in distances if distance <= radius_km]
+
+    def test_radius_search_without_limit_returns_every_station(self):
+        stations = find_stations_within_radius(self.con, LONGITUDE, LATITUDE, 2.0, limit=None)
+
+        expected = self.expected_stations(LONGITUDE, LATITUDE, 2.0)
+        self.assertGreater(len(expected), 10)
+        self.assertEqual(stations.column("station_id").to_pylist(), expected)
+
+    def test_nearest_stations_across_cell_borders(self):
+        # Just west and south of a cell corner: the nearest stations are in the
+        # three neighbouring cells, a station of the same cell is further away
+        corner_longitude = math.ceil(LONGITUDE / GRID_CELL_DEGREES) * GRID_CELL_DEGREES
+        corner_latitude = math.ceil(LATITUDE / GRID_CELL_DEGREES) * GRID_CELL_DEGREES
+        longitude, latitude = corner_longitude - 0.0001, corner_latitude - 0.0001
+        self.add_stations([
+            (corner_longitude + 0.0002, latitude, 1),
+            (longitude, corner_latitude + 0.0002, 1),
+            (corner_longitude + 0.0002, corner_latitude + 0.0002, 1),
+            (corner_longitude - 0.009, corner_latitude - 0.009, 1),
+        ])
+
+        nearby = find_stations_within_radius(self.con, longitude, latitude, 0.1)
+        stations = find_nearest_stations(self.con, longitude, latitude, k=3)
+
+        self.assertEqual(
+            nearby.column("station_id").to_pylist(),
+            self.expected_stations(longitude, latitude, 0.1),
+        )
+        self.assertEqual(
+            stations.column("station_id").to_pylist(),
+            self.expected_stations(longitude, latitude, 50.0)[:3],
+        )
+        self.assertEqual(
+            sorted(stations.column("station_id").to_pylist()),
+            [len(self.stations) + 1, len(self.stations) + 2, len(self.stations) + 3],
+        )
+
+    def test_no_station_within_the_largest_radius(self):
+        # Marseille, about 660 km away
+        stations = find_nearest_stations(self.con, 5.3698, 43.2965, k=5)
+
+        self.assertEqual(stations.num_rows, 0)
+
+    def test_nearest_stations_with_fewer_stations_than_requested(self):
+        stations = find_nearest_stations(self.con, LONGITUDE, LATITUDE, k=1000, min_bicycles=3)
+
+        expected = self.expected_stations(LONGITUDE, LATITUDE, 50.0, min_bicycles=3)
+        self.assertLess(len(expected), 1000)
+        self.assertEqual(stations.column("station_id").to_pylist(), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()